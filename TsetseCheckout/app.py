@@ -1,48 +1,91 @@
 # -*- coding: utf-8 -*-
 '''The app module, containing the app factory function.'''
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from flask import Flask, render_template
+from werkzeug.utils import import_string
 
 from TsetseCheckout.settings import ProdConfig
-from TsetseCheckout.assets import assets
+from TsetseCheckout.assets import asset_manifest
+from TsetseCheckout.audit.log import audit_log
+from TsetseCheckout.caching import page_cache
+from TsetseCheckout.hashing import hashing_pool
+from TsetseCheckout.metrics import metrics
+from TsetseCheckout.middleware import response_middleware
+from TsetseCheckout.profiling import profiler
+from TsetseCheckout.throttle import login_throttle
 from TsetseCheckout.extensions import (
     bcrypt,
     cache,
     db,
     login_manager,
-    migrate,
-    debug_toolbar,
 )
-from TsetseCheckout import public, user
+from TsetseCheckout.user.cache import user_cache, username_filter
 
 
 def create_app(config_object=ProdConfig):
     '''An application factory, as explained here:
         http://flask.pocoo.org/docs/patterns/appfactories/
 
+    How long each step takes is kept in ``app.extensions['startup_timings']``.
+
     :param config_object: The configuration object to use.
     '''
     app = Flask(__name__)
-    app.config.from_object(config_object)
+    app.extensions['startup_timings'] = OrderedDict()
+    with startup_step(app, 'config'):
+        app.config.from_object(config_object)
     register_extensions(app)
-    register_blueprints(app)
+    with startup_step(app, 'blueprints'):
+        register_blueprints(app)
     register_errorhandlers(app)
     return app
 
 
+@contextmanager
+def startup_step(app, name):
+    '''Record how long the enclosed block takes as startup step ``name``.'''
+    start = time.time()
+    yield
+    app.extensions['startup_timings'][name] = time.time() - start
+
+
 def register_extensions(app):
-    assets.init_app(app)
-    bcrypt.init_app(app)
-    cache.init_app(app)
-    db.init_app(app)
-    login_manager.init_app(app)
-    debug_toolbar.init_app(app)
-    migrate.init_app(app, db)
+    steps = [
+        ('asset_manifest', asset_manifest.init_app),
+        ('hashing_pool', hashing_pool.init_app),
+        ('bcrypt', bcrypt.init_app),
+        ('cache', cache.init_app),
+        ('page_cache', page_cache.init_app),
+        ('db', db.init_app),
+        ('login_manager', login_manager.init_app),
+        ('user_cache', user_cache.init_app),
+        ('username_filter', username_filter.init_app),
+        ('response_middleware', response_middleware.init_app),
+        ('metrics', metrics.init_app),
+        ('profiler', profiler.init_app),
+        ('login_throttle', login_throttle.init_app),
+        ('audit_log', audit_log.init_app),
+    ]
+    # Development-only extensions aren't even imported unless enabled.
+    if app.config.get('DEBUG_TB_ENABLED'):
+        steps.append(('debug_toolbar', _init_debug_toolbar))
+    for name, init_app in steps:
+        with startup_step(app, name):
+            init_app(app)
     return None
 
 
+def _init_debug_toolbar(app):
+    from flask.ext.debugtoolbar import DebugToolbarExtension
+    DebugToolbarExtension(app)
+
+
 def register_blueprints(app):
-    app.register_blueprint(public.views.blueprint)
-    app.register_blueprint(user.views.blueprint)
+    for import_name in app.config['BLUEPRINTS']:
+        app.register_blueprint(import_string(import_name))
     return None
 
 
@@ -50,7 +93,25 @@ def register_errorhandlers(app):
     def render_error(error):
         # If a HTTPException, pull the `code` attribute; default to 500
         error_code = getattr(error, 'code', 500)
-        return render_template("{0}.html".format(error_code)), error_code
-    for errcode in [401, 404, 500]:
+        headers = {}
+        if getattr(error, 'retry_after', None) is not None:
+            headers['Retry-After'] = str(error.retry_after)
+        return (render_template("{0}.html".format(error_code)), error_code,
+                headers)
+    for errcode in [401, 403, 404, 429, 500, 503]:
         app.errorhandler(errcode)(render_error)
-    return None
\ No newline at end of file
+    return None
+
+
+def after_fork(app):
+    '''Drop resources a worker must not share with the process it was forked
+    from. Call in each worker when the app is created before forking, as with
+    gunicorn's ``preload_app``.
+
+    The database pool's connections would otherwise be shared by every
+    worker. The hashing pool and the SQLite cache notice the fork themselves
+    and start afresh.
+    '''
+    with app.app_context():
+        db.engine.dispose()
+    return None
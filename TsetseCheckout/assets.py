@@ -1,22 +1,180 @@
 # -*- coding: utf-8 -*-
-from flask.ext.assets import Bundle, Environment
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
 
-css = Bundle(
-    "libs/bootstrap/dist/css/bootstrap.css",
-    "css/style.css",
-    filters="cssmin",
-    output="public/css/common.css"
-)
+from flask import Blueprint, abort, send_file, url_for
 
-js = Bundle(
-    "libs/jQuery/dist/jquery.js",
-    "libs/bootstrap/dist/js/bootstrap.js",
-    "js/plugins.js",
-    filters='jsmin',
-    output="public/js/common.js"
+from TsetseCheckout.middleware import (
+    accepts_encoding,
+    no_compression,
+    no_etag,
 )
 
-assets = Environment()
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Plain data, so workers serving prebuilt files never import Flask-Assets.
+BUNDLES = {
+    "css_all": dict(
+        contents=(
+            "libs/bootstrap/dist/css/bootstrap.css",
+            "css/style.css",
+        ),
+        filters="cssmin",
+        output="public/css/common.css",
+    ),
+    "js_all": dict(
+        contents=(
+            "libs/jQuery/dist/jquery.js",
+            "libs/bootstrap/dist/js/bootstrap.js",
+            "js/plugins.js",
+        ),
+        filters='jsmin',
+        output="public/js/common.js",
+    ),
+}
+
+#: Cache lifetime for hashed files; their names change with their content.
+FAR_FUTURE = 365 * 24 * 60 * 60
+
+#: Precompressed variants, in order of preference, by file suffix.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+blueprint = Blueprint('assets', __name__, url_prefix='/assets')
+
+
+def build_assets(app, dist_dir=None):
+    '''Compile every registered bundle once and write it to ``dist_dir``
+    under a name containing a hash of its content, next to gzip (and, if
+    the ``brotli`` package is installed, brotli) compressed copies. A
+    ``manifest.json`` maps each bundle name to its file.
+
+    :returns: The manifest.
+    '''
+    dist_dir = dist_dir or app.config['ASSETS_DIST_DIR']
+    if not os.path.isdir(dist_dir):
+        os.makedirs(dist_dir)
+    manifest = {}
+    environment = make_environment(app)
+    with app.app_context():
+        for name in sorted(BUNDLES):
+            bundle = environment[name]
+            data = ''.join(hunk.data() for hunk in bundle.build(force=True))
+            data = data.encode('utf-8')
+            root, ext = os.path.splitext(os.path.basename(bundle.output))
+            filename = '{0}.{1}{2}'.format(
+                root, hashlib.sha256(data).hexdigest()[:12], ext)
+            path = os.path.join(dist_dir, filename)
+            _write(path, data)
+            _write(path + '.gz', _gzip(data))
+            if brotli is not None:
+                _write(path + '.br', brotli.compress(data))
+            manifest[name] = filename
+    _write(os.path.join(dist_dir, 'manifest.json'),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def make_environment(app):
+    '''A Flask-Assets environment for ``app`` with :data:`BUNDLES`
+    registered.
+    '''
+    from flask.ext.assets import Bundle, Environment
+    environment = Environment(app)
+    for name, spec in BUNDLES.items():
+        environment.register(name, Bundle(*spec['contents'],
+                                          filters=spec['filters'],
+                                          output=spec['output']))
+    return environment
+
+
+class AssetManifest(object):
+    '''Gives templates ``asset_urls(name)``.
+
+    With ``ASSETS_USE_MANIFEST`` the URLs come from the manifest written by
+    :func:`build_assets` and point at the hashed files, which workers serve
+    precompressed and never build. Otherwise, or if the manifest hasn't
+    been built, Flask-Assets builds bundles on demand as before.
+    '''
+
+    def __init__(self, app=None):
+        self.manifest = None
+        self.dist_dir = None
+        self.environment = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.manifest = None
+        self.environment = None
+        self.dist_dir = app.config.get('ASSETS_DIST_DIR')
+        if app.config.get('ASSETS_USE_MANIFEST'):
+            path = os.path.join(self.dist_dir, 'manifest.json')
+            try:
+                with open(path) as f:
+                    self.manifest = json.load(f)
+            except (IOError, OSError):
+                app.logger.warning(
+                    'ASSETS_USE_MANIFEST is set but %s is missing, so assets '
+                    'will be built on demand. Run "python manage.py assets '
+                    'build" when deploying.', path)
+        if self.manifest is None:
+            self.environment = make_environment(app)
+        app.jinja_env.globals['asset_urls'] = self.urls
+        app.extensions['asset_manifest'] = self
+
+    def urls(self, name):
+        if self.manifest is None:
+            return self.environment[name].urls()
+        return [url_for('assets.dist', filename=self.manifest[name])]
+
+
+@blueprint.route('/<filename>')
+@no_compression
+@no_etag
+def dist(filename):
+    '''Serve a built asset, precompressed if the client accepts it, with
+    headers that let browsers keep it for a year without revalidating.
+    '''
+    manifest = asset_manifest.manifest
+    if not manifest or filename not in manifest.values():
+        abort(404)
+    path = os.path.join(asset_manifest.dist_dir, filename)
+    encoding = None
+    for candidate, suffix in ENCODINGS:
+        if accepts_encoding(candidate) and os.path.exists(path + suffix):
+            encoding, path = candidate, path + suffix
+            break
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0],
+                         add_etags=False, cache_timeout=FAR_FUTURE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = \
+        'public, max-age={0}, immutable'.format(FAR_FUTURE)
+    return response
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    # A fixed mtime keeps builds of the same content byte-identical.
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
 
-assets.register("js_all", js)
-assets.register("css_all", css)
\ No newline at end of file
+asset_manifest = AssetManifest()
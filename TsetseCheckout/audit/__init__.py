@@ -0,0 +1,3 @@
+'''The audit module, an append-only record of logins and checkouts.'''
+
+from . import models
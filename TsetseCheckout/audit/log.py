@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+'''Write-behind audit logging.
+
+:meth:`AuditLog.record` only adds the event to a buffer in memory, so a
+login or a rack checkout doesn't wait for another commit. A thread writes
+the buffer to ``audit_events`` every ``AUDIT_FLUSH_INTERVAL`` seconds, or
+as soon as ``AUDIT_BATCH_SIZE`` events are waiting, in one transaction of
+multi-row ``INSERT`` statements. Whatever is left is written when the worker
+exits. If a write fails the events go back in the buffer for the next try,
+up to ``AUDIT_MAX_BUFFER`` of them; past that, the oldest are dropped.
+
+If ``AUDIT_SPOOL_DIR`` is set, every event is also appended to a spool file
+there (a directory only this user may write to) until the batch it belongs to is committed. The spool files of a
+worker that died first are written by the next worker to start flushing
+(:meth:`AuditLog.recover`), skipping any events that did reach the database.
+With a spool, events over ``AUDIT_MAX_BUFFER`` are not dropped but left in
+their files, which the worker recovers after its next successful write.
+'''
+import atexit
+import datetime as dt
+import errno
+import glob
+import itertools
+import json
+import os
+import re
+import threading
+import uuid
+
+from flask import has_request_context, request
+from sqlalchemy import select
+
+from TsetseCheckout.audit.models import AuditEvent
+from TsetseCheckout.database import SQLITE_MAX_VARIABLES, chunked, db
+from TsetseCheckout.shared_sqlite import private_directory
+from TsetseCheckout.utils import process_is_running
+
+#: Seconds :meth:`AuditLog.shutdown` waits for the flushing thread.
+SHUTDOWN_TIMEOUT = 10
+
+#: Event ids looked up per query when recovering a spool file.
+RECOVERY_BATCH_SIZE = 500
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# <writer pid>.<sequence>.jsonl, then .<recovering pid>.recovering once a
+# worker has claimed it.
+_SPOOL_FILE = re.compile(r'^(\d+)\.(\d+)\.jsonl(?:\.(\d+)\.recovering)?$')
+
+
+class AuditLog(object):
+    '''Buffers :class:`AuditEvent` rows and writes them in batches.'''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.flush_interval = 5
+        self.batch_size = 500
+        self.max_buffer = 10000
+        self.spool_dir = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._sequence = itertools.count(1)
+        self._registered_exit = False
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        # Anything a previous app couldn't write belongs to its database.
+        self._reset()
+        self.app = app
+        self.enabled = app.config.get('AUDIT_ENABLED', True)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', 5)
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', 500)
+        self.max_buffer = app.config.get('AUDIT_MAX_BUFFER', 10000)
+        self.spool_dir = app.config.get('AUDIT_SPOOL_DIR')
+        if self.spool_dir:
+            # Its files are written to audit_events as they are.
+            private_directory(self.spool_dir)
+        if not self._registered_exit:
+            atexit.register(self.shutdown)
+            self._registered_exit = True
+        app.extensions['audit_log'] = self
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._buffer = []
+        self._spool = None
+        self._spool_path = None
+        # Spool files holding the buffered events that came from them
+        self._spooled_paths = []
+        # Whether spool files were left for recover() after a failed write
+        self._unrecovered = False
+        self._thread = None
+
+    def _check_pid(self):
+        # A forked worker keeps its own buffer and spool files.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def record(self, action, user_id=None, sample_ids=(None,),
+               username=None, detail=None):
+        '''Log ``action`` by the current client, once per sample in
+        ``sample_ids`` (or once, for actions that don't involve one).
+        '''
+        if not self.enabled:
+            return
+        now = dt.datetime.utcnow()
+        remote_addr = request.remote_addr if has_request_context() else None
+        events = [dict(event_id=uuid.uuid4().hex, action=action,
+                       user_id=user_id, sample_id=sample_id,
+                       username=username[:80] if username else None,
+                       remote_addr=remote_addr,
+                       detail=detail[:255] if detail else None,
+                       created_at=now)
+                  for sample_id in sample_ids]
+        if not events:
+            return
+        with self._lock:
+            self._check_pid()
+            self._buffer.extend(events)
+            if self.spool_dir:
+                self._write_spool(events)
+            full = len(self._buffer) >= self.batch_size
+        if self.flush_interval:
+            self._ensure_started()
+            if full:
+                self._wake.set()
+        elif full:
+            self.flush()
+
+    def _write_spool(self, events):
+        if self._spool is None:
+            self._spool_path = os.path.join(
+                self.spool_dir, '{0}.{1}.jsonl'.format(os.getpid(),
+                                                       next(self._sequence)))
+            self._spool = open(self._spool_path, 'a')
+        for event in events:
+            self._spool.write(_dumps(event) + '\n')
+        # In the OS's hands, a crash of this process no longer loses it.
+        self._spool.flush()
+
+    def flush(self):
+        '''Write the buffered events now.
+
+        :returns: How many were written.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                self._check_pid()
+                events, self._buffer = self._buffer, []
+                if self._spool is not None:
+                    self._spool.close()
+                    self._spooled_paths.append(self._spool_path)
+                    self._spool = self._spool_path = None
+                paths, self._spooled_paths = self._spooled_paths, []
+            if not events:
+                return 0
+            try:
+                self._insert(events)
+            except Exception:
+                self.app.logger.exception(
+                    'Could not write %d audit events; will retry',
+                    len(events))
+                with self._lock:
+                    self._requeue(events, paths)
+                return 0
+            for path in paths:
+                _remove(path)
+            written = len(events)
+            if self._unrecovered:
+                try:
+                    written += self.recover()
+                except Exception:
+                    self.app.logger.exception(
+                        'Could not recover audit spool files')
+                else:
+                    self._unrecovered = False
+            return written
+
+    def _requeue(self, events, paths):
+        # Put the events of a failed write back, keeping at most
+        # max_buffer in memory while the database is down.
+        if len(events) + len(self._buffer) <= self.max_buffer:
+            self._buffer[:0] = events
+            self._spooled_paths[:0] = paths
+        elif paths:
+            # They are all on disk: leave them to recover().
+            for path in paths:
+                os.rename(path, '{0}.{1}.recovering'.format(path,
+                                                           os.getpid()))
+            self._unrecovered = True
+        else:
+            self._buffer[:0] = events
+            dropped = len(self._buffer) - self.max_buffer
+            del self._buffer[:dropped]
+            self.app.logger.error('Dropped %d audit events', dropped)
+
+    def recover(self):
+        '''Write the events in the spool files of workers that have exited.
+
+        :returns: How many events were written.
+        '''
+        if not self.spool_dir:
+            return 0
+        written = 0
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*'))):
+            claimed = self._claim(path)
+            if claimed is None:
+                continue
+            with open(claimed) as f:
+                events = [_loads(line) for line in f]
+            events = [event for event in events if event is not None]
+            written += self._insert_missing(events)
+            _remove(claimed)
+        return written
+
+    def _claim(self, path):
+        match = _SPOOL_FILE.match(os.path.basename(path))
+        if match is None:
+            return None
+        claimer = match.group(3)
+        if claimer is not None and int(claimer) == os.getpid():
+            return path  # Ours, from a try that failed
+        if process_is_running(int(claimer or match.group(1))):
+            return None
+        claimed = '{0}.{1}.jsonl.{2}.recovering'.format(
+            match.group(1), match.group(2), os.getpid())
+        claimed = os.path.join(self.spool_dir, claimed)
+        try:
+            os.rename(path, claimed)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return None  # Another worker got there first
+            raise
+        return claimed
+
+    def _insert(self, events):
+        table = AuditEvent.__table__
+        engine = db.get_engine(self.app)
+        per_statement = len(events)
+        if engine.dialect.name == 'sqlite':
+            per_statement = SQLITE_MAX_VARIABLES // len(table.columns)
+        with engine.begin() as conn:
+            for rows in chunked(events, per_statement):
+                conn.execute(table.insert().values(rows))
+
+    def _insert_missing(self, events):
+        event_id = AuditEvent.__table__.c.event_id
+        engine = db.get_engine(self.app)
+        missing = []
+        for batch in chunked(events, RECOVERY_BATCH_SIZE):
+            found = set(row[0] for row in engine.execute(
+                select([event_id]).where(
+                    event_id.in_([event['event_id'] for event in batch]))))
+            missing.extend(event for event in batch
+                           if event['event_id'] not in found)
+        if missing:
+            self._insert(missing)
+        return len(missing)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self.recover()
+        except Exception:
+            self.app.logger.exception('Could not recover audit spool files')
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def shutdown(self):
+        '''Stop the flushing thread and write what is left. Called when the
+        process exits.
+        '''
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            self._stopping.set()
+            self._wake.set()
+            thread.join(SHUTDOWN_TIMEOUT)
+        self._thread = None
+        if self.app is not None:
+            self.flush()
+
+
+def _dumps(event):
+    event = dict(event)
+    event['created_at'] = event['created_at'].strftime(_DATETIME_FORMAT)
+    return json.dumps(event, sort_keys=True)
+
+
+def _loads(line):
+    try:
+        event = json.loads(line)
+        event['created_at'] = dt.datetime.strptime(event['created_at'],
+                                                   _DATETIME_FORMAT)
+    except (ValueError, KeyError, TypeError):
+        return None  # Cut short by the crash
+    return event
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+audit_log = AuditLog()
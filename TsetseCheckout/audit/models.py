@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+
+from TsetseCheckout.database import Column, db, Model, SurrogatePK
+
+
+class AuditEvent(SurrogatePK, Model):
+    '''Something a user did, as recorded by
+    :data:`TsetseCheckout.audit.log.audit_log`. Rows are only ever added.
+    '''
+    __tablename__ = 'audit_events'
+
+    LOGIN = 'login'
+    LOGIN_FAILED = 'login_failed'
+    LOGIN_THROTTLED = 'login_throttled'
+    CHECKOUT = 'checkout'
+    RETURN = 'return'
+
+    #: Unique per event, so replaying a spool file can't record one twice
+    event_id = Column(db.String(32), unique=True, nullable=False)
+    action = Column(db.String(20), nullable=False)
+    #: Not foreign keys: the trail outlives the users and samples it names
+    user_id = Column(db.Integer, nullable=True)
+    sample_id = Column(db.Integer, nullable=True)
+    #: As typed, including names nobody has registered
+    username = Column(db.String(80), nullable=True)
+    remote_addr = Column(db.String(45), nullable=True)
+    detail = Column(db.String(255), nullable=True)
+    #: When it happened, not when it was written
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    @classmethod
+    def search(cls, user_id=None, sample_id=None, username=None, action=None,
+               start=None, end=None):
+        '''Events matching every filter given, newest first.
+
+        :param start: Earliest ``created_at`` included.
+        :param end: ``created_at`` before which events are included.
+        '''
+        query = cls.query
+        for column, value in ((cls.user_id, user_id),
+                              (cls.sample_id, sample_id),
+                              (cls.username, username),
+                              (cls.action, action)):
+            if value is not None:
+                query = query.filter(column == value)
+        if start is not None:
+            query = query.filter(cls.created_at >= start)
+        if end is not None:
+            query = query.filter(cls.created_at < end)
+        return query.order_by(cls.created_at.desc(), cls.id.desc())
+
+    def __repr__(self):
+        return '<AuditEvent({action!r}, {created_at})>'.format(
+            action=self.action, created_at=self.created_at)
+
+
+db.Index('ix_audit_events_created_at', AuditEvent.created_at)
+db.Index('ix_audit_events_user_id_created_at',
+         AuditEvent.user_id, AuditEvent.created_at)
+db.Index('ix_audit_events_sample_id_created_at',
+         AuditEvent.sample_id, AuditEvent.created_at)
+db.Index('ix_audit_events_username_created_at',
+         AuditEvent.username, AuditEvent.created_at)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+'''Cache backends for the ``cache`` extension.
+
+``simple`` keeps a private dictionary per worker, which divides the hit rate
+by the number of workers and makes invalidation per-process. The ``sqlite``
+backend here keeps entries in one SQLite file in WAL mode that every worker
+on the host opens, so a value cached or deleted by one worker is seen by all
+of them immediately, without running a cache server.
+
+Select it with ::
+
+    CACHE_TYPE = 'TsetseCheckout.cache_backends.sqlite'
+    CACHE_DIR = '/var/cache/tsetsecheckout'
+    CACHE_THRESHOLD = 10000
+'''
+import os
+import sqlite3
+import threading
+import time
+
+from werkzeug.contrib.cache import BaseCache
+
+from TsetseCheckout.shared_sqlite import SharedSQLite, private_directory
+
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+#: Seconds between writes of an entry's last access time, so hot keys don't
+#: turn every read into a write.
+TOUCH_INTERVAL = 1.0
+
+#: Sets per process between checks of the entry count against the
+#: threshold; the cache may briefly overshoot by this much per worker.
+PRUNE_EVERY = 32
+
+#: Entries are evicted down to this fraction of the threshold when it is
+#: exceeded, so pruning doesn't happen on every set.
+PRUNE_TO = 0.9
+
+#: How often buffered hit/miss counts are written to the shared file.
+STATS_FLUSH_INTERVAL = 5.0
+
+STAT_NAMES = ('hits', 'misses', 'sets', 'deletes', 'evictions', 'expirations')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache ('
+    '  key TEXT PRIMARY KEY, value BLOB NOT NULL,'
+    '  expires REAL, accessed REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_cache_accessed ON cache (accessed)',
+    'CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)',
+    'CREATE TABLE IF NOT EXISTS stats ('
+    '  name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+)
+
+
+class SQLiteCache(BaseCache):
+    '''A cache shared by every process on the host through a SQLite file.
+
+    Entries expire after their timeout (``0`` means never) and the least
+    recently used are evicted once there are more than ``threshold``.
+    Hit, miss, set, delete, eviction and expiration counts are summed across
+    processes; see :meth:`stats`.
+
+    :param path: The database file. Created if it doesn't exist.
+    :param busy_timeout: Seconds to wait for another process's write.
+    '''
+
+    def __init__(self, path, threshold=500, default_timeout=300,
+                 key_prefix=None, busy_timeout=5):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self.key_prefix = key_prefix or ''
+        self._file = SharedSQLite(path, busy_timeout)
+        self._lock = threading.Lock()
+        self._reset_counters()
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.executemany(
+                'INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)',
+                [(name,) for name in STAT_NAMES])
+
+    def _reset_counters(self):
+        self._pid = os.getpid()
+        self._counts = dict((name, 0) for name in STAT_NAMES)
+        self._flushed_at = time.time()
+        self._sets = 0
+
+    def _check_pid(self):
+        # A forked process counts from zero; its parent flushes its own.
+        pid = os.getpid()
+        if pid != self._pid:
+            with self._lock:
+                if pid != self._pid:
+                    self._reset_counters()
+
+    def _connection(self):
+        self._check_pid()
+        return self._file.connection()
+
+    def _transaction(self):
+        self._check_pid()
+        return self._file.transaction()
+
+    def _key(self, key):
+        return self.key_prefix + key
+
+    def _expires(self, timeout, now):
+        if timeout is None:
+            timeout = self.default_timeout
+        return now + timeout if timeout > 0 else None
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+        if time.time() - self._flushed_at >= STATS_FLUSH_INTERVAL:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        with self._lock:
+            counts = [(value, name) for name, value in self._counts.items()
+                      if value]
+            self._counts = dict((name, 0) for name in STAT_NAMES)
+            self._flushed_at = time.time()
+        if counts:
+            with self._transaction() as conn:
+                conn.executemany(
+                    'UPDATE stats SET value = value + ? WHERE name = ?',
+                    counts)
+
+    def get(self, key):
+        key, now = self._key(key), time.time()
+        conn = self._connection()
+        row = conn.execute('SELECT value, expires, accessed FROM cache '
+                           'WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            self._count('misses')
+            return None
+        if row[2] < now - TOUCH_INTERVAL:
+            conn.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                         (now, key))
+        self._count('hits')
+        return pickle.loads(bytes(row[0]))
+
+    def has(self, key):
+        row = self._connection().execute(
+            'SELECT expires FROM cache WHERE key = ?',
+            (self._key(key),)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def set(self, key, value, timeout=None):
+        return self._store('INSERT OR REPLACE', key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        now = time.time()
+        with self._transaction() as conn:
+            # An expired entry doesn't stop an add.
+            conn.execute('DELETE FROM cache WHERE key = ? AND expires <= ?',
+                         (self._key(key), now))
+            added = conn.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)', self._row(key, value, timeout, now)
+            ).rowcount == 1
+        if added:
+            self._after_set()
+        return added
+
+    def _store(self, verb, key, value, timeout):
+        now = time.time()
+        self._connection().execute(
+            verb + ' INTO cache (key, value, expires, accessed) '
+            'VALUES (?, ?, ?, ?)', self._row(key, value, timeout, now))
+        self._after_set()
+        return True
+
+    def _row(self, key, value, timeout, now):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return (self._key(key), sqlite3.Binary(value),
+                self._expires(timeout, now), now)
+
+    def set_many(self, mapping, timeout=None):
+        now = time.time()
+        items = mapping.items() if hasattr(mapping, 'items') else mapping
+        rows = [self._row(key, value, timeout, now) for key, value in items]
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO cache '
+                             '(key, value, expires, accessed) '
+                             'VALUES (?, ?, ?, ?)', rows)
+        self._after_set(len(rows))
+        return True
+
+    def delete(self, key):
+        deleted = self._connection().execute(
+            'DELETE FROM cache WHERE key = ?', (self._key(key),)).rowcount
+        self._count('deletes', deleted)
+        return deleted == 1
+
+    def delete_many(self, *keys):
+        with self._transaction() as conn:
+            deleted = conn.executemany(
+                'DELETE FROM cache WHERE key = ?',
+                [(self._key(key),) for key in keys]).rowcount
+        self._count('deletes', max(deleted, 0))
+        return True
+
+    def clear(self):
+        '''Delete this cache's entries, leaving those of other prefixes.'''
+        # Not LIKE: it is case-insensitive and treats _ in the prefix as a
+        # wildcard.
+        self._connection().execute(
+            'DELETE FROM cache WHERE substr(key, 1, ?) = ?',
+            (len(self.key_prefix), self.key_prefix))
+        return True
+
+    def inc(self, key, delta=1):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value, expires FROM cache '
+                               'WHERE key = ?', (self._key(key),)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                value, expires = 0, self._expires(None, now)
+            else:
+                value, expires = pickle.loads(bytes(row[0])), row[1]
+            value = (value or 0) + delta
+            conn.execute('INSERT OR REPLACE INTO cache '
+                         '(key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                         (self._key(key), sqlite3.Binary(
+                             pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                          expires, now))
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def _after_set(self, n=1):
+        self._count('sets', n)
+        with self._lock:
+            self._sets += n
+            due = self._sets >= PRUNE_EVERY
+            if due:
+                self._sets = 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        '''Drop expired entries, then the least recently used ones if there
+        are still more than ``threshold``.
+        '''
+        with self._transaction() as conn:
+            expired = conn.execute(
+                'DELETE FROM cache WHERE expires <= ?',
+                (time.time(),)).rowcount
+            count = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            evicted = 0
+            if count > self.threshold:
+                evicted = conn.execute(
+                    'DELETE FROM cache WHERE key IN ('
+                    '  SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                    (count - int(self.threshold * PRUNE_TO),)).rowcount
+        self._count('expirations', expired)
+        self._count('evictions', evicted)
+
+    def stats(self):
+        '''Counts summed over every process using the file, plus the
+        current number of entries.
+        '''
+        self._flush_stats()
+        conn = self._connection()
+        stats = dict(conn.execute('SELECT name, value FROM stats'))
+        stats['entries'] = conn.execute(
+            'SELECT COUNT(*) FROM cache').fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = (float(stats['hits']) / lookups
+                              if lookups else 0.0)
+        return stats
+
+
+def sqlite(app, config, args, kwargs):
+    '''Flask-Cache factory for :class:`SQLiteCache`, storing its file in
+    ``CACHE_DIR``, which must be private to this user (see
+    :func:`private_directory`).
+    '''
+    cache_dir = private_directory(config['CACHE_DIR'])
+    args.insert(0, os.path.join(cache_dir, 'cache.sqlite'))
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD'],
+                       key_prefix=config['CACHE_KEY_PREFIX']))
+    return SQLiteCache(*args, **kwargs)
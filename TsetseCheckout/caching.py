@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+'''Whole-page and template-fragment caching on top of the ``cache``
+extension.
+
+Cached output varies on who is looking: anonymous visitors share one copy,
+signed-in users each get their own, and the key includes their roles. Pages
+are never cached or served from cache while flashed messages are waiting.
+CSRF tokens are swapped for a placeholder before anything is stored and a
+fresh token for the current session is put back on the way out, so no
+visitor is ever served someone else's token.
+
+Every key includes the release (``RELEASE``, or a fingerprint of the
+templates and static files) and a generation that :meth:`PageCache.
+invalidate` replaces, so a deploy or a write to a model the pages show makes
+old entries unreachable. Set ``PAGE_CACHE_ENABLED = False`` to bypass it.
+'''
+import hashlib
+import os
+import re
+import uuid
+from functools import wraps
+
+from flask import _request_ctx_stack, current_app, request, session
+from flask.ext.login import current_user
+from flask.ext.wtf.csrf import generate_csrf
+from jinja2 import Markup, nodes
+from jinja2.ext import Extension
+
+from TsetseCheckout.compat import text_type
+from TsetseCheckout.extensions import cache
+
+CSRF_PLACEHOLDER = '__csrf_token_placeholder__'
+
+GENERATION_KEY = 'page_cache:generation'
+
+#: Seconds the current generation is kept; losing it only empties the cache.
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+_CSRF_VALUE = re.compile(
+    r'(<input[^>]*\bname="csrf_token"[^>]*\bvalue=")([^"]*)(")')
+
+
+class PageCache(object):
+    '''Caches rendered views (:meth:`cached`) and template fragments (the
+    ``{% cachefragment %}`` tag) in the app's ``cache``.
+    '''
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.timeout = None
+        self.version = ''
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PAGE_CACHE_ENABLED', True)
+        self.timeout = app.config.get('PAGE_CACHE_TIMEOUT', 300)
+        self.version = app.config.get('RELEASE') or _fingerprint(app)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.extensions['page_cache'] = self
+
+    def cached(self, timeout=None):
+        '''Decorate a view to serve its GET responses from the cache.'''
+        def decorator(view):
+            @wraps(view)
+            def decorated_view(*args, **kwargs):
+                if not self._can_cache_request():
+                    return view(*args, **kwargs)
+                key = self._key('page', self.vary(), request.path)
+                entry = cache.get(key)
+                if entry is not None:
+                    body, content_type = entry
+                    response = current_app.response_class(
+                        _insert_csrf(body), content_type=content_type)
+                    response.headers['X-Page-Cache'] = 'hit'
+                    return response
+                response = current_app.make_response(view(*args, **kwargs))
+                if (response.status_code == 200 and
+                        not response.direct_passthrough and
+                        not _flashes_shown()):
+                    body = _strip_csrf(response.get_data(as_text=True))
+                    cache.set(key, (body, response.content_type),
+                              timeout=timeout or self.timeout)
+                    response.headers['X-Page-Cache'] = 'miss'
+                return response
+            return decorated_view
+        return decorator
+
+    def fragment(self, name, parts, render):
+        '''Return the cached output of ``render()`` for the fragment
+        ``name`` varied on ``parts``, rendering and storing it on a miss.
+        '''
+        # POSTed forms echo the submitted values back; never share those.
+        if (not self.enabled or _request_ctx_stack.top is None or
+                request.method != 'GET'):
+            return render()
+        key = self._key('fragment', name, *parts)
+        body = cache.get(key)
+        if body is None:
+            body = _strip_csrf(render())
+            cache.set(key, body, timeout=self.timeout)
+        return Markup(_insert_csrf(body))
+
+    def invalidate(self):
+        '''Make every cached page and fragment stale, in all workers that
+        share the cache.
+        '''
+        # The next request picks a new random generation, so old keys are
+        # never reused even if the cache forgets the generation.
+        cache.delete(GENERATION_KEY)
+        if _request_ctx_stack.top is not None:
+            _request_ctx_stack.top.page_cache_generation = None
+
+    def _can_cache_request(self):
+        return (self.enabled and request.method in ('GET', 'HEAD') and
+                not request.query_string and '_flashes' not in session)
+
+    def generation(self):
+        '''The current generation; changes whenever :meth:`invalidate` is
+        called. Looked up once per request.
+        '''
+        ctx = _request_ctx_stack.top
+        generation = getattr(ctx, 'page_cache_generation', None)
+        if generation is None:
+            cache.add(GENERATION_KEY, uuid.uuid4().hex,
+                      timeout=GENERATION_TIMEOUT)
+            generation = ctx.page_cache_generation = cache.get(GENERATION_KEY)
+        return generation
+
+    def vary(self):
+        '''Who the response is for: ``anonymous``, or the user and roles.'''
+        if not current_user.is_authenticated():
+            return 'anonymous'
+        role_names = getattr(current_user, 'role_names', None)
+        if role_names is None:
+            role_names = [role.name for role in current_user.roles]
+        return 'user:{0}:{1}:{2}'.format(
+            current_user.get_id(), int(bool(current_user.is_admin)),
+            ','.join(sorted(role_names)))
+
+    def _key(self, *parts):
+        parts = (self.version, self.generation()) + parts
+        digest = hashlib.sha1('\0'.join(
+            '{0}'.format(part) for part in parts).encode('utf-8'))
+        return 'page_cache:{0}'.format(digest.hexdigest())
+
+
+class FragmentCacheExtension(Extension):
+    '''Adds ``{% cachefragment "name", key, ... %}...{% endcachefragment
+    %}`` to templates. Any expressions after the name are added to the key.
+    '''
+    tags = set(['cachefragment'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcachefragment'],
+                                       drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(args)]),
+            [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        return page_cache.fragment(args[0], args[1:], caller)
+
+
+def _flashes_shown():
+    # get_flashed_messages() moves them off the session onto the request.
+    return bool(getattr(_request_ctx_stack.top, 'flashes', None))
+
+
+def _strip_csrf(body):
+    # As plain text: re.sub would escape a Markup's pieces as it joins them.
+    return _CSRF_VALUE.sub(r'\g<1>' + CSRF_PLACEHOLDER + r'\3',
+                           text_type(body))
+
+
+def _insert_csrf(body):
+    if CSRF_PLACEHOLDER in body:
+        body = body.replace(CSRF_PLACEHOLDER, generate_csrf())
+    return body
+
+
+def _fingerprint(app):
+    '''Identify the deployed templates and asset sources by their names,
+    sizes and modification times. Bundles that Flask-Assets builds into
+    ``static/public`` are left out, since workers build them at different
+    times.
+    '''
+    digest = hashlib.sha1()
+    for folder in (app.template_folder, app.static_folder):
+        root = os.path.join(app.root_path, folder)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(
+                d for d in dirnames if not d.startswith('.') and
+                os.path.join(dirpath, d) != os.path.join(root, 'public'))
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                digest.update('{0}:{1}:{2}\n'.format(
+                    os.path.relpath(path, root), stat.st_size,
+                    int(stat.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+page_cache = PageCache()
@@ -7,12 +7,20 @@ import sys
 PY2 = int(sys.version[0]) == 2
 
 if PY2:
+    import Queue as queue
+    import cookielib as http_cookiejar
+    import urllib2 as urllib_request
+    from urllib import urlencode
     text_type = unicode
     binary_type = str
     string_types = (str, unicode)
     unicode = unicode
     basestring = basestring
 else:
+    import queue
+    import http.cookiejar as http_cookiejar
+    import urllib.request as urllib_request
+    from urllib.parse import urlencode
     text_type = str
     binary_type = bytes
     string_types = (str,)
@@ -2,14 +2,33 @@
 """Database module, including the SQLAlchemy database object and DB-related
 utilities.
 """
-from sqlalchemy.orm import relationship
+import base64
+import datetime as dt
+import io
+import itertools
+import json
+import numbers
+from collections import OrderedDict
 
-from .extensions import db
-from .compat import basestring
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import class_mapper, relationship
+from sqlalchemy.sql.expression import Insert
+
+from .extensions import cache, db
+from .compat import PY2, basestring, text_type
+from .routing import use_replica
 
 # Alias common SQLAlchemy names
 Column = db.Column
 relationship = relationship
+use_replica = use_replica
+
+#: SQLite refuses statements with more bound parameters than this.
+SQLITE_MAX_VARIABLES = 999
+
+#: Below this many estimated rows an exact count is cheap enough.
+EXACT_COUNT_THRESHOLD = 10000
 
 class CRUDMixin(object):
     """Mixin that adds convenience methods for CRUD (create, read, update, delete)
@@ -26,6 +45,8 @@ class CRUDMixin(object):
         """Update specific fields of a record."""
         for attr, value in kwargs.iteritems():
             setattr(self, attr, value)
+        if not commit:
+            self.on_write()
         return commit and self.save() or self
 
     def save(self, commit=True):
@@ -33,12 +54,463 @@ class CRUDMixin(object):
         db.session.add(self)
         if commit:
             db.session.commit()
+        self.on_write()
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
         db.session.delete(self)
-        return commit and db.session.commit()
+        result = commit and db.session.commit()
+        self.on_write()
+        return result
+
+    def on_write(self):
+        """Called after the record is saved, updated or deleted. Override to
+        invalidate anything cached from it.
+        """
+        pass
+
+    @classmethod
+    def on_bulk_write(cls):
+        """Called after any of the ``bulk_*`` methods change rows of this
+        model. Override to invalidate anything cached from them.
+        """
+        pass
+
+    @classmethod
+    def bulk_create(cls, rows, batch_size=1000, return_ids=True, commit=True):
+        """Insert records from an iterable of dicts without building model
+        instances.
+
+        ``rows`` is consumed ``batch_size`` at a time, so it can be a
+        generator over any number of records. Each batch is a multi-row
+        ``INSERT`` (``RETURNING`` the new ids on PostgreSQL), or a ``COPY`` on
+        PostgreSQL when ``return_ids`` is false. Python-side column defaults
+        are applied as they would be by the ORM.
+
+        :returns: The new primary keys in input order, or the number of rows
+            inserted if ``return_ids`` is false.
+        """
+        table = cls.__table__
+        ids, count = [], 0
+        for chunk in chunked(rows, batch_size):
+            keys, chunk = _normalize_rows(table, chunk)
+            if not return_ids and _dialect_name() == 'postgresql':
+                _copy_rows(table, keys, chunk)
+            else:
+                ids.extend(_insert_rows(table, keys, chunk))
+            count += len(chunk)
+        if commit:
+            db.session.commit()
+        cls.on_bulk_write()
+        return ids if return_ids else count
+
+    @classmethod
+    def bulk_update(cls, rows, batch_size=1000, commit=True):
+        """Update records from an iterable of dicts, each of which includes
+        the primary key and the columns to change. Rows in a batch that change
+        the same columns share one ``executemany`` ``UPDATE``.
+
+        :returns: The number of rows updated.
+        """
+        count = 0
+        for chunk in chunked(rows, batch_size):
+            count += _update_rows(cls.__table__, chunk)
+        if commit:
+            db.session.commit()
+        cls.on_bulk_write()
+        return count
+
+    @classmethod
+    def bulk_upsert(cls, rows, index_elements=None, batch_size=1000,
+                    commit=True):
+        """Insert records from an iterable of dicts, updating the existing
+        record instead wherever one matches on ``index_elements`` (the primary
+        key by default; otherwise columns with a unique constraint).
+
+        PostgreSQL does each batch in one ``INSERT ... ON CONFLICT DO
+        UPDATE``. Other databases look up which rows exist with one query per
+        batch and then insert and update as :meth:`bulk_create` and
+        :meth:`bulk_update` would. Within a batch the last row for a key wins.
+
+        :returns: The primary key of each input row, in input order.
+        """
+        table = cls.__table__
+        pk = _primary_key(table)
+        index_elements = tuple(index_elements or (pk.key,))
+        postgresql = _dialect_name() == 'postgresql'
+        ids = []
+        for chunk in chunked(rows, batch_size):
+            # Defaults fill in new rows but never overwrite existing ones.
+            keys, filled = _normalize_rows(table, chunk)
+            chunk_keys = [tuple(row[key] for key in index_elements)
+                          for row in chunk]
+            latest = OrderedDict(zip(chunk_keys, zip(chunk, filled)))
+            if postgresql:
+                update_keys = sorted(
+                    key for key in set(itertools.chain.from_iterable(chunk))
+                    if key not in index_elements and key != pk.key)
+                key_to_id = _upsert_rows(
+                    table, [row for _, row in latest.values()],
+                    index_elements, update_keys)
+            else:
+                key_to_id = _lookup_ids(table, index_elements, latest)
+                updates = [dict(row, **{pk.key: key_to_id[key]})
+                           for key, (row, _) in latest.items()
+                           if key in key_to_id]
+                inserts = [(key, row) for key, (_, row) in latest.items()
+                           if key not in key_to_id]
+                _update_rows(table, updates)
+                new_ids = _insert_rows(table, keys,
+                                       [row for _, row in inserts])
+                key_to_id.update(zip([key for key, _ in inserts], new_ids))
+            ids.extend(key_to_id[key] for key in chunk_keys)
+        if commit:
+            db.session.commit()
+        cls.on_bulk_write()
+        return ids
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _dialect_name():
+    return db.engine.dialect.name
+
+
+def _primary_key(table):
+    return list(table.primary_key.columns)[0]
+
+
+def _normalize_rows(table, rows):
+    """Give every row in a batch the same keys, filling in Python-side column
+    defaults and ``None`` for anything else that is missing.
+    """
+    defaults = dict(
+        (column.key, column.default) for column in table.columns
+        if column.default is not None and
+        (column.default.is_scalar or column.default.is_callable)
+    )
+    keys = set(defaults)
+    for row in rows:
+        keys.update(row)
+    keys = sorted(keys)
+    normalized = []
+    for row in rows:
+        row = dict(row)
+        for key in keys:
+            if key not in row:
+                default = defaults.get(key)
+                if default is None:
+                    row[key] = None
+                elif default.is_callable:
+                    row[key] = default.arg(None)
+                else:
+                    row[key] = default.arg
+        normalized.append(row)
+    return keys, normalized
+
+
+def _insert_rows(table, keys, rows):
+    """Insert ``rows`` with multi-row ``INSERT`` statements and return their
+    primary keys in order. Rows may carry their own primary key; the others
+    get one from the database.
+    """
+    pk = _primary_key(table)
+    ids = [row.get(pk.key) for row in rows]
+    explicit = [row for row in rows if row.get(pk.key) is not None]
+    generated = [n for n, row in enumerate(rows) if row.get(pk.key) is None]
+    for statement_rows in _insert_statements(keys, explicit):
+        db.session.execute(table.insert().values(statement_rows))
+    keys = [key for key in keys if key != pk.key]
+    new_rows = [dict((key, rows[n][key]) for key in keys) for n in generated]
+    new_ids = []
+    if not new_rows:
+        pass
+    elif _dialect_name() == 'postgresql':
+        result = db.session.execute(
+            table.insert().values(new_rows).returning(pk))
+        new_ids = [row[0] for row in result]
+    else:
+        for statement_rows in _insert_statements(keys, new_rows):
+            result = db.session.execute(table.insert().values(statement_rows))
+            # SQLite hands out consecutive rowids within one INSERT that
+            # names none itself, and only reports the last of them.
+            last = result.lastrowid
+            new_ids.extend(range(last - len(statement_rows) + 1, last + 1))
+    for n, new_id in zip(generated, new_ids):
+        ids[n] = new_id
+    return ids
+
+
+def _insert_statements(keys, rows):
+    """Split ``rows`` into the rows of each ``INSERT``: one on PostgreSQL,
+    as many as SQLite's parameter limit allows otherwise.
+    """
+    if not rows:
+        return []
+    if _dialect_name() == 'postgresql':
+        return [rows]
+    return chunked(rows, max(1, SQLITE_MAX_VARIABLES // max(len(keys), 1)))
+
+
+def _copy_rows(table, keys, rows):
+    """Stream ``rows`` into PostgreSQL with ``COPY ... FROM STDIN``.
+
+    Every value is quoted and ``NULL`` is written as an unquoted ``\\N``, so
+    empty strings stay empty strings (and a string ``"\\N"`` stays one).
+    """
+    buf = io.BytesIO() if PY2 else io.StringIO()
+    for row in rows:
+        line = _copy_line([row[key] for key in keys])
+        buf.write(line.encode('utf-8') if PY2 else line)
+    buf.seek(0)
+    preparer = db.engine.dialect.identifier_preparer
+    sql = "COPY {0} ({1}) FROM STDIN WITH CSV NULL '\\N'".format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(table.c[key].name) for key in keys))
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+def _copy_line(values):
+    return u','.join(
+        u'\\N' if value is None
+        else u'"{0}"'.format(text_type(value).replace(u'"', u'""'))
+        for value in values) + u'\n'
+
+
+def _update_rows(table, rows):
+    pk = _primary_key(table)
+    groups = OrderedDict()
+    for row in rows:
+        row = dict(row)
+        row['_pk'] = row.pop(pk.key)
+        if len(row) == 1:
+            continue  # Nothing to set
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    count = 0
+    statement = table.update().where(pk == bindparam('_pk'))
+    for group in groups.values():
+        count += db.session.execute(statement, group).rowcount
+    return count
+
+
+def _lookup_ids(table, index_elements, rows_by_key):
+    """Map each key in ``rows_by_key`` that already exists to its primary
+    key, in as few queries as SQLite's parameter limit allows.
+    """
+    pk = _primary_key(table)
+    columns = [table.c[key] for key in index_elements]
+    ids = {}
+    for keys in chunked(rows_by_key, SQLITE_MAX_VARIABLES // len(columns)):
+        if len(columns) == 1:
+            condition = columns[0].in_([key[0] for key in keys])
+        else:
+            condition = db.or_(*[
+                db.and_(*[column == value
+                          for column, value in zip(columns, key)])
+                for key in keys
+            ])
+        query = db.select([pk] + columns).where(condition)
+        ids.update((tuple(row)[1:], row[0])
+                   for row in db.session.execute(query))
+    return ids
+
+
+class _Upsert(Insert):
+    """``INSERT ... ON CONFLICT (...) DO UPDATE ... RETURNING`` for
+    PostgreSQL 9.5 and later.
+    """
+
+    def __init__(self, table, index_elements, update_keys):
+        Insert.__init__(self, table)
+        self.index_elements = index_elements
+        self.update_keys = update_keys
+
+
+@compiles(_Upsert)
+def _compile_upsert(insert, compiler, **kw):
+    quote = compiler.preparer.quote
+    table = insert.table
+    names = [quote(table.c[key].name) for key in insert.index_elements]
+    sql = compiler.visit_insert(insert, **kw)
+    sql += ' ON CONFLICT ({0})'.format(', '.join(names))
+    if insert.update_keys:
+        sql += ' DO UPDATE SET ' + ', '.join(
+            '{0} = excluded.{0}'.format(quote(table.c[key].name))
+            for key in insert.update_keys)
+    else:
+        # DO NOTHING would not return the existing row's id.
+        sql += ' DO UPDATE SET {0} = excluded.{0}'.format(names[0])
+    returning = [_primary_key(table)] + [table.c[key]
+                                        for key in insert.index_elements]
+    return sql + ' RETURNING ' + ', '.join(
+        quote(column.name) for column in returning)
+
+
+def _upsert_rows(table, rows, index_elements, update_keys):
+    statement = _Upsert(table, index_elements, update_keys).values(rows)
+    return dict((tuple(row)[1:], row[0])
+                for row in db.session.execute(statement))
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+class KeysetPage(object):
+    """One page of rows from :func:`keyset_paginate`.
+
+    ``next_cursor`` and ``prev_cursor`` are opaque strings to pass back as
+    ``after`` and ``before``; each is ``None`` when there is no such page.
+    """
+
+    def __init__(self, rows, next_cursor=None, prev_cursor=None):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def keyset_paginate(select, order_by, per_page=50, after=None, before=None,
+                    descending=False):
+    """Fetch one page of ``select`` by seeking past the last row seen
+    rather than with ``OFFSET``, so every page costs the same given an index
+    on the ``order_by`` columns.
+
+    :param order_by: Columns to sort on, which together must be unique;
+        end with the primary key. Any not in ``select`` are added to it.
+    :param after: Cursor of the page before the wanted one.
+    :param before: Cursor of the page after the wanted one.
+    :raises InvalidCursor: If a cursor is malformed.
+    """
+    cursor = after or before
+    # Walk backwards from ``before``, then put the rows back in order.
+    backwards = bool(before) and not after
+    ascending = descending == backwards
+    for column in order_by:
+        if column not in select.inner_columns:
+            select = select.column(column)
+    if cursor:
+        values = _decode_cursor(cursor, order_by)
+        select = select.where(_seek(order_by, values, ascending))
+    select = select.order_by(*[column.asc() if ascending else column.desc()
+                               for column in order_by])
+    rows = db.session.execute(select.limit(per_page + 1)).fetchall()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    has_next = more if not backwards else True
+    has_prev = more if backwards else bool(cursor)
+    return KeysetPage(
+        rows,
+        next_cursor=_encode_cursor(rows[-1], order_by)
+        if rows and has_next else None,
+        prev_cursor=_encode_cursor(rows[0], order_by)
+        if rows and has_prev else None,
+    )
+
+
+def _seek(columns, values, ascending):
+    # (a, b) > (x, y) spelled out, since not every database compares rows.
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        past = column > values[i] if ascending else column < values[i]
+        clauses.append(db.and_(*(equal + [past])))
+    return db.or_(*clauses)
+
+
+def _encode_cursor(row, columns):
+    values = []
+    for column in columns:
+        value = row[column]
+        if isinstance(value, (dt.date, dt.datetime)):
+            value = value.isoformat()
+        values.append(value)
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, columns):
+    try:
+        cursor = str(cursor)
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('wrong number of values')
+        return [_parse_cursor_value(value, column)
+                for value, column in zip(values, columns)]
+    except (TypeError, ValueError) as error:
+        raise InvalidCursor('Invalid cursor: {0}'.format(error))
+
+
+def _parse_cursor_value(value, column):
+    if isinstance(column.type, db.DateTime):
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        return dt.datetime.strptime(value, fmt)
+    if isinstance(column.type, db.Date):
+        return dt.datetime.strptime(value, '%Y-%m-%d').date()
+    if isinstance(column.type, db.Integer) and (
+            isinstance(value, bool) or
+            not isinstance(value, numbers.Integral)):
+        raise ValueError('expected an integer')
+    return value
+
+
+def approximate_count(table, whereclause=None, cache_key=None, timeout=60):
+    """Count the rows of ``table`` matching ``whereclause``, cheaply.
+
+    An unfiltered count on PostgreSQL comes from the planner's estimate
+    when the table is large; anything else is an exact ``COUNT(*)``. With a
+    ``cache_key`` the answer is kept in the app cache for ``timeout``
+    seconds, so pages don't each pay for it.
+    """
+    if cache_key is not None:
+        count = cache.get(cache_key)
+        if count is not None:
+            return count
+    count = None
+    if whereclause is None and _dialect_name() == 'postgresql':
+        estimate = db.session.execute(
+            text('SELECT reltuples::bigint FROM pg_class '
+                 'WHERE oid = CAST(:name AS regclass)'),
+            {'name': table.name}).scalar()
+        if estimate is not None and estimate >= EXACT_COUNT_THRESHOLD:
+            count = estimate
+    if count is None:
+        select = db.select([db.func.count()]).select_from(table)
+        if whereclause is not None:
+            select = select.where(whereclause)
+        count = db.session.execute(select).scalar()
+    if cache_key is not None:
+        cache.set(cache_key, count, timeout=timeout)
+    return count
+
 
 class Model(CRUDMixin, db.Model):
     """Base model class that includes CRUD convenience methods."""
@@ -56,13 +528,54 @@ class SurrogatePK(object):
 
     @classmethod
     def get_by_id(cls, id):
-        if any(
-            (isinstance(id, basestring) and id.isdigit(),
-             isinstance(id, (int, float))),
-        ):
-            return cls.query.get(int(id))
+        id = _as_id(id)
+        if id is not None:
+            return cls.query.get(id)
         return None
 
+    @classmethod
+    def get_many(cls, ids, chunk_size=500):
+        """Fetch the records for many ids without a query per id.
+
+        Ids are validated as in :meth:`get_by_id`. Records the session has
+        already loaded are reused as they are; the rest are fetched with
+        ``IN`` queries of at most ``chunk_size`` ids.
+
+        :returns: A ``(records, missing)`` tuple: the records found, in the
+            order their ids were requested, and the requested ids that
+            matched nothing (or were not valid ids).
+        """
+        requested = [(id, _as_id(id)) for id in ids]
+        mapper = class_mapper(cls)
+        identity_map = db.session.identity_map
+        found, to_fetch = {}, set()
+        for _, key in requested:
+            if key is None or key in found or key in to_fetch:
+                continue
+            instance = identity_map.get(
+                mapper.identity_key_from_primary_key([key]))
+            # Expired instances would each refresh with their own query.
+            if instance is not None and not inspect(instance).expired:
+                found[key] = instance
+            else:
+                to_fetch.add(key)
+        for chunk in chunked(sorted(to_fetch), chunk_size):
+            for instance in cls.query.filter(cls.id.in_(chunk)):
+                found[instance.id] = instance
+        records = [found[key] for _, key in requested if key in found]
+        missing = [id for id, key in requested if key not in found]
+        return records, missing
+
+
+def _as_id(value):
+    """Return ``value`` as an integer id, or ``None`` if it isn't one."""
+    if any(
+        (isinstance(value, basestring) and value.isdigit(),
+         isinstance(value, (int, float))),
+    ):
+        return int(value)
+    return None
+
 
 def ReferenceCol(tablename, nullable=False, pk_name='id', **kwargs):
     """Column that adds primary key foreign key reference.
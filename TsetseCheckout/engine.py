@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Connection pool configuration for the ``db`` extension.
+
+Every database except in-memory SQLite gets a :class:`InstrumentedQueuePool`
+sized by ``DB_POOL_SIZE`` and ``DB_MAX_OVERFLOW``. Connections are also
+handled as follows:
+
+* Each connection is pinged when the engine checks it out, and the pool
+  reconnects if the server has gone away (``DB_POOL_PRE_PING``).
+* Connections are recycled after ``DB_POOL_RECYCLE`` seconds.
+* A connection created in another process is thrown away instead of being
+  used, so workers forked from a preloaded app never share sockets.
+* Statements run while handling a request are cancelled after
+  ``DB_STATEMENT_TIMEOUT`` seconds; commands and jobs are not limited.
+  PostgreSQL enforces this with ``statement_timeout``, set when a request
+  checks the connection out; SQLite enforces it with a progress handler.
+
+:meth:`SQLAlchemy.pool_stats` reports the wait for connections and how many
+are in use. Reads may go to replicas; see :mod:`TsetseCheckout.routing`.
+"""
+import os
+import threading
+import time
+import weakref
+from functools import partial
+
+from flask import has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event, exc, orm, select
+from sqlalchemy.pool import QueuePool
+
+from TsetseCheckout.routing import ReplicaSet, RoutingSession
+
+#: SQLite virtual machine instructions between checks of the statement
+#: deadline.
+SQLITE_PROGRESS_INTERVAL = 1000
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A :class:`~sqlalchemy.pool.QueuePool` that keeps track of how long
+    callers wait for connections and how often they give up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        timed_out = False
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+    def stats(self):
+        """Counts for this process since the pool was created."""
+        with self._stats_lock:
+            checkouts, wait_time = self.checkouts, self.wait_time
+            stats = dict(checkouts=checkouts, timeouts=self.timeouts,
+                         wait_time=wait_time,
+                         max_wait_time=self.max_wait_time)
+        stats.update(
+            size=self.size(), in_use=self.checkedout(),
+            idle=self.checkedin(), overflow=max(self.overflow(), 0),
+            max_overflow=self._max_overflow,
+            mean_wait_time=wait_time / checkouts if checkouts else 0.0)
+        return stats
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Flask-SQLAlchemy with the pool behaviour described in this module."""
+
+    def __init__(self, *args, **kwargs):
+        BaseSQLAlchemy.__init__(self, *args, **kwargs)
+        self._configured_engines = weakref.WeakKeyDictionary()
+        self._configure_lock = threading.Lock()
+
+    def init_app(self, app):
+        BaseSQLAlchemy.init_app(self, app)
+        app.extensions['db_replicas'] = ReplicaSet(self, app)
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        BaseSQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if _is_memory_sqlite(info):
+            # A single shared connection; there is no pool to size.
+            return
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=app.config.get('DB_POOL_SIZE', 5),
+            max_overflow=app.config.get('DB_MAX_OVERFLOW', 10),
+            pool_timeout=app.config.get('DB_POOL_TIMEOUT', 30),
+            pool_recycle=app.config.get('DB_POOL_RECYCLE', -1),
+        )
+        if info.drivername.startswith('sqlite'):
+            # Pooled connections move between threads.
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def get_engine(self, app, bind=None):
+        engine = BaseSQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._configured_engines:
+            with self._configure_lock:
+                if engine not in self._configured_engines:
+                    _configure_engine(engine, app.config)
+                    self._configured_engines[engine] = True
+        return engine
+
+    def pool_stats(self, app=None, bind=None):
+        """Connection pool counts for this process: ``in_use``, ``idle``,
+        ``overflow``, ``checkouts``, ``timeouts`` and the total, mean and
+        maximum seconds spent waiting for a connection. Empty if the engine
+        isn't pooled.
+        """
+        pool = self.get_engine(self.get_app(app), bind).pool
+        if not isinstance(pool, InstrumentedQueuePool):
+            return {}
+        return pool.stats()
+
+
+def _is_memory_sqlite(info):
+    return (info.drivername.startswith('sqlite') and
+            info.database in (None, '', ':memory:'))
+
+
+def _configure_engine(engine, config):
+    if config.get('DB_POOL_PRE_PING', True):
+        event.listen(engine, 'engine_connect', _ping_connection)
+    if isinstance(engine.pool, QueuePool):
+        event.listen(engine.pool, 'connect', _record_pid)
+        event.listen(engine.pool, 'checkout', _check_pid)
+    timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if timeout and engine.dialect.name == 'sqlite':
+        _limit_sqlite_statements(engine, timeout)
+    elif timeout and engine.dialect.name == 'postgresql':
+        event.listen(engine.pool, 'checkout',
+                     partial(_set_statement_timeout, timeout))
+
+
+def _ping_connection(connection, branch):
+    # SQLAlchemy's recipe for pessimistic disconnect handling: a failed
+    # ping invalidates the pool, and the retry gets a fresh connection.
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as error:
+        if not error.connection_invalidated:
+            raise
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid') != os.getpid():
+        # Forget the parent's connection without closing it under them.
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to process {0}, not {1}'.format(
+                connection_record.info.get('pid'), os.getpid()))
+
+
+def _limit_sqlite_statements(engine, timeout):
+    def connect(dbapi_connection, connection_record):
+        info = connection_record.info
+
+        def progress():
+            deadline = info.get('statement_deadline')
+            return 1 if deadline is not None and time.time() > deadline else 0
+        dbapi_connection.set_progress_handler(progress,
+                                              SQLITE_PROGRESS_INTERVAL)
+
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        if has_request_context():
+            conn.connection.info['statement_deadline'] = time.time() + timeout
+
+    def after_execute(conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.connection.info['statement_deadline'] = None
+
+    event.listen(engine.pool, 'connect', connect)
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+
+
+def _set_statement_timeout(timeout, dbapi_connection, connection_record,
+                           connection_proxy):
+    # Only requests are limited; migrations, imports and jobs may take as
+    # long as they need. Connections rarely move between the two, so the
+    # setting is only sent when it has to change.
+    wanted = int(timeout * 1000) if has_request_context() else 0
+    if connection_record.info.get('statement_timeout', 0) == wanted:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET statement_timeout = {0:d}'.format(wanted))
+        cursor.close()
+        # Nothing else is in this transaction; commit so a rollback of the
+        # next one doesn't undo the setting.
+        dbapi_connection.commit()
+    except Exception as error:
+        # Most likely the server went away; the pool tries a new connection.
+        raise exc.DisconnectionError(
+            'Could not set statement_timeout: {0}'.format(error))
+    connection_record.info['statement_timeout'] = wanted
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''Streaming CSV and JSON-lines exports.
+
+Exports select plain columns rather than model instances and read them from
+a server-side cursor in batches (``stream_results`` on PostgreSQL; SQLite
+cursors are lazy already), handing each batch to the client as soon as it is
+encoded. Memory use stays flat however many rows there are, and the first
+bytes go out before the query has finished.
+'''
+import csv
+import datetime as dt
+import io
+import json
+
+from flask import Response, current_app, stream_with_context
+
+from TsetseCheckout.compat import PY2, text_type
+from TsetseCheckout.database import db
+from TsetseCheckout.middleware import accepts_encoding, gzip_chunks
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def iter_rows(select, batch_size=1000):
+    '''Yield batches of rows for ``select`` from a server-side cursor.'''
+    # On the statement: the session's connection may be open already, and
+    # Session.connection() only applies options to a new one.
+    result = db.session.connection().execute(
+        select.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def encode_csv(batches, columns):
+    '''Encode batches of rows as CSV, one chunk of bytes per batch, with a
+    header row first.
+    '''
+    yield _csv_lines([columns])
+    for rows in batches:
+        yield _csv_lines(rows)
+
+
+def encode_jsonl(batches, columns):
+    '''Encode batches of rows as JSON lines, one object per row.'''
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=_json_value,
+                                 sort_keys=True) + '\n'
+                      for row in rows).encode('utf-8')
+
+
+def export_response(select, columns, fmt, filename):
+    '''Stream the rows of ``select`` as a ``fmt`` attachment.
+
+    :param columns: Names for the selected columns, used as the CSV header
+        and the JSON keys.
+    :param fmt: ``'csv'`` or ``'jsonl'``.
+    :param filename: Download name, without extension.
+    '''
+    encode = encode_csv if fmt == 'csv' else encode_jsonl
+    batches = iter_rows(select, current_app.config['EXPORT_BATCH_SIZE'])
+    chunks = encode(batches, columns)
+    headers = {
+        'Content-Disposition': 'attachment; filename={0}.{1}'.format(
+            filename, fmt),
+        'Vary': 'Accept-Encoding',
+    }
+    if accepts_encoding('gzip'):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt],
+                    headers=headers, direct_passthrough=True)
+
+
+def _csv_lines(rows):
+    buf = io.BytesIO() if PY2 else io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+    value = buf.getvalue()
+    return value if PY2 else value.encode('utf-8')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dt.date, dt.datetime)):
+        value = value.isoformat()
+    if PY2 and isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def _json_value(value):
+    if isinstance(value, (dt.date, dt.datetime)):
+        return value.isoformat()
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 """Extensions module. Each extension is initialized in the app factory located
 in app.py
+
+Extensions only some processes need (the debug toolbar, Flask-Assets,
+Flask-Migrate) are imported where they are used instead.
 """
 
 from flask.ext.bcrypt import Bcrypt
@@ -9,14 +12,8 @@ bcrypt = Bcrypt()
 from flask.ext.login import LoginManager
 login_manager = LoginManager()
 
-from flask.ext.sqlalchemy import SQLAlchemy
+from TsetseCheckout.engine import SQLAlchemy  # Flask-SQLAlchemy, plus pool setup
 db = SQLAlchemy()
 
-from flask.ext.migrate import Migrate
-migrate = Migrate()
-
 from flask.ext.cache import Cache
 cache = Cache()
-
-from flask.ext.debugtoolbar import DebugToolbarExtension
-debug_toolbar = DebugToolbarExtension()
\ No newline at end of file
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Bounded pool for password hashing.
+
+bcrypt is slow on purpose, so hashes run on a small pool of threads (bcrypt
+releases the GIL while it works) behind a bounded queue. When the queue is
+full the request is shed with a 503 rather than letting every worker stall.
+
+The cost factor is calibrated once per deploy (``manage.py calibrate``) so
+a hash stays within a latency budget on the machines we are deployed to.
+Workers don't calibrate at startup: hosts, or one host under load, would
+disagree about the cost, and stored hashes would flip between them.
+"""
+import binascii
+import os
+import threading
+import time
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from .compat import binary_type, queue
+from .extensions import bcrypt
+
+#: bcrypt clamps cost factors to this range.
+MIN_LOG_ROUNDS = 4
+MAX_LOG_ROUNDS = 31
+
+
+def log_rounds_of(pw_hash):
+    """Return the cost factor stored in a bcrypt hash (``$2a$12$...``), or
+    ``None`` if ``pw_hash`` is not a bcrypt hash.
+    """
+    if isinstance(pw_hash, binary_type):
+        pw_hash = pw_hash.decode('ascii')
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def calibrate_log_rounds(budget, min_rounds=MIN_LOG_ROUNDS,
+                         max_rounds=MAX_LOG_ROUNDS):
+    """Return the highest cost factor whose hash takes at most ``budget``
+    seconds on this machine, but never less than ``min_rounds``.
+
+    Each extra round doubles the work, so the search stops as soon as the
+    next round would be predicted to overshoot the budget.
+
+    :param budget: Per-hash latency budget in seconds.
+    """
+    rounds = max(min_rounds, MIN_LOG_ROUNDS)
+    elapsed = _time_hash(rounds)
+    while rounds < max_rounds and elapsed * 2 <= budget:
+        elapsed = _time_hash(rounds + 1)
+        if elapsed > budget:
+            break
+        rounds += 1
+    return rounds
+
+
+def _time_hash(rounds):
+    started = time.time()
+    bcrypt.generate_password_hash('calibration', rounds)
+    return time.time() - started
+
+
+class HashingOverloaded(ServiceUnavailable):
+    """Raised when the hashing queue is full or a queued hash waited too
+    long to start.
+    """
+    description = ("We're checking a lot of passwords right now. "
+                   "Please try again in a moment.")
+
+
+class _Job(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.enqueued_at = time.time()
+        self.done = threading.Event()
+        self.abandoned = False
+        self.result = None
+        self.error = None
+
+    def wait_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class HashingPool(object):
+    """Runs password hashing on a fixed number of threads.
+
+    Configuration (read in :meth:`init_app`):
+
+    ``HASHING_POOL_SIZE``
+        Number of hashing threads per process. ``0`` hashes inline.
+    ``HASHING_QUEUE_DEPTH``
+        Hashes allowed to wait for a thread before new ones are rejected.
+    ``HASHING_TIMEOUT``
+        Seconds a caller waits for its hash before giving up.
+    ``BCRYPT_LOG_ROUNDS``
+        Cost factor for new hashes.
+    ``BCRYPT_MIN_LOG_ROUNDS``
+        Cost factor stronger stored hashes are never rehashed below.
+    """
+
+    def __init__(self, app=None):
+        self.log_rounds = 12
+        self.min_log_rounds = 10
+        self.size = 0
+        self.queue_depth = 0
+        self.timeout = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self._dummy_hash = None
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'queue_wait_seconds': 0.0,
+            'hash_seconds': 0.0,
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        self.size = app.config.get('HASHING_POOL_SIZE', 2)
+        self.queue_depth = app.config.get('HASHING_QUEUE_DEPTH', 8)
+        self.timeout = app.config.get('HASHING_TIMEOUT', 5)
+        self.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.min_log_rounds = app.config.get('BCRYPT_MIN_LOG_ROUNDS', 10)
+        self._dummy_hash = None
+        app.extensions['hashing_pool'] = self
+
+    def generate_password_hash(self, password):
+        return self.submit(bcrypt.generate_password_hash, password,
+                           self.log_rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        return self.submit(bcrypt.check_password_hash, pw_hash, password)
+
+    def check_dummy(self, password):
+        """Check ``password`` against a hash nobody's password matches, at
+        the current cost factor. Logins for unknown users do this so they
+        take as long, and cost as much, as a wrong password.
+        """
+        if self._dummy_hash is None:
+            self._dummy_hash = self.generate_password_hash(
+                binascii.hexlify(os.urandom(16)))
+        self.check_password_hash(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, pw_hash):
+        """Return True if ``pw_hash`` was made with another cost factor than
+        new hashes get (or isn't a bcrypt hash), so every login costs the
+        same after the cost is recalibrated. Stronger hashes are only moved
+        down to a cost of at least ``BCRYPT_MIN_LOG_ROUNDS``.
+        """
+        current = min(max(self.log_rounds, MIN_LOG_ROUNDS), MAX_LOG_ROUNDS)
+        rounds = log_rounds_of(pw_hash)
+        if rounds is None or rounds < current:
+            return True
+        return rounds > current and current >= self.min_log_rounds
+
+    def submit(self, func, *args):
+        """Run ``func(*args)`` on the pool and return its result.
+
+        :raises HashingOverloaded: if the queue is full or the job could not
+            finish within ``HASHING_TIMEOUT`` seconds.
+        """
+        job = _Job(func, args)
+        if self.size <= 0:
+            self._run(job)
+            return job.wait_result()
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._count('rejected', 1)
+            raise HashingOverloaded()
+        self._count('submitted', 1)
+        if not job.done.wait(self.timeout):
+            job.abandoned = True
+            self._count('timed_out', 1)
+            raise HashingOverloaded()
+        return job.wait_result()
+
+    def stats(self):
+        """Return a snapshot of the pool's counters."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize() if self._queue else 0
+        return stats
+
+    def shutdown(self):
+        """Stop the pool's threads. They are restarted on the next hash."""
+        with self._lock:
+            if self._queue is not None and self._pid == os.getpid():
+                for _ in range(self.size):
+                    try:
+                        self._queue.put_nowait(None)
+                    except queue.Full:
+                        break
+            self._queue = None
+            self._pid = None
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so a pool inherited from a
+        # preloading parent process starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_depth)
+            for _ in range(self.size):
+                thread = threading.Thread(target=self._work,
+                                          args=(self._queue,))
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if not job.abandoned:
+                self._run(job)
+
+    def _run(self, job):
+        started = time.time()
+        try:
+            job.result = job.func(*job.args)
+        except Exception as error:
+            job.error = error
+        finished = time.time()
+        with self._lock:
+            self._stats['completed'] += 1
+            self._stats['queue_wait_seconds'] += started - job.enqueued_at
+            self._stats['hash_seconds'] += finished - started
+        job.done.set()
+
+    def _count(self, key, amount):
+        with self._lock:
+            self._stats[key] += amount
+
+
+hashing_pool = HashingPool()
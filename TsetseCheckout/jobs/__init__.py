@@ -0,0 +1,3 @@
+'''The jobs module, a queue of background work kept in the database.'''
+
+from . import models, views
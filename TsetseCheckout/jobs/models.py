@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import json
+
+from TsetseCheckout.database import Column, db, Model, SurrogatePK
+
+
+class Job(SurrogatePK, Model):
+    '''A call to a task function, run by ``manage.py worker``. See
+    :mod:`TsetseCheckout.jobs.queue`.
+    '''
+    __tablename__ = 'jobs'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    #: Import name of the task, e.g. "TsetseCheckout.jobs.tasks:export_samples"
+    name = Column(db.String(200), nullable=False)
+    #: JSON: {"args": [...], "kwargs": {...}}
+    arguments = Column(db.Text, nullable=False, default='{}')
+    status = Column(db.String(20), nullable=False, default=QUEUED)
+    #: Higher runs first
+    priority = Column(db.Integer, nullable=False, default=0)
+    attempts = Column(db.Integer, nullable=False, default=0)
+    max_attempts = Column(db.Integer, nullable=False, default=3)
+    #: Not claimed before this; pushed back after each failed attempt
+    run_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    #: host:pid of the worker running it
+    locked_by = Column(db.String(80), nullable=True)
+    locked_at = Column(db.DateTime, nullable=True)
+    #: Bumped on every claim so concurrent workers can detect each other
+    version = Column(db.Integer, nullable=False, default=1)
+    #: JSON returned by the task
+    result = Column(db.Text, nullable=True)
+    #: The last attempt's exception
+    error = Column(db.Text, nullable=True)
+    #: Who asked for it; only they (and admins) may see it
+    user_id = Column(db.Integer, nullable=True)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    finished_at = Column(db.DateTime, nullable=True)
+
+    @property
+    def done(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def to_dict(self):
+        '''What status polling shows.'''
+        return dict(
+            id=self.id, name=self.name, status=self.status,
+            attempts=self.attempts, max_attempts=self.max_attempts,
+            result=json.loads(self.result) if self.result else None,
+            error=self.error.strip().splitlines()[-1] if self.error else None,
+            created_at=self.created_at.isoformat(),
+            finished_at=(self.finished_at.isoformat()
+                         if self.finished_at else None),
+        )
+
+    def __repr__(self):
+        return '<Job({id}, {name!r}, {status!r})>'.format(
+            id=self.id, name=self.name, status=self.status)
+
+
+db.Index('ix_jobs_status_priority_run_at',
+         Job.status, Job.priority, Job.run_at)
+db.Index('ix_jobs_user_id_created_at', Job.user_id, Job.created_at)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''A queue of background jobs kept in the ``jobs`` table.
+
+Long tasks, like a full inventory export, shouldn't hold a web worker for the
+whole request. Views :func:`enqueue` them instead and answer right away;
+``manage.py worker`` runs them in a pool of processes (see
+:mod:`TsetseCheckout.jobs.worker`), and the browser polls for the outcome.
+
+Workers take the queued job with the highest priority whose ``run_at`` has
+passed. On PostgreSQL the job is claimed with one ``UPDATE`` of a row picked
+with ``FOR UPDATE SKIP LOCKED``, so workers never wait for each other. Other
+databases read a few candidates and claim one with an update that only
+succeeds if its ``version`` is unchanged, as samples are checked out.
+
+A job that raises is retried ``JOBS_RETRY_DELAY * 2 ** (attempts - 1)``
+seconds later (at most ``JOBS_RETRY_MAX_DELAY``) until it has run
+``max_attempts`` times, and then fails. While a job runs its worker refreshes
+``locked_at``; a job whose worker hasn't for ``JOBS_LOCK_TIMEOUT`` seconds is
+assumed lost with its worker and queued again (:func:`requeue_stale`).
+
+Files that jobs write to ``JOBS_OUTPUT_DIR`` are deleted after
+``JOBS_OUTPUT_TTL`` seconds (:func:`remove_expired_output`).
+'''
+import datetime as dt
+import json
+import os
+import socket
+import threading
+import traceback
+
+from flask import current_app
+from sqlalchemy import text
+from werkzeug.utils import import_string
+
+from TsetseCheckout.compat import string_types
+from TsetseCheckout.database import db
+from TsetseCheckout.jobs.models import Job
+from TsetseCheckout.shared_sqlite import private_directory
+
+#: Jobs read per claim on databases without ``SKIP LOCKED``. Another worker
+#: may take the first before we do, so we try the next.
+CLAIM_CANDIDATES = 5
+
+_CLAIM_SKIP_LOCKED = text(
+    'UPDATE jobs SET status = :running, locked_by = :worker, '
+    '  locked_at = :now, attempts = attempts + 1, version = version + 1 '
+    'WHERE id = ('
+    '  SELECT id FROM jobs WHERE status = :queued AND run_at <= :now '
+    '  ORDER BY priority DESC, run_at, id LIMIT 1 '
+    '  FOR UPDATE SKIP LOCKED'
+    ') RETURNING id'
+)
+
+
+def task(max_attempts=None, priority=0):
+    '''Mark a function as a task that may be queued. It must be importable
+    by name, and both its arguments and what it returns must be JSON
+    serializable. ::
+
+        @task(max_attempts=5)
+        def rebuild_something(box_id):
+            ...
+    '''
+    def decorator(func):
+        func.is_task = True
+        func.max_attempts = max_attempts
+        func.priority = priority
+        return func
+    return decorator
+
+
+def worker_id():
+    '''The ``locked_by`` of jobs this process claims.'''
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())[:80]
+
+
+def enqueue(func, args=(), kwargs=None, priority=None, delay=0,
+            max_attempts=None, user_id=None, commit=True):
+    '''Queue a call to the task ``func`` (or its import name,
+    ``'package.module:function'``).
+
+    :param priority: Higher runs first; defaults to the task's.
+    :param delay: Seconds before it may run.
+    :param user_id: Who may see the job's status.
+    :returns: The new :class:`Job`.
+    '''
+    if isinstance(func, string_types):
+        name = func
+    else:
+        name = '{0}:{1}'.format(func.__module__, func.__name__)
+    func = _resolve(name)
+    if priority is None:
+        priority = func.priority
+    max_attempts = (max_attempts or func.max_attempts or
+                    current_app.config['JOBS_MAX_ATTEMPTS'])
+    job = Job(
+        name=name,
+        arguments=json.dumps(dict(args=list(args), kwargs=kwargs or {}),
+                             sort_keys=True),
+        priority=priority, max_attempts=max_attempts, user_id=user_id,
+        run_at=dt.datetime.utcnow() + dt.timedelta(seconds=delay))
+    return job.save(commit=commit)
+
+
+def _resolve(name):
+    func = import_string(name)
+    if not getattr(func, 'is_task', False):
+        # Job names come from the database; only run what was meant to be.
+        raise ValueError('{0} is not a task'.format(name))
+    return func
+
+
+def claim(worker, now=None):
+    '''Claim the next job that is due for ``worker``.
+
+    :returns: The :class:`Job`, now running, or ``None`` if none is due.
+    '''
+    now = now or dt.datetime.utcnow()
+    if db.engine.dialect.name == 'postgresql':
+        job_id = db.session.execute(_CLAIM_SKIP_LOCKED, dict(
+            running=Job.RUNNING, queued=Job.QUEUED, worker=worker,
+            now=now)).scalar()
+    else:
+        job_id = _claim_unchanged(worker, now)
+    db.session.commit()
+    return Job.get_by_id(job_id) if job_id is not None else None
+
+
+def _claim_unchanged(worker, now):
+    jobs = Job.__table__
+    candidates = db.session.execute(
+        db.select([jobs.c.id, jobs.c.version])
+        .where(jobs.c.status == Job.QUEUED)
+        .where(jobs.c.run_at <= now)
+        .order_by(jobs.c.priority.desc(), jobs.c.run_at, jobs.c.id)
+        .limit(CLAIM_CANDIDATES)).fetchall()
+    for job_id, version in candidates:
+        claimed = db.session.execute(
+            jobs.update()
+            .where(jobs.c.id == job_id)
+            .where(jobs.c.version == version)
+            .where(jobs.c.status == Job.QUEUED)
+            .values(status=Job.RUNNING, locked_by=worker, locked_at=now,
+                    attempts=jobs.c.attempts + 1,
+                    version=jobs.c.version + 1)).rowcount
+        if claimed:
+            return job_id
+    return None
+
+
+def run(job, worker):
+    '''Run a job claimed by ``worker`` and record how it went.
+
+    :returns: Whether it succeeded.
+    '''
+    job_id, attempts, max_attempts = job.id, job.attempts, job.max_attempts
+    heartbeat = _Heartbeat(job_id, worker,
+                           current_app.config['JOBS_LOCK_TIMEOUT'] / 3.0)
+    heartbeat.start()
+    try:
+        arguments = json.loads(job.arguments)
+        result = _resolve(job.name)(*arguments.get('args', ()),
+                                    **arguments.get('kwargs', {}))
+        result = json.dumps(result, sort_keys=True)
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        current_app.logger.warning('Job %d failed (attempt %d of %d):\n%s',
+                                   job_id, attempts, max_attempts, error)
+        if attempts < max_attempts:
+            delay = min(
+                current_app.config['JOBS_RETRY_DELAY'] * 2 ** (attempts - 1),
+                current_app.config['JOBS_RETRY_MAX_DELAY'])
+            _finish(job_id, worker, status=Job.QUEUED, error=error,
+                    run_at=dt.datetime.utcnow() + dt.timedelta(seconds=delay))
+        else:
+            _finish(job_id, worker, status=Job.FAILED, error=error,
+                    finished_at=dt.datetime.utcnow())
+        return False
+    finally:
+        heartbeat.stop()
+    _finish(job_id, worker, status=Job.SUCCEEDED, result=result, error=None,
+            finished_at=dt.datetime.utcnow())
+    return True
+
+
+def _finish(job_id, worker, **values):
+    jobs = Job.__table__
+    # If the job was requeued as lost meanwhile, it isn't ours to finish.
+    db.session.execute(
+        jobs.update()
+        .where(jobs.c.id == job_id)
+        .where(jobs.c.locked_by == worker)
+        .where(jobs.c.status == Job.RUNNING)
+        .values(locked_by=None, locked_at=None, **values))
+    db.session.commit()
+
+
+def requeue_stale(now=None):
+    '''Queue again the running jobs whose worker hasn't been heard from in
+    ``JOBS_LOCK_TIMEOUT`` seconds, or fail those out of attempts.
+
+    :returns: How many jobs were requeued or failed.
+    '''
+    now = now or dt.datetime.utcnow()
+    cutoff = now - dt.timedelta(
+        seconds=current_app.config['JOBS_LOCK_TIMEOUT'])
+    jobs = Job.__table__
+    stale = db.and_(jobs.c.status == Job.RUNNING, jobs.c.locked_at < cutoff)
+    failed = db.session.execute(
+        jobs.update()
+        .where(stale)
+        .where(jobs.c.attempts >= jobs.c.max_attempts)
+        .values(status=Job.FAILED, locked_by=None, locked_at=None,
+                error='The worker running the job was lost',
+                finished_at=now)).rowcount
+    requeued = db.session.execute(
+        jobs.update()
+        .where(stale)
+        .values(status=Job.QUEUED, locked_by=None, locked_at=None,
+                run_at=now, version=jobs.c.version + 1)).rowcount
+    db.session.commit()
+    return failed + requeued
+
+
+def remove_expired_output(now=None):
+    '''Delete the files in ``JOBS_OUTPUT_DIR``, finished or abandoned,
+    last written more than ``JOBS_OUTPUT_TTL`` seconds ago.
+
+    :returns: How many files were deleted.
+    '''
+    now = now or dt.datetime.utcnow()
+    cutoff = now - dt.timedelta(
+        seconds=current_app.config['JOBS_OUTPUT_TTL'])
+    output_dir = current_app.config['JOBS_OUTPUT_DIR']
+    if not os.path.isdir(output_dir):
+        return 0
+    private_directory(output_dir)
+    removed = 0
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        try:
+            modified = dt.datetime.utcfromtimestamp(os.path.getmtime(path))
+            if modified < cutoff and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue  # Removed by another worker meanwhile
+    return removed
+
+
+class _Heartbeat(object):
+    '''Refreshes a running job's ``locked_at`` so it isn't taken for lost.'''
+
+    def __init__(self, job_id, worker, interval):
+        self.job_id = job_id
+        self.worker = worker
+        self.interval = interval
+        self.engine = db.engine
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        jobs = Job.__table__
+        while not self._stopping.wait(self.interval):
+            # Its own connection: the task may be mid-transaction on ours.
+            with self.engine.begin() as conn:
+                conn.execute(
+                    jobs.update()
+                    .where(jobs.c.id == self.job_id)
+                    .where(jobs.c.locked_by == self.worker)
+                    .values(locked_at=dt.datetime.utcnow()))
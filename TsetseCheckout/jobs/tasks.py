@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''Tasks the web app queues for ``manage.py worker``.'''
+import datetime as dt
+import os
+import uuid
+
+from flask import current_app
+
+from TsetseCheckout.database import db
+from TsetseCheckout.exports import encode_csv, encode_jsonl, iter_rows
+from TsetseCheckout.jobs.queue import task
+from TsetseCheckout.samples.models import inventory_select
+from TsetseCheckout.shared_sqlite import private_directory
+
+
+@task()
+def export_samples(fmt='csv'):
+    '''Write the sample inventory to a file in ``JOBS_OUTPUT_DIR``.
+
+    :param fmt: ``'csv'`` or ``'jsonl'``.
+    :returns: ``{"filename": ..., "rows": ...}``
+    '''
+    encode = encode_csv if fmt == 'csv' else encode_jsonl
+    select = inventory_select()
+    columns = [column.name for column in select.c]
+    # The downloads view serves whatever is here, so nobody else may write.
+    output_dir = private_directory(current_app.config['JOBS_OUTPUT_DIR'])
+    filename = 'samples-{0}-{1}.{2}'.format(
+        dt.datetime.utcnow().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8],
+        fmt)
+    path = os.path.join(output_dir, filename)
+    counted = _Counter(iter_rows(select,
+                                 current_app.config['EXPORT_BATCH_SIZE']))
+    # Written under another name first so a download never gets half a file.
+    with open(path + '.part', 'wb') as f:
+        for chunk in encode(counted, columns):
+            f.write(chunk)
+    os.rename(path + '.part', path)
+    return dict(filename=filename, rows=counted.rows)
+
+
+@task()
+def refresh_statistics():
+    '''Update the query planner's statistics, e.g. after a large import.'''
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    return dict(database=db.engine.dialect.name)
+
+
+class _Counter(object):
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.rows = 0
+
+    def __iter__(self):
+        for rows in self.batches:
+            self.rows += len(rows)
+            yield rows
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''Job status pages, polled by the browser while a job runs.'''
+import json
+
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    jsonify,
+    render_template,
+    send_from_directory,
+    url_for,
+)
+from flask.ext.login import current_user, login_required
+
+from TsetseCheckout.jobs.models import Job
+
+blueprint = Blueprint("jobs", __name__, url_prefix='/jobs',
+                        static_folder="../static")
+
+
+@blueprint.route("/<int:job_id>/")
+@login_required
+def show(job_id):
+    '''A page that follows the job until it is done.'''
+    job = _get_job(job_id)
+    return render_template("jobs/job.html", job=job,
+                           download_url=_download_url(job))
+
+
+@blueprint.route("/<int:job_id>/status")
+@login_required
+def status(job_id):
+    '''The job's :meth:`~Job.to_dict`, and a ``download_url`` once it has
+    written a file.
+    '''
+    job = _get_job(job_id)
+    data = job.to_dict()
+    data['download_url'] = _download_url(job)
+    return jsonify(data)
+
+
+@blueprint.route("/<int:job_id>/download")
+@login_required
+def download(job_id):
+    '''The file a finished job wrote.'''
+    job = _get_job(job_id)
+    if _download_url(job) is None:
+        abort(404)
+    return send_from_directory(current_app.config['JOBS_OUTPUT_DIR'],
+                               json.loads(job.result)['filename'],
+                               as_attachment=True)
+
+
+def _get_job(job_id):
+    job = Job.get_by_id(job_id)
+    # Other people's jobs are as good as missing.
+    if job is None or not (job.user_id == getattr(current_user, 'id', None) or
+                           getattr(current_user, 'is_admin', False)):
+        abort(404)
+    return job
+
+
+def _download_url(job):
+    result = json.loads(job.result) if job.result else None
+    if (job.status != Job.SUCCEEDED or not isinstance(result, dict) or
+            'filename' not in result):
+        return None
+    return url_for('.download', job_id=job.id)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+'''The process pool behind ``manage.py worker``.
+
+A supervisor forks ``JOBS_CONCURRENCY`` processes that each claim and run
+one job at a time, and looks for more every ``JOBS_POLL_INTERVAL`` seconds
+when the queue is empty. It starts a new process for any that dies, waiting
+longer each time one dies straight after starting, requeues the jobs of
+workers that were lost, here or on another host, and deletes expired job
+output.
+
+SIGTERM or SIGINT lets every process finish its current job and exit; a
+second one stops them at once (their jobs are retried once they are found
+stale).
+'''
+import multiprocessing
+import os
+import signal
+import time
+
+from TsetseCheckout.app import after_fork
+from TsetseCheckout.database import db
+from TsetseCheckout.jobs import queue
+
+#: Seconds between the supervisor's checks on its processes.
+SUPERVISE_INTERVAL = 1
+
+#: A process that exits within this many seconds of starting failed to start.
+MIN_UPTIME = 10
+
+#: Seconds, at most, before a process that keeps failing to start is retried.
+MAX_RESTART_DELAY = 60
+
+
+class Worker(object):
+    '''Runs queued jobs in ``concurrency`` processes until stopped.
+
+    :param burst: Exit once the queue is empty instead of waiting for jobs.
+    '''
+
+    def __init__(self, app, concurrency=None, poll_interval=None,
+                 burst=False):
+        self.app = app
+        self.concurrency = concurrency or app.config['JOBS_CONCURRENCY']
+        if poll_interval is None:
+            poll_interval = app.config['JOBS_POLL_INTERVAL']
+        self.poll_interval = poll_interval
+        self.burst = burst
+        self.stopping = multiprocessing.Event()
+        self.processes = []
+        self._next_maintenance = 0
+
+    def run(self):
+        '''Start the processes and supervise them until they have all
+        exited.
+        '''
+        handlers = dict((signum, signal.signal(signum, self._stop))
+                        for signum in (signal.SIGTERM, signal.SIGINT))
+        try:
+            self.processes = [self._start() for _ in range(self.concurrency)]
+            while self.processes:
+                if not self.stopping.is_set():
+                    self._maintain()
+                time.sleep(SUPERVISE_INTERVAL)
+                self._reap()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _start(self, failures=0):
+        with self.app.app_context():
+            # The connections requeueing used mustn't be shared with a child.
+            db.engine.dispose()
+        process = multiprocessing.Process(
+            target=_work,
+            args=(self.app, self.stopping, self.poll_interval, self.burst))
+        process.start()
+        process.started_at = time.time()
+        # Processes in this slot in a row that failed to start
+        process.failures = failures
+        process.restart_at = None
+        return process
+
+    def _reap(self):
+        now = time.time()
+        for i, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            process.join()
+            if self.stopping.is_set() or (self.burst and
+                                          process.exitcode == 0):
+                self.processes[i] = None
+                continue
+            if process.restart_at is None:
+                # Whatever stopped it starting (say a bad setting) will
+                # likely stop the next one, so wait longer each time.
+                if now - process.started_at < MIN_UPTIME:
+                    process.failures += 1
+                    delay = min(SUPERVISE_INTERVAL * 2 ** process.failures,
+                                MAX_RESTART_DELAY)
+                else:
+                    process.failures, delay = 0, 0
+                process.restart_at = now + delay
+                self.app.logger.warning(
+                    'Job worker %d exited with %s; starting another in %ds',
+                    process.pid, process.exitcode, delay)
+            if now >= process.restart_at:
+                self.processes[i] = self._start(process.failures)
+        self.processes = [p for p in self.processes if p is not None]
+
+    def _maintain(self):
+        now = time.time()
+        if now < self._next_maintenance:
+            return
+        self._next_maintenance = (
+            now + self.app.config['JOBS_LOCK_TIMEOUT'] / 2.0)
+        with self.app.app_context():
+            try:
+                requeued = queue.requeue_stale()
+                removed = queue.remove_expired_output()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(
+                    'Could not requeue stale jobs or delete expired output')
+                return
+            finally:
+                db.session.remove()
+        if requeued:
+            self.app.logger.warning('Requeued %d jobs of lost workers',
+                                    requeued)
+        if removed:
+            self.app.logger.info('Deleted %d expired job files', removed)
+
+    def _stop(self, signum, frame):
+        if self.stopping.is_set():
+            for process in self.processes:
+                if process.is_alive():
+                    # They ignore SIGTERM.
+                    os.kill(process.pid, signal.SIGKILL)
+        self.stopping.set()
+
+
+def _work(app, stopping, poll_interval, burst):
+    # Ctrl-C, or a SIGTERM sent to the process group, reaches every
+    # process; the supervisor decides when to stop the jobs.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    after_fork(app)
+    worker = queue.worker_id()
+    with app.app_context():
+        while not stopping.is_set():
+            try:
+                job = queue.claim(worker)
+                if job is not None:
+                    queue.run(job, worker)
+            except Exception:
+                # Most likely the database; don't spin on it.
+                db.session.rollback()
+                app.logger.exception('Job worker %s failed', worker)
+                job = None
+            finally:
+                db.session.remove()
+            if job is None:
+                if burst:
+                    return
+                stopping.wait(poll_interval)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+'''Load testing with simulated users.
+
+Each simulated user registers an account and logs in, then picks flows at
+random (by :data:`FLOWS` weight) until the time is up: browsing the member
+directory, checking a rack of samples out and back in, logging out and in
+again, or registering another account. Users run in threads, against the
+app in this process (through the WSGI interface, so no server is involved)
+or against a running server such as a local gunicorn.
+
+Every request's latency and status are recorded. :func:`run` returns a
+report with throughput, error rates and p50/p95/p99 latencies overall and
+per request, ready to be saved as JSON and compared between releases.
+
+Run in-process, the simulated users write to the app's own database: the
+accounts they register (``@loadtest.invalid`` addresses), the samples
+:func:`seed_samples` creates and their checkouts. :func:`cleanup` deletes
+them again.
+'''
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from TsetseCheckout.compat import http_cookiejar, urlencode, urllib_request
+from TsetseCheckout.metrics import BUCKETS
+
+#: Relative frequency of each flow after a user's first login.
+FLOWS = (
+    ('browse', 6),
+    ('checkout', 2),
+    ('relogin', 1),
+    ('register', 1),
+)
+
+PERCENTILES = (50, 95, 99)
+
+#: Barcodes of the samples :func:`seed_samples` creates.
+BARCODE_PREFIX = 'LOADTEST'
+BARCODE_FORMAT = BARCODE_PREFIX + '{0:06d}'
+
+#: Domain of the email addresses of the accounts simulated users register.
+EMAIL_DOMAIN = 'loadtest.invalid'
+
+PASSWORD = 'load-test-password'
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+
+
+class LoadTestError(Exception):
+    '''A response a flow can't continue from.'''
+
+
+class Recorder(object):
+    '''Collects the outcome of every request, from all users.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)  # name -> [(seconds, status, ok)]
+
+    def record(self, name, seconds, status, ok):
+        with self._lock:
+            self.samples[name].append((seconds, status, ok))
+
+    def report(self, elapsed):
+        '''Summaries of everything recorded, overall and per request.'''
+        with self._lock:
+            samples = dict((name, list(values))
+                           for name, values in self.samples.items())
+        everything = [sample for values in samples.values()
+                      for sample in values]
+        report = _summarise(everything, elapsed)
+        report['requests_by_name'] = dict(
+            (name, _summarise(values, elapsed))
+            for name, values in sorted(samples.items()))
+        return report
+
+
+class WSGISession(object):
+    '''A browser session against an app in this process.'''
+
+    def __init__(self, app):
+        self.client = Client(app, BaseResponse, use_cookies=True)
+
+    def request(self, method, path, form=None, json_body=None):
+        kwargs = {}
+        if form is not None:
+            kwargs['data'] = form
+        if json_body is not None:
+            kwargs.update(data=json.dumps(json_body),
+                          content_type='application/json')
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPSession(object):
+    '''A browser session against a server at ``base_url``.'''
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib_request.build_opener(
+            urllib_request.HTTPCookieProcessor(http_cookiejar.CookieJar()),
+            _NoRedirects())
+
+    def request(self, method, path, form=None, json_body=None):
+        data, headers = None, {}
+        if form is not None:
+            data = urlencode(form).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = urllib_request.Request(self.base_url + path, data=data,
+                                         headers=headers)
+        request.get_method = lambda: method
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except urllib_request.HTTPError as error:
+            response = error
+        return response.getcode(), response.read().decode('utf-8', 'replace')
+
+
+class _NoRedirects(urllib_request.HTTPRedirectHandler):
+    # Redirects are recorded as requests of their own, like a browser's.
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class SimulatedUser(object):
+    '''One user working through flows in a :class:`WSGISession` or
+    :class:`HTTPSession`.
+    '''
+
+    def __init__(self, session, recorder, barcodes=(), rack_size=12,
+                 rng=None):
+        self.session = session
+        self.recorder = recorder
+        self.barcodes = list(barcodes)
+        self.rack_size = rack_size
+        self.random = rng or random.Random()
+        self.username = None
+
+    def request(self, name, method, path, expect=200, **kwargs):
+        started = time.time()
+        try:
+            status, body = self.session.request(method, path, **kwargs)
+        except Exception:
+            self.recorder.record(name, time.time() - started, None, False)
+            raise
+        ok = status == expect
+        self.recorder.record(name, time.time() - started, status, ok)
+        if not ok:
+            raise LoadTestError('{0} {1} returned {2}, expected {3}'.format(
+                method, path, status, expect))
+        return body
+
+    def run(self, deadline):
+        self.register()
+        self.login()
+        flows = [name for name, weight in FLOWS for _ in range(weight)]
+        while time.time() < deadline:
+            try:
+                getattr(self, self.random.choice(flows))()
+            except LoadTestError:
+                # Already counted as an error. Start over from a known state.
+                self.login()
+        self.logout()
+
+    def register(self):
+        self.request('register:form', 'GET', '/register/')
+        self.username = 'lt{0}'.format(uuid.uuid4().hex[:16])
+        self.request('register:submit', 'POST', '/register/', expect=302,
+                     form=dict(username=self.username,
+                               email='{0}@{1}'.format(self.username,
+                                                      EMAIL_DOMAIN),
+                               password=PASSWORD, confirm=PASSWORD))
+
+    def login(self):
+        page = self.request('login:form', 'GET', '/')
+        form = dict(username=self.username, password=PASSWORD)
+        token = _CSRF_TOKEN.search(page)
+        if token:
+            form['csrf_token'] = token.group(1)
+        self.request('login:submit', 'POST', '/', expect=302, form=form)
+
+    def logout(self):
+        self.request('logout', 'GET', '/logout/', expect=302)
+
+    def relogin(self):
+        self.logout()
+        self.login()
+
+    def browse(self):
+        self.request('browse:members', 'GET', '/users/')
+        self.request('browse:search', 'GET', '/users/?q=lt')
+        self.request('browse:about', 'GET', '/about/')
+
+    def checkout(self):
+        if not self.barcodes:
+            return
+        rack = self.random.sample(self.barcodes,
+                                  min(self.rack_size, len(self.barcodes)))
+        self.request('checkout:out', 'POST', '/samples/checkout/',
+                     json_body={'barcodes': rack})
+        self.request('checkout:return', 'POST', '/samples/return/',
+                     json_body={'barcodes': rack})
+
+
+def run(make_session, users=10, duration=30, barcodes=(), rack_size=12,
+        seed=None):
+    '''Run ``users`` simulated users for ``duration`` seconds.
+
+    :param make_session: Called once per user for a new
+        :class:`WSGISession` or :class:`HTTPSession`.
+    :param barcodes: Samples the checkout flow may take; it is skipped if
+        there are none.
+    :returns: The report, as a dict.
+    '''
+    recorder = Recorder()
+    rng = random.Random(seed)
+    started = time.time()
+    deadline = started + duration
+    failures = []
+
+    def simulate(user):
+        try:
+            user.run(deadline)
+        except Exception as error:  # The user gives up; the rest carry on
+            failures.append(repr(error))
+
+    threads = []
+    for _ in range(users):
+        user = SimulatedUser(make_session(), recorder, barcodes, rack_size,
+                             random.Random(rng.random()))
+        threads.append(threading.Thread(target=simulate, args=(user,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = recorder.report(time.time() - started)
+    report.update(users=users, duration=duration,
+                  started_at=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           time.gmtime(started)),
+                  abandoned_users=failures)
+    return report
+
+
+def seed_samples(count):
+    '''Make sure the samples the checkout flow uses exist and are available.
+
+    :returns: Their barcodes.
+    '''
+    from TsetseCheckout.samples.models import Sample
+    barcodes = [BARCODE_FORMAT.format(i) for i in range(count)]
+    Sample.bulk_upsert(({'barcode': barcode, 'status': Sample.AVAILABLE}
+                        for barcode in barcodes),
+                       index_elements=['barcode'])
+    return barcodes
+
+
+def cleanup():
+    '''Delete the accounts simulated users registered, the samples
+    :func:`seed_samples` created, and the checkouts of either.
+
+    :returns: The numbers of users and samples deleted.
+    '''
+    from TsetseCheckout.database import db
+    from TsetseCheckout.samples.models import Checkout, Sample
+    from TsetseCheckout.user.models import User
+    user_ids = db.session.query(User.id).filter(
+        User.email.like('%@' + EMAIL_DOMAIN))
+    sample_ids = db.session.query(Sample.id).filter(
+        Sample.barcode.like(BARCODE_PREFIX + '%'))
+    Checkout.query.filter(db.or_(
+        Checkout.user_id.in_(user_ids.subquery()),
+        Checkout.sample_id.in_(sample_ids.subquery())
+    )).delete(synchronize_session=False)
+    users = User.query.filter(User.id.in_(user_ids.subquery())) \
+        .delete(synchronize_session=False)
+    samples = Sample.query.filter(Sample.id.in_(sample_ids.subquery())) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    User.on_bulk_write()
+    Sample.on_bulk_write()
+    return users, samples
+
+
+def _summarise(samples, elapsed):
+    latencies = sorted(seconds for seconds, _, _ in samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    statuses = defaultdict(int)
+    for _, status, _ in samples:
+        statuses[str(status)] += 1
+    summary = dict(
+        requests=len(samples),
+        errors=errors,
+        error_rate=float(errors) / len(samples) if samples else 0.0,
+        throughput=len(samples) / elapsed if elapsed else 0.0,
+        statuses=dict(statuses),
+        latency=dict(
+            ('p{0}'.format(p), _percentile(latencies, p))
+            for p in PERCENTILES),
+        histogram=[
+            dict(le='+Inf' if bound == float('inf') else bound,
+                 count=sum(1 for seconds in latencies if seconds <= bound))
+            for bound in BUCKETS],
+    )
+    summary['latency'].update(
+        mean=sum(latencies) / len(latencies) if latencies else 0.0,
+        max=latencies[-1] if latencies else 0.0)
+    return summary
+
+
+def _percentile(ordered, percent):
+    # Nearest rank.
+    if not ordered:
+        return 0.0
+    rank = int(-(-percent * len(ordered) // 100))  # ceil
+    return ordered[max(rank, 1) - 1]
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+'''Request, SQL, template and hashing metrics in Prometheus text format.
+
+Every request's latency goes into a histogram per endpoint, along with the
+number and total time of its SQL statements. Time spent rendering templates
+is recorded per template, and the hashing and connection pools and the
+login throttle report their own counters. ``GET /metrics`` serves all of it
+to ``METRICS_ALLOWED_ADDRESSES``, or to scrapers that send ``METRICS_TOKEN``
+as a bearer token; anyone else gets a 404.
+
+Each worker keeps its numbers in memory and, if ``METRICS_DIR`` is set (to
+a directory only this user may write to), writes them to ``METRICS_DIR/<pid>.json`` at most every
+``METRICS_FLUSH_INTERVAL`` seconds. ``/metrics`` adds up the files of every
+worker on the host, so it doesn't matter which worker answers the scrape.
+Counters of workers that have exited are kept, so totals never go down;
+their gauges are dropped.
+
+Requests slower than ``METRICS_SLOW_REQUEST`` seconds are logged with the
+slowest SQL statements they ran.
+'''
+import errno
+import glob
+import heapq
+import json
+import os
+import threading
+import time
+
+from flask import _request_ctx_stack, abort, current_app, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.security import safe_str_cmp
+
+from TsetseCheckout.extensions import db
+from TsetseCheckout.hashing import hashing_pool
+from TsetseCheckout.middleware import no_etag
+from TsetseCheckout.shared_sqlite import private_directory
+from TsetseCheckout.throttle import LIMITS, login_throttle
+from TsetseCheckout.utils import process_is_running
+
+#: Upper bounds, in seconds, of the latency histogram's buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           float('inf'))
+
+#: Statements kept per request for the slow request log: the slowest ones.
+MAX_LOGGED_STATEMENTS = 20
+
+#: Characters of each statement shown in the slow request log.
+MAX_STATEMENT_LENGTH = 300
+
+#: name -> (type, help) for everything :class:`Metrics` exposes.
+DESCRIPTIONS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time to handle a request, by endpoint and method.'),
+    'http_requests_total': (
+        'counter', 'Requests handled, by endpoint, method and status.'),
+    'sql_queries_total': (
+        'counter', 'SQL statements executed, by endpoint.'),
+    'sql_query_duration_seconds_total': (
+        'counter', 'Time spent executing SQL statements, by endpoint.'),
+    'template_render_seconds_total': (
+        'counter', 'Time spent rendering templates, by template.'),
+    'template_renders_total': (
+        'counter', 'Templates rendered, by template.'),
+    'bcrypt_hashes_total': (
+        'counter', 'Password hashes and checks completed.'),
+    'bcrypt_hash_seconds_total': (
+        'counter', 'Time spent hashing and checking passwords.'),
+    'bcrypt_queue_wait_seconds_total': (
+        'counter', 'Time hashes waited for a hashing thread.'),
+    'bcrypt_rejected_total': (
+        'counter', 'Hashes refused because the hashing pool was busy.'),
+    'login_attempts_total': (
+        'counter', 'Login attempts the throttle let through.'),
+    'login_attempts_rejected_total': (
+        'counter', 'Login attempts refused by the throttle, by limit.'),
+    'db_pool_connections': (
+        'gauge', 'Database connections, by state.'),
+    'db_pool_checkouts_total': (
+        'counter', 'Connections taken from the database pool.'),
+    'db_pool_timeouts_total': (
+        'counter', 'Times no database connection became free in time.'),
+    'db_pool_wait_seconds_total': (
+        'counter', 'Time spent waiting for a database connection.'),
+}
+
+
+class RequestMetrics(object):
+    '''What one request has done so far.'''
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.status = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.statements = []  # A heap of (seconds, statement)
+
+
+class Metrics(object):
+    '''Collects the metrics described in this module and serves them on
+    ``/metrics``.
+    '''
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.flush_interval = 10
+        self.slow_request = None
+        self.allowed_addresses = ()
+        self.token = None
+        self._lock = threading.Lock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.directory = app.config.get('METRICS_DIR')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 10)
+        self.slow_request = app.config.get('METRICS_SLOW_REQUEST')
+        self.allowed_addresses = frozenset(app.config.get(
+            'METRICS_ALLOWED_ADDRESSES', ('127.0.0.1', '::1')))
+        self.token = app.config.get('METRICS_TOKEN')
+        if not self.enabled:
+            return
+        if self.directory:
+            # Every file in it is added to what /metrics reports.
+            private_directory(self.directory)
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        # Teardown, unlike after_request, runs after a streamed response
+        # has finished.
+        app.teardown_request(self._finish_request)
+        app.jinja_env.template_class = TimedTemplate
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+        app.extensions['metrics'] = self
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = time.time()
+
+    def _check_pid(self):
+        # A forked worker starts counting from zero in its own file.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def inc(self, name, labels=None, amount=1):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_pid()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(BUCKETS) + [0.0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-1] += value
+
+    def _start_request(self):
+        _request_ctx_stack.top.metrics = RequestMetrics()
+
+    def _record_status(self, response):
+        current = getattr(_request_ctx_stack.top, 'metrics', None)
+        if current is not None:
+            current.status = response.status_code
+        return response
+
+    def _finish_request(self, error=None):
+        current = getattr(_request_ctx_stack.top, 'metrics', None)
+        if current is None:
+            return
+        _request_ctx_stack.top.metrics = None
+        duration = time.time() - current.started_at
+        endpoint = request.endpoint or '<unmatched>'
+        status = 500 if error is not None else current.status
+        self.observe('http_request_duration_seconds', duration,
+                     dict(endpoint=endpoint, method=request.method))
+        self.inc('http_requests_total', dict(
+            endpoint=endpoint, method=request.method, status=status))
+        if current.sql_count:
+            self.inc('sql_queries_total', dict(endpoint=endpoint),
+                     current.sql_count)
+            self.inc('sql_query_duration_seconds_total',
+                     dict(endpoint=endpoint), current.sql_time)
+        if self.slow_request is not None and duration >= self.slow_request:
+            self._log_slow_request(current, endpoint, status, duration)
+        if (self.directory and
+                time.time() - self._flushed_at >= self.flush_interval):
+            self.flush()
+
+    def _log_slow_request(self, current, endpoint, status, duration):
+        lines = ['Slow request: {0} {1} ({2}) {3} took {4:.0f} ms; '
+                 '{5} SQL statements in {6:.0f} ms, templates {7:.0f} ms'
+                 .format(request.method, request.path, endpoint, status,
+                         duration * 1000, current.sql_count,
+                         current.sql_time * 1000,
+                         current.template_time * 1000)]
+        for seconds, statement in sorted(current.statements, reverse=True):
+            lines.append('  {0:8.1f} ms  {1}'.format(
+                seconds * 1000,
+                ' '.join(statement.split())[:MAX_STATEMENT_LENGTH]))
+        current_app.logger.warning('\n'.join(lines))
+
+    def snapshot(self):
+        '''This process's metrics as a JSON-serialisable dict.'''
+        with self._lock:
+            self._check_pid()
+            counters = [[name, list(labels), value] for (name, labels), value
+                        in self._counters.items()]
+            histograms = [[name, list(labels), list(values)]
+                          for (name, labels), values
+                          in self._histograms.items()]
+        gauges = []
+        for name, labels, value in _collect(gauges):
+            counters.append([name, list(_label_key(labels)), value])
+        return dict(pid=os.getpid(), counters=counters,
+                    histograms=histograms, gauges=gauges)
+
+    def flush(self):
+        '''Write :meth:`snapshot` to this worker's file in ``METRICS_DIR``.'''
+        self._flushed_at = time.time()
+        path = os.path.join(self.directory, '{0}.json'.format(os.getpid()))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(tmp_path, path)
+
+    def collect(self):
+        '''Snapshots of every worker on the host (or just this one, without
+        ``METRICS_DIR``).
+        '''
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                continue  # Replaced or half-written; it'll be back
+        return snapshots
+
+    @no_etag
+    def expose(self):
+        if not self._may_scrape():
+            abort(404)
+        body = render_prometheus(aggregate(self.collect()))
+        return current_app.response_class(
+            body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+    def _may_scrape(self):
+        if request.remote_addr in self.allowed_addresses:
+            return True
+        authorization = request.headers.get('Authorization', '')
+        return bool(self.token) and safe_str_cmp(
+            authorization, 'Bearer {0}'.format(self.token))
+
+
+class TimedTemplate(Template):
+    '''Records how long each top-level render takes.'''
+
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            labels = dict(template=self.name or '<string>')
+            metrics.inc('template_renders_total', labels)
+            metrics.inc('template_render_seconds_total', labels, elapsed)
+            current = _current_request()
+            if current is not None:
+                current.template_time += elapsed
+
+
+def aggregate(snapshots):
+    '''Sum the counters and histograms of ``snapshots``, and keep the gauges
+    of processes that are still running.
+
+    :returns: ``{(name, labels): value}``, where histogram values are lists
+        of cumulative bucket counts followed by the sum.
+    '''
+    totals = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, _label_key(labels))
+            totals[key] = totals.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, _label_key(labels))
+            current = totals.get(key)
+            totals[key] = (values if current is None else
+                           [a + b for a, b in zip(current, values)])
+        if process_is_running(snapshot['pid']):
+            for name, labels, value in snapshot['gauges']:
+                key = (name, _label_key(labels))
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def render_prometheus(totals):
+    '''Format :func:`aggregate`'s result in the Prometheus text format.'''
+    lines = []
+    for name in sorted(set(name for name, _ in totals)):
+        kind, help_text = DESCRIPTIONS.get(name, ('untyped', name))
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for (sample_name, labels), value in sorted(totals.items()):
+            if sample_name != name:
+                continue
+            if kind != 'histogram':
+                lines.append('{0}{1} {2}'.format(name, _format_labels(labels),
+                                                 _format_value(value)))
+                continue
+            for bound, count in zip(BUCKETS, value):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels + (('le', le),)), count))
+            lines.append('{0}_sum{1} {2}'.format(
+                name, _format_labels(labels), _format_value(value[-1])))
+            lines.append('{0}_count{1} {2}'.format(
+                name, _format_labels(labels), value[-2]))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_directory(directory):
+    '''Remove the files of a previous deployment's workers.'''
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        try:
+            os.remove(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+
+def _collect(gauges):
+    # Counters the pools keep for themselves; gauges go straight in.
+    stats = hashing_pool.stats()
+    yield 'bcrypt_hashes_total', None, stats['completed']
+    yield 'bcrypt_hash_seconds_total', None, stats['hash_seconds']
+    yield 'bcrypt_queue_wait_seconds_total', None, stats['queue_wait_seconds']
+    yield ('bcrypt_rejected_total', None,
+           stats['rejected'] + stats['timed_out'])
+    attempts = login_throttle.stats()
+    yield 'login_attempts_total', None, attempts['allowed']
+    for limit in LIMITS:
+        yield ('login_attempts_rejected_total', dict(limit=limit),
+               attempts['rejected_' + limit])
+    pool = db.pool_stats(current_app._get_current_object())
+    if pool:
+        yield 'db_pool_checkouts_total', None, pool['checkouts']
+        yield 'db_pool_timeouts_total', None, pool['timeouts']
+        yield 'db_pool_wait_seconds_total', None, pool['wait_time']
+        for state in ('in_use', 'idle', 'overflow'):
+            gauges.append(['db_pool_connections', [['state', state]],
+                           pool[state]])
+
+
+def _current_request():
+    ctx = _request_ctx_stack.top
+    return getattr(ctx, 'metrics', None) if ctx is not None else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_started_at', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get('metrics_started_at')
+    if not started:
+        return
+    elapsed = time.time() - started.pop()
+    current = _current_request()
+    if current is not None:
+        current.sql_count += 1
+        current.sql_time += elapsed
+        if len(current.statements) < MAX_LOGGED_STATEMENTS:
+            heapq.heappush(current.statements, (elapsed, statement))
+        else:
+            heapq.heappushpop(current.statements, (elapsed, statement))
+
+
+def _label_key(labels):
+    if not labels:
+        return ()
+    if isinstance(labels, dict):
+        labels = labels.items()
+    return tuple(sorted((str(key), str(value)) for key, value in labels))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(key, value.replace('\\', r'\\')
+                           .replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
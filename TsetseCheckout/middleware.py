@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+'''Conditional GET and response compression.
+
+Every successful GET response gets a weak ETag computed from its body, so
+a browser that already has the page receives a bodiless 304. A view that
+can name a cheap freshness key up front can use :func:`fresh_when` to
+answer with a 304 before doing any work at all.
+
+Responses the client accepts gzip for are compressed if they are big
+enough and of a textual type, except HTML pages that could leak a CSRF
+token through their compressed size (BREACH). Streamed responses are
+compressed as they stream. Routes opt out with :func:`no_etag` or :func:`no_compression`.
+'''
+import hashlib
+import time
+import zlib
+from functools import wraps
+
+from flask import current_app, request, session
+
+from TsetseCheckout.caching import page_cache
+
+#: Types worth compressing; images and archives are compressed already.
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml',
+    'application/json', 'application/javascript', 'application/xml',
+    'application/x-ndjson',
+])
+
+
+class ResponseMiddleware(object):
+    '''Adds ETags to, and compresses, the app's responses.'''
+
+    def __init__(self, app=None):
+        self.etags = True
+        self.compress = True
+        self.min_size = 500
+        self.level = 6
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.etags = app.config.get('ETAGS_ENABLED', True)
+        self.compress = app.config.get('COMPRESS_ENABLED', True)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        self.level = app.config.get('COMPRESS_LEVEL', 6)
+        app.after_request(self.process_response)
+        app.extensions['response_middleware'] = self
+
+    def process_response(self, response):
+        view = current_app.view_functions.get(request.endpoint)
+        if self.etags and not getattr(view, 'no_etag', False):
+            response = self._add_etag(response)
+        if self.compress and not getattr(view, 'no_compression', False):
+            response = self._compress(response)
+        return response
+
+    def _add_etag(self, response):
+        if (request.method not in ('GET', 'HEAD') or
+                response.status_code != 200 or response.is_streamed or
+                response.direct_passthrough):
+            return response
+        if 'ETag' not in response.headers:
+            response.add_etag(weak=True)
+        return response.make_conditional(request)
+
+    def _compress(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or not accepts_encoding('gzip')
+                or request.method == 'HEAD'
+                or _breach_prone(response)):
+            return response
+        if response.is_streamed or response.direct_passthrough:
+            response.response = gzip_chunks(response.iter_encoded(),
+                                            self.level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(b''.join(gzip_chunks([data], self.level)))
+        response.headers['Content-Encoding'] = 'gzip'
+        _add_vary(response, 'Accept-Encoding')
+        return response
+
+
+def accepts_encoding(encoding):
+    '''Whether the request accepts ``encoding`` with a quality above zero.
+
+    ``'gzip' in request.accept_encodings`` is true for ``gzip;q=0`` too.
+    '''
+    return request.accept_encodings[encoding] > 0
+
+
+def gzip_chunks(chunks, level=6):
+    '''Gzip a stream of byte chunks, flushing after every chunk so the
+    client receives data as it is produced.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def fresh_when(key_func):
+    '''Decorate a view whose output only changes when ``key_func()`` does.
+
+    The ETag is derived from the key, the URL and who is asking, so a
+    matching ``If-None-Match`` gets a 304 without calling the view. Skipped
+    while flashed messages are waiting to be shown.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def decorated_view(*args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or
+                    '_flashes' in session):
+                return view(*args, **kwargs)
+            etag = _freshness_etag(key_func(*args, **kwargs))
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            return response
+        return decorated_view
+    return decorator
+
+
+def no_etag(view):
+    '''Don't add an ETag to this view's responses.'''
+    view.no_etag = True
+    return view
+
+
+def no_compression(view):
+    '''Don't compress this view's responses.'''
+    view.no_compression = True
+    return view
+
+
+def _breach_prone(response):
+    # BREACH: the compressed size of a page that carries a CSRF token and
+    # echoes attacker-chosen input gives the token away a byte at a time.
+    # Reflected input usually arrives in the query string, or in a form
+    # posted back with its token, so leave both kinds of page uncompressed.
+    if response.mimetype != 'text/html':
+        return False
+    if request.query_string or response.is_streamed:
+        return True
+    return b'name="csrf_token"' in response.get_data()
+
+
+def _freshness_etag(key):
+    parts = [key, request.full_path, page_cache.version, page_cache.vary()]
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if current_app.config.get('WTF_CSRF_ENABLED', True) and time_limit:
+        # Pages embed CSRF tokens that expire; don't keep confirming a page
+        # whose token is about to.
+        parts.append(int(time.time() // (time_limit // 2 or 1)))
+    digest = hashlib.sha1('\0'.join(
+        '{0}'.format(part) for part in parts).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _add_vary(response, header):
+    vary = [value.strip() for value in
+            response.headers.get('Vary', '').split(',') if value.strip()]
+    if header.lower() not in [value.lower() for value in vary]:
+        response.headers['Vary'] = ', '.join(vary + [header])
+
+
+response_middleware = ResponseMiddleware()
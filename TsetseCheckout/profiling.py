@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+'''Profiling individual requests on live workers.
+
+A request is profiled if its endpoint is in ``PROFILE_ENDPOINTS``, if it is
+picked as one in every ``PROFILE_SAMPLE_RATE`` requests, or if it carries an
+``X-Profile`` header made with :meth:`RequestProfiler.make_token` (``python
+manage.py profile-token``). Only someone who knows the ``SECRET_KEY`` can
+make that header, so headers are refused while it is a placeholder or
+shorter than ``MIN_SECRET_LENGTH``.
+
+Profiles are written to ``PROFILE_DIR``:
+
+``sample`` mode
+    A thread looks at the request's stack every ``PROFILE_INTERVAL``
+    seconds. The counts are written as collapsed stacks (``*.collapsed``),
+    which ``flamegraph.pl`` and speedscope turn into flame graphs.
+``cprofile`` mode
+    The request runs under :mod:`cProfile`. It is exact but slows the
+    request down; the stats are written to ``*.prof`` for :mod:`pstats`.
+
+Without ``PROFILE_DIR`` nothing is installed at all. With it, a request
+that isn't profiled costs a few comparisons. Each worker runs at most
+``PROFILE_MAX_CONCURRENT`` profiles at a time, and sampling stops after
+``PROFILE_MAX_SECONDS``.
+'''
+import cProfile
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import _request_ctx_stack, current_app, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Profile'
+
+MODES = ('sample', 'cprofile')
+
+#: Example values of ``SECRET_KEY`` that anyone could sign a header with.
+PLACEHOLDER_SECRETS = frozenset(['secret-key', 'something-really-secret',
+                                 'secret', 'changeme'])
+
+#: Shorter secret keys are taken to be placeholders too.
+MIN_SECRET_LENGTH = 16
+
+_UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class RequestProfiler(object):
+    '''Decides which requests to profile and writes their profiles.'''
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.endpoints = frozenset()
+        self.sample_rate = 0
+        self.mode = 'sample'
+        self.interval = 0.005
+        self.max_seconds = 30
+        self._slots = None
+        self._sequence = itertools.count(1)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get('PROFILE_DIR')
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.endpoints = frozenset(app.config.get('PROFILE_ENDPOINTS') or ())
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+        self.mode = app.config.get('PROFILE_MODE', 'sample')
+        self.interval = app.config.get('PROFILE_INTERVAL', 0.005)
+        self.max_seconds = app.config.get('PROFILE_MAX_SECONDS', 30)
+        self._slots = threading.BoundedSemaphore(
+            app.config.get('PROFILE_MAX_CONCURRENT', 1))
+        app.before_request(self._start)
+        app.after_request(self._add_header)
+        app.teardown_request(self._finish)
+        app.extensions['profiler'] = self
+
+    def make_token(self, mode=None):
+        '''A value for the ``X-Profile`` header that profiles the request
+        it is sent with, in ``mode``.
+
+        :raises RuntimeError: If ``SECRET_KEY`` is a placeholder, so the
+            header would be refused.
+        '''
+        if not _secret_is_strong():
+            raise RuntimeError('Set a real SECRET_KEY (TSETSECHECKOUT_SECRET) '
+                               'to profile requests with a header')
+        return _serializer().dumps({'mode': mode or self.mode})
+
+    def _requested_mode(self):
+        token = request.headers.get(HEADER)
+        if token and not _secret_is_strong():
+            current_app.logger.warning('Ignoring a %s header: SECRET_KEY is '
+                                       'a placeholder', HEADER)
+        elif token:
+            try:
+                mode = _serializer().loads(
+                    token, max_age=current_app.config.get(
+                        'PROFILE_TOKEN_MAX_AGE', 3600))['mode']
+            except (BadSignature, KeyError, TypeError):
+                current_app.logger.warning('Ignoring an invalid %s header',
+                                           HEADER)
+            else:
+                return mode if mode in MODES else self.mode
+        if (request.endpoint in self.endpoints or
+                (self.sample_rate and
+                 random.randint(1, self.sample_rate) == 1)):
+            return self.mode
+        return None
+
+    def _start(self):
+        mode = self._requested_mode()
+        if mode is None or not self._slots.acquire(False):
+            return
+        profile = _Profile(mode, self._path(mode))
+        try:
+            if mode == 'cprofile':
+                profile.profiler = cProfile.Profile()
+                profile.profiler.enable()
+            else:
+                profile.sampler = _Sampler(threading.current_thread().ident,
+                                           self.interval, self.max_seconds)
+                profile.sampler.start()
+        except Exception:
+            self._slots.release()
+            raise
+        _request_ctx_stack.top.profile = profile
+
+    def _add_header(self, response):
+        profile = getattr(_request_ctx_stack.top, 'profile', None)
+        if profile is not None and HEADER in request.headers:
+            response.headers[HEADER + '-File'] = os.path.basename(profile.path)
+        return response
+
+    def _finish(self, error=None):
+        profile = getattr(_request_ctx_stack.top, 'profile', None)
+        if profile is None:
+            return
+        _request_ctx_stack.top.profile = None
+        try:
+            profile.stop()
+            profile.write()
+        finally:
+            self._slots.release()
+
+    def _path(self, mode):
+        name = '{0}-{1}-{2}-{3}'.format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(self._sequence),
+            _UNSAFE_FILENAME.sub('_', request.endpoint or 'unmatched'))
+        suffix = '.prof' if mode == 'cprofile' else '.collapsed'
+        return os.path.join(self.directory, name + suffix)
+
+
+class _Profile(object):
+
+    def __init__(self, mode, path):
+        self.mode = mode
+        self.path = path
+        self.profiler = None
+        self.sampler = None
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def write(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.path)
+        if self.sampler is not None:
+            with open(self.path, 'w') as f:
+                for stack, count in sorted(self.sampler.stacks.items()):
+                    f.write('{0} {1}\n'.format(stack, count))
+
+
+class _Sampler(threading.Thread):
+    '''Counts the stacks seen in another thread at regular intervals.'''
+
+    def __init__(self, thread_id, interval, max_seconds):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.deadline = time.time() + max_seconds
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or time.time() > self.deadline:
+                return
+            self.stacks[_collapse(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        names.append('{0}:{1}'.format(frame.f_globals.get('__name__', '?'),
+                                      frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _secret_is_strong():
+    secret = current_app.secret_key or ''
+    return (len(secret) >= MIN_SECRET_LENGTH and
+            secret.lower() not in PLACEHOLDER_SECRETS)
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key,
+                                  salt='TsetseCheckout.profiling')
+
+
+profiler = RequestProfiler()
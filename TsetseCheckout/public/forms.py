@@ -2,6 +2,8 @@ from flask_wtf import Form
 from wtforms import StringField, PasswordField
 from wtforms.validators import DataRequired
 
+from TsetseCheckout.hashing import hashing_pool
+from TsetseCheckout.throttle import login_throttle
 from TsetseCheckout.user.models import User
 
 
@@ -18,8 +20,14 @@ class LoginForm(Form):
         if not initial_validation:
             return False
 
+        # Over the limit, this raises before any query or hash.
+        login_throttle.attempt(self.username.data)
+
         self.user = User.query.filter_by(username=self.username.data).first()
         if not self.user:
+            # Cost what a wrong password would, so guessing at unknown
+            # usernames is no cheaper for the server than at real ones.
+            hashing_pool.check_dummy(self.password.data)
             self.username.errors.append('Unknown username')
             return False
 
@@ -30,4 +38,11 @@ class LoginForm(Form):
         if not self.user.active:
             self.username.errors.append('User not activated')
             return False
+
+        # We only know the plaintext now, so this is the moment to move the
+        # stored hash to the current cost factor.
+        if self.user.password_needs_rehash():
+            self.user.set_password(self.password.data)
+            self.user.save()
+        login_throttle.succeeded(self.username.data)
         return True
\ No newline at end of file
@@ -1,34 +1,58 @@
 # -*- coding: utf-8 -*-
 '''Public section, including homepage and signup.'''
 from flask import (Blueprint, request, render_template, flash, url_for,
-                    redirect, session)
+                    redirect, session, jsonify)
 from flask.ext.login import login_user, login_required, logout_user
+from sqlalchemy.exc import IntegrityError
 
+from TsetseCheckout.audit.log import audit_log
+from TsetseCheckout.audit.models import AuditEvent
+from TsetseCheckout.caching import page_cache
 from TsetseCheckout.extensions import login_manager
+from TsetseCheckout.middleware import fresh_when
+from TsetseCheckout.user.cache import user_cache
 from TsetseCheckout.user.models import User
 from TsetseCheckout.public.forms import LoginForm
+from TsetseCheckout.throttle import TooManyAttempts
 from TsetseCheckout.user.forms import RegisterForm
 from TsetseCheckout.utils import flash_errors
-from TsetseCheckout.database import db
+from TsetseCheckout.database import db, use_replica
 
 blueprint = Blueprint('public', __name__, static_folder="../static")
 
 @login_manager.user_loader
 def load_user(id):
-    return User.get_by_id(int(id))
+    return user_cache.get(int(id), User.get_by_id)
 
 
 @blueprint.route("/", methods=["GET", "POST"])
+@use_replica
+@fresh_when(page_cache.generation)
+@page_cache.cached()
 def home():
     form = LoginForm(request.form)
     # Handle logging in
     if request.method == 'POST':
-        if form.validate_on_submit():
+        try:
+            valid = form.validate_on_submit()
+        except TooManyAttempts:
+            audit_log.record(AuditEvent.LOGIN_THROTTLED,
+                             username=form.username.data)
+            raise
+        if valid:
             login_user(form.user)
+            audit_log.record(AuditEvent.LOGIN, user_id=form.user.id,
+                             username=form.user.username)
             flash("You are logged in.", 'success')
             redirect_url = request.args.get("next") or url_for("user.members")
             return redirect(redirect_url)
         else:
+            audit_log.record(AuditEvent.LOGIN_FAILED,
+                             user_id=form.user.id if form.user else None,
+                             username=form.username.data,
+                             detail='; '.join(error for errors in
+                                              form.errors.values()
+                                              for error in errors))
             flash_errors(form)
     return render_template("public/home.html", form=form)
 
@@ -43,17 +67,35 @@ def logout():
 def register():
     form = RegisterForm(request.form, csrf_enabled=False)
     if form.validate_on_submit():
-        new_user = User.create(username=form.username.data,
-                        email=form.email.data,
-                        password=form.password.data,
-                        active=True)
-        flash("Thank you for registering. You can now log in.", 'success')
-        return redirect(url_for('public.home'))
+        try:
+            new_user = User.create(username=form.username.data,
+                            email=form.email.data,
+                            password=form.password.data,
+                            active=True)
+        except IntegrityError:
+            # Someone else registered the same name or email since we
+            # validated; report it like any other taken name.
+            db.session.rollback()
+            if form.check_unique():
+                raise
+            flash_errors(form)
+        else:
+            flash("Thank you for registering. You can now log in.", 'success')
+            return redirect(url_for('public.home'))
     else:
         flash_errors(form)
     return render_template('public/register.html', form=form)
 
+@blueprint.route("/register/available/")
+@use_replica
+def username_available():
+    username = request.args.get('username', '').strip()
+    available = bool(username) and User.username_available(username)
+    return jsonify(username=username, available=available)
+
 @blueprint.route("/about/")
+@fresh_when(page_cache.generation)
+@page_cache.cached()
 def about():
     form = LoginForm(request.form)
     return render_template("public/about.html", form=form)
\ No newline at end of file
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Sending reads to replicas.
+
+``GET`` and ``HEAD`` requests to views decorated with :func:`use_replica`
+run their queries against one of the binds listed in ``DB_REPLICA_BINDS``,
+chosen round-robin. Everything else uses the primary, including:
+
+* writes (flushes and ``INSERT``/``UPDATE``/``DELETE`` statements), and any
+  query a request makes after it has written;
+* raw SQL that isn't a ``SELECT``;
+* every request for ``DB_READ_YOUR_WRITES`` seconds after the same browser
+  session last wrote, so nobody looks at a replica that hasn't caught up
+  with their own change.
+
+A replica that fails its health check is skipped for
+``DB_REPLICA_HEALTH_INTERVAL`` seconds. If none are healthy, reads go to the
+primary.
+"""
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import _request_ctx_stack, has_request_context, request, session
+from sqlalchemy import exc, select
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+try:
+    from flask.ext.sqlalchemy import SignallingSession
+except ImportError:  # Flask-SQLAlchemy < 2.0
+    from flask.ext.sqlalchemy import _SignallingSession as SignallingSession
+
+#: Where the time of a browser session's last write is kept.
+LAST_WRITE_KEY = '_db_last_write'
+
+
+class RoutingSession(SignallingSession):
+    """The session behind ``db.session``; picks an engine per statement as
+    described in this module.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or _is_write(clause):
+            _record_write()
+        elif _reading_from_replica() and not _has_bind_key(mapper):
+            replicas = self.app.extensions.get('db_replicas')
+            engine = replicas.choose() if replicas is not None else None
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class ReplicaSet(object):
+    """The replica engines of one app, with the result of their last health
+    check.
+    """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.binds = list(app.config.get('DB_REPLICA_BINDS') or ())
+        self.health_interval = app.config.get('DB_REPLICA_HEALTH_INTERVAL',
+                                              10)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        # bind -> (healthy, time of the check)
+        self._health = {}
+
+    def choose(self):
+        """The next healthy replica's engine, or ``None``."""
+        if not self.binds:
+            return None
+        with self._lock:
+            start = next(self._next)
+        for i in range(len(self.binds)):
+            bind = self.binds[(start + i) % len(self.binds)]
+            if self.is_healthy(bind):
+                return self.db.get_engine(self.app, bind=bind)
+        return None
+
+    def is_healthy(self, bind):
+        healthy, checked_at = self._health.get(bind, (None, 0))
+        if time.time() - checked_at >= self.health_interval:
+            healthy = self._check(bind)
+            self._health[bind] = (healthy, time.time())
+        return healthy
+
+    def _check(self, bind):
+        try:
+            with self.db.get_engine(self.app, bind=bind).connect() as conn:
+                conn.scalar(select([1]))
+        except exc.SQLAlchemyError as error:
+            self.app.logger.warning('Replica %s is unavailable: %s', bind,
+                                    error)
+            return False
+        return True
+
+    def health(self):
+        """``{bind: healthy}`` as of each replica's last check."""
+        return dict((bind, self._health.get(bind, (None, 0))[0])
+                    for bind in self.binds)
+
+
+def use_replica(view):
+    """Decorate a view whose queries may be answered by a replica when it
+    handles a ``GET`` or ``HEAD``. Other methods, like a login ``POST``
+    that checks a password, always read from the primary.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            _request_ctx_stack.top.db_use_replica = True
+        return view(*args, **kwargs)
+    return decorated_view
+
+
+def _is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().lower().startswith(('select',
+                                                           'with'))
+    return False
+
+
+def _has_bind_key(mapper):
+    return (mapper is not None and
+            getattr(mapper.mapped_table, 'info', {}).get('bind_key')
+            is not None)
+
+
+def _record_write():
+    if not has_request_context():
+        return
+    ctx = _request_ctx_stack.top
+    ctx.db_wrote = True
+    if ctx.app.config.get('DB_REPLICA_BINDS'):
+        session[LAST_WRITE_KEY] = time.time()
+
+
+def _reading_from_replica():
+    ctx = _request_ctx_stack.top
+    if (ctx is None or not getattr(ctx, 'db_use_replica', False) or
+            getattr(ctx, 'db_wrote', False)):
+        return False
+    window = ctx.app.config.get('DB_READ_YOUR_WRITES', 5)
+    return time.time() - session.get(LAST_WRITE_KEY, 0) >= window
@@ -0,0 +1,3 @@
+'''The samples module, covering storage boxes, samples and checkouts.'''
+
+from . import models, views
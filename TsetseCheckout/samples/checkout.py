@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Checking samples out and back in.
+
+Many technicians check out samples at the same time, so claims never take a
+table lock. On PostgreSQL available rows are claimed with ``FOR UPDATE SKIP
+LOCKED``: a row another transaction is claiming is skipped and reported as
+busy instead of waited for. Other databases claim each row with an update
+that only succeeds if the row's ``version`` is unchanged since we read it.
+"""
+import datetime as dt
+from collections import namedtuple
+
+from sqlalchemy import bindparam, text
+
+from TsetseCheckout.database import chunked, db
+from TsetseCheckout.samples.models import Checkout, Sample
+
+#: Ids per ``IN`` list; keeps SQLite under its bound parameter limit.
+CHUNK_SIZE = 900
+
+#: The outcome for one requested sample. ``reason`` is ``None`` on success,
+#: otherwise one of ``'unknown'``, ``'unavailable'``, ``'busy'`` or
+#: ``'not_checked_out'``.
+ItemResult = namedtuple('ItemResult', ['sample_id', 'ok', 'reason'])
+
+_CLAIM_SKIP_LOCKED = text(
+    'UPDATE samples SET status = :to_status, version = version + 1 '
+    'WHERE id IN ('
+    '  SELECT id FROM samples WHERE id = ANY(:ids) AND status = :from_status '
+    '  FOR UPDATE SKIP LOCKED'
+    ') RETURNING id'
+)
+
+
+def checkout_samples(sample_ids, user_id, commit=True):
+    """Check out every available sample in ``sample_ids`` to ``user_id`` in
+    a single transaction.
+
+    :returns: An :class:`ItemResult` per distinct requested id, in order.
+    """
+    sample_ids = _unique(sample_ids)
+    claimed = _claim(sample_ids, Sample.AVAILABLE, Sample.CHECKED_OUT)
+    now = dt.datetime.utcnow()
+    Checkout.bulk_create(
+        ({'sample_id': sample_id, 'user_id': user_id, 'checked_out_at': now}
+         for sample_id in sample_ids if sample_id in claimed),
+        return_ids=False, commit=False)
+    results = _results(sample_ids, claimed, Sample.AVAILABLE, 'unavailable')
+    if commit:
+        db.session.commit()
+    return results
+
+
+def return_samples(sample_ids, commit=True):
+    """Return every checked-out sample in ``sample_ids`` and close its open
+    checkout, in a single transaction.
+
+    :returns: An :class:`ItemResult` per distinct requested id, in order.
+    """
+    sample_ids = _unique(sample_ids)
+    claimed = _claim(sample_ids, Sample.CHECKED_OUT, Sample.AVAILABLE)
+    now = dt.datetime.utcnow()
+    checkouts = Checkout.__table__
+    for chunk in chunked(sorted(claimed), CHUNK_SIZE):
+        db.session.execute(
+            checkouts.update()
+            .where(checkouts.c.sample_id.in_(chunk))
+            .where(checkouts.c.returned_at.is_(None))
+            .values(returned_at=now))
+    results = _results(sample_ids, claimed, Sample.CHECKED_OUT,
+                       'not_checked_out')
+    if commit:
+        db.session.commit()
+    return results
+
+
+def resolve_barcodes(barcodes):
+    """Map each of ``barcodes`` that exists to its sample id."""
+    samples = Sample.__table__
+    ids = {}
+    for chunk in chunked(_unique(barcodes), CHUNK_SIZE):
+        ids.update(db.session.execute(
+            db.select([samples.c.barcode, samples.c.id])
+            .where(samples.c.barcode.in_(chunk))).fetchall())
+    return ids
+
+
+def _unique(ids):
+    seen = set()
+    return [id for id in ids if not (id in seen or seen.add(id))]
+
+
+def _claim(sample_ids, from_status, to_status):
+    """Move samples from ``from_status`` to ``to_status`` and return the set
+    of ids this transaction moved.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        result = db.session.execute(_CLAIM_SKIP_LOCKED, {
+            'ids': list(sample_ids),
+            'from_status': from_status,
+            'to_status': to_status,
+        })
+        return set(row[0] for row in result)
+    samples = Sample.__table__
+    claim = (samples.update()
+             .where(samples.c.id == bindparam('_id'))
+             .where(samples.c.version == bindparam('_version'))
+             .where(samples.c.status == from_status)
+             .values(status=to_status, version=samples.c.version + 1))
+    claimed = set()
+    for chunk in chunked(sample_ids, CHUNK_SIZE):
+        candidates = db.session.execute(
+            db.select([samples.c.id, samples.c.version])
+            .where(samples.c.id.in_(chunk))
+            .where(samples.c.status == from_status))
+        for sample_id, version in candidates.fetchall():
+            result = db.session.execute(
+                claim, {'_id': sample_id, '_version': version})
+            if result.rowcount == 1:
+                claimed.add(sample_id)
+    return claimed
+
+
+def _results(sample_ids, claimed, from_status, wrong_status_reason):
+    """Build per-item results, looking up why unclaimed samples failed."""
+    statuses = {}
+    failed = [id for id in sample_ids if id not in claimed]
+    samples = Sample.__table__
+    for chunk in chunked(failed, CHUNK_SIZE):
+        statuses.update(db.session.execute(
+            db.select([samples.c.id, samples.c.status])
+            .where(samples.c.id.in_(chunk))).fetchall())
+    results = []
+    for sample_id in sample_ids:
+        if sample_id in claimed:
+            results.append(ItemResult(sample_id, True, None))
+        elif sample_id not in statuses:
+            results.append(ItemResult(sample_id, False, 'unknown'))
+        elif statuses[sample_id] == from_status:
+            # Still claimable, so another transaction held it
+            results.append(ItemResult(sample_id, False, 'busy'))
+        else:
+            results.append(ItemResult(sample_id, False, wrong_status_reason))
+    return results
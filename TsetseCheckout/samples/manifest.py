@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Streaming import of field-collection manifests.
+
+A manifest is a CSV file with a header row or a JSON-lines file, one sample
+per record, with the columns in :data:`FIELDS`. Records flow through a
+generator pipeline (read, validate, batch, upsert) so the file is never held
+in memory, and a checkpoint file next to the manifest records how far the
+import got so a failed import can pick up where it stopped.
+"""
+import csv
+import datetime as dt
+import io
+import itertools
+import json
+import os
+import time
+
+from TsetseCheckout.compat import PY2
+from TsetseCheckout.database import chunked
+from TsetseCheckout.samples.models import Sample, StorageBox
+
+FIELDS = ('barcode', 'box', 'position', 'species', 'collection_site',
+          'collected_on')
+
+#: Invalid records kept for the report; the rest are only counted.
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportStats(object):
+    """Progress of one import."""
+
+    def __init__(self, start):
+        self.start = start
+        self.position = start
+        self.imported = 0
+        self.invalid = 0
+        self.errors = []
+        self.started_at = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def rate(self):
+        """Records read per second."""
+        elapsed = self.elapsed
+        return (self.position - self.start) / elapsed if elapsed else 0.0
+
+    def add_error(self, number, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((number, message))
+
+
+def import_manifest(path, fmt=None, chunk_size=1000, restart=False,
+                    progress=None):
+    """Import the samples in the manifest at ``path``.
+
+    Records are upserted on ``barcode`` in chunks of ``chunk_size``, each in
+    its own transaction, and the checkpoint is advanced after every commit.
+    Re-running after a failure resumes from the checkpoint unless ``restart``
+    is true; records imported twice are simply updated.
+
+    :param fmt: ``'csv'`` or ``'jsonl'``; guessed from the extension if
+        ``None``.
+    :param progress: Called with the :class:`ImportStats` after each chunk.
+    :returns: The final :class:`ImportStats`.
+    """
+    checkpoint = path + '.checkpoint'
+    start = 0 if restart else _read_checkpoint(checkpoint)
+    stats = ImportStats(start)
+    records = read_records(path, fmt or _guess_format(path), start)
+    samples = validate_records(records, stats, _BoxResolver())
+    for chunk in chunked(samples, chunk_size):
+        Sample.bulk_upsert((sample for _, sample in chunk),
+                           index_elements=['barcode'], batch_size=chunk_size)
+        stats.imported += len(chunk)
+        _write_checkpoint(checkpoint, stats.position)
+        if progress is not None:
+            progress(stats)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return stats
+
+
+def read_records(path, fmt, start=0):
+    """Yield ``(number, record)`` for each record in the manifest, starting
+    with record number ``start``. JSON-lines records are yielded as the raw
+    line; :func:`validate_records` parses them.
+    """
+    if PY2:
+        f = open(path, 'rb')
+    else:
+        f = io.open(path, 'r', encoding='utf-8', newline='')
+    with f:
+        if fmt == 'csv':
+            records = csv.DictReader(f)
+        elif fmt == 'jsonl':
+            records = (line for line in f if line.strip())
+        else:
+            raise ValueError('Unknown manifest format: {0}'.format(fmt))
+        # Records before start were imported already; skip them unparsed.
+        for number, record in itertools.islice(enumerate(records), start,
+                                               None):
+            if PY2 and fmt == 'csv':
+                record = dict((key.decode('utf-8'),
+                               value.decode('utf-8') if value else value)
+                              for key, value in record.items())
+            yield number, record
+
+
+def validate_records(records, stats, boxes):
+    """Yield ``(number, sample_row)`` for every valid record, counting the
+    invalid ones in ``stats``.
+    """
+    for number, record in records:
+        stats.position = number + 1
+        try:
+            yield number, _to_sample_row(record, boxes)
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            stats.add_error(number, str(error))
+
+
+def _to_sample_row(record, boxes):
+    if not isinstance(record, dict):
+        # A JSON line, parsed here so a malformed one is just invalid.
+        record = json.loads(record)
+    barcode = (record.get('barcode') or '').strip()
+    if not barcode:
+        raise ValueError('missing barcode')
+    row = {'barcode': barcode}
+    for field in ('position', 'species', 'collection_site'):
+        row[field] = (record.get(field) or '').strip() or None
+    collected_on = (record.get('collected_on') or '').strip()
+    row['collected_on'] = (dt.datetime.strptime(collected_on,
+                                                '%Y-%m-%d').date()
+                           if collected_on else None)
+    box = (record.get('box') or '').strip()
+    row['box_id'] = boxes.id_for(box) if box else None
+    return row
+
+
+class _BoxResolver(object):
+    """Looks up storage boxes by name, creating any that don't exist yet."""
+
+    def __init__(self):
+        self._ids = {}
+
+    def id_for(self, name):
+        if name not in self._ids:
+            box = StorageBox.query.filter_by(name=name).first()
+            if box is None:
+                self._ids[name] = StorageBox.bulk_create([{'name': name}],
+                                                         commit=False)[0]
+            else:
+                self._ids[name] = box.id
+        return self._ids[name]
+
+
+def _guess_format(path):
+    if path.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError):
+        return 0
+
+
+def _write_checkpoint(path, position):
+    # Write then rename, so a crash never leaves a half-written checkpoint.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(position))
+    os.rename(tmp_path, path)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+
+from TsetseCheckout.database import (
+    Column,
+    db,
+    Model,
+    ReferenceCol,
+    relationship,
+    SurrogatePK,
+)
+
+
+class StorageBox(SurrogatePK, Model):
+    __tablename__ = 'storage_boxes'
+    name = Column(db.String(80), unique=True, nullable=False)
+    #: Freezer, shelf and rack the box lives in
+    location = Column(db.String(120), nullable=True)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    def __init__(self, name, **kwargs):
+        db.Model.__init__(self, name=name, **kwargs)
+
+    def __repr__(self):
+        return '<StorageBox({name!r})>'.format(name=self.name)
+
+
+class Sample(SurrogatePK, Model):
+    __tablename__ = 'samples'
+
+    AVAILABLE = 'available'
+    CHECKED_OUT = 'checked_out'
+
+    barcode = Column(db.String(64), unique=True, nullable=False)
+    box_id = ReferenceCol('storage_boxes', nullable=True)
+    box = relationship('StorageBox', backref='samples')
+    #: Well or slot within the box, e.g. "A1"
+    position = Column(db.String(10), nullable=True)
+    species = Column(db.String(80), nullable=True)
+    collection_site = Column(db.String(120), nullable=True)
+    collected_on = Column(db.Date, nullable=True)
+    status = Column(db.String(20), nullable=False, default=AVAILABLE)
+    #: Bumped on every change so concurrent writers can detect each other
+    version = Column(db.Integer, nullable=False, default=1)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    def __init__(self, barcode, **kwargs):
+        db.Model.__init__(self, barcode=barcode, **kwargs)
+
+    @property
+    def available(self):
+        return self.status == self.AVAILABLE
+
+    def __repr__(self):
+        return '<Sample({barcode!r})>'.format(barcode=self.barcode)
+
+
+class Checkout(SurrogatePK, Model):
+    __tablename__ = 'checkouts'
+    sample_id = ReferenceCol('samples')
+    sample = relationship('Sample', backref='checkouts')
+    user_id = ReferenceCol('users')
+    user = relationship('User', backref='checkouts')
+    checked_out_at = Column(db.DateTime, nullable=False,
+                            default=dt.datetime.utcnow)
+    #: Null while the sample is still out
+    returned_at = Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<Checkout({sample_id}, {user_id})>'.format(
+            sample_id=self.sample_id, user_id=self.user_id)
+
+
+db.Index('ix_samples_created_at_id', Sample.created_at, Sample.id)
+db.Index('ix_checkouts_sample_id_returned_at',
+         Checkout.sample_id, Checkout.returned_at)
+db.Index('ix_checkouts_user_id_checked_out_at',
+         Checkout.user_id, Checkout.checked_out_at)
+
+
+def inventory_select():
+    '''The sample inventory as exported: one row per sample, with the name
+    of its box.
+    '''
+    samples, boxes = Sample.__table__, StorageBox.__table__
+    return (db.select([samples.c.id, samples.c.barcode,
+                       boxes.c.name.label('box'), samples.c.position,
+                       samples.c.species, samples.c.collection_site,
+                       samples.c.collected_on, samples.c.status,
+                       samples.c.created_at])
+            .select_from(samples.outerjoin(boxes))
+            .order_by(samples.c.id))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''Sample views, including the batch endpoints barcode scanners post to.'''
+from flask import Blueprint, current_app, jsonify, request, url_for
+from flask.ext.login import current_user, login_required
+
+from TsetseCheckout.audit.log import audit_log
+from TsetseCheckout.audit.models import AuditEvent
+from TsetseCheckout.compat import string_types
+from TsetseCheckout.database import use_replica
+from TsetseCheckout.exports import export_response
+from TsetseCheckout.jobs.queue import enqueue
+from TsetseCheckout.samples.checkout import (
+    checkout_samples,
+    resolve_barcodes,
+    return_samples,
+)
+from TsetseCheckout.samples.models import inventory_select
+
+blueprint = Blueprint("samples", __name__, url_prefix='/samples',
+                        static_folder="../static")
+
+
+@blueprint.route("/checkout/", methods=["POST"])
+@login_required
+def checkout():
+    '''Check out a rack of scanned tubes at once.
+
+    Expects a JSON body of the form ``{"barcodes": ["TS000001", ...]}``.
+    '''
+    return _scan(lambda ids: checkout_samples(ids, current_user.id),
+                 AuditEvent.CHECKOUT)
+
+
+@blueprint.route("/return/", methods=["POST"])
+@login_required
+def checkin():
+    '''Return a rack of scanned tubes at once. Takes the same body as
+    :func:`checkout`.
+    '''
+    return _scan(return_samples, AuditEvent.RETURN)
+
+
+@blueprint.route("/export.<any(csv, jsonl):fmt>")
+@use_replica
+@login_required
+def export(fmt):
+    '''Download the sample inventory.'''
+    select = inventory_select()
+    columns = [column.name for column in select.c]
+    return export_response(select, columns, fmt, 'samples')
+
+
+@blueprint.route("/export.<any(csv, jsonl):fmt>", methods=["POST"])
+@login_required
+def export_job(fmt):
+    '''Queue an export of the sample inventory for ``manage.py worker``.
+
+    Answers 202 with the job's status (poll ``status_url``) and a
+    ``Location`` for its page. Like :func:`checkout`, expects a JSON body
+    (which may be ``{}``).
+    '''
+    if request.get_json(silent=True) is None:
+        return jsonify(error='Expected a JSON body'), 400
+    # By name: the tasks module imports this package's models.
+    job = enqueue('TsetseCheckout.jobs.tasks:export_samples',
+                  kwargs=dict(fmt=fmt), user_id=current_user.id)
+    response = jsonify(dict(job.to_dict(),
+                            status_url=url_for('jobs.status', job_id=job.id)))
+    response.status_code = 202
+    response.headers['Location'] = url_for('jobs.show', job_id=job.id)
+    return response
+
+
+def _scan(action, audit_action):
+    # Requiring a JSON content type means browsers won't send this
+    # cross-site without a CORS preflight.
+    payload = request.get_json(silent=True) or {}
+    barcodes = payload.get('barcodes')
+    if (not isinstance(barcodes, list) or
+            not all(isinstance(b, string_types) for b in barcodes)):
+        return jsonify(error='Expected {"barcodes": [...]}'), 400
+    limit = current_app.config['SCAN_MAX_BARCODES']
+    if len(barcodes) > limit:
+        return jsonify(error='At most {0} barcodes per request'.format(limit)), 400
+
+    ids = resolve_barcodes(barcodes)
+    outcomes = dict((result.sample_id, result)
+                    for result in action([ids[b] for b in barcodes if b in ids]))
+    audit_log.record(audit_action, user_id=current_user.id,
+                     sample_ids=sorted(sample_id for sample_id, outcome
+                                       in outcomes.items() if outcome.ok))
+    results = []
+    for barcode in barcodes:
+        outcome = outcomes.get(ids.get(barcode))
+        results.append({
+            'barcode': barcode,
+            'ok': bool(outcome and outcome.ok),
+            'reason': outcome.reason if outcome else 'unknown',
+        })
+    succeeded = sum(1 for result in results if result['ok'])
+    return jsonify(results=results, succeeded=succeeded,
+                   failed=len(results) - succeeded)
@@ -7,11 +7,88 @@ class Config(object):
     SECRET_KEY = os_env['TSETSECHECKOUT_SECRET']  # TODO: Change me
     APP_DIR = os.path.abspath(os.path.dirname(__file__))  # This directory
     PROJECT_ROOT = os.path.abspath(os.path.join(APP_DIR, os.pardir))
-    BCRYPT_LOG_ROUNDS = 13
+    # Cost of new hashes; pick it per deploy with "manage.py calibrate"
+    BCRYPT_LOG_ROUNDS = int(os_env.get('TSETSECHECKOUT_BCRYPT_LOG_ROUNDS', 13))
+    BCRYPT_LATENCY_BUDGET = 0.25  # Seconds one hash may take when calibrating
+    BCRYPT_MIN_LOG_ROUNDS = 10
+    BCRYPT_MAX_LOG_ROUNDS = 15
+    HASHING_POOL_SIZE = 2  # Password hashing threads per worker
+    HASHING_QUEUE_DEPTH = 8  # Hashes that may wait before we shed with a 503
+    HASHING_TIMEOUT = 5  # Seconds a request waits for its hash
+    LOGIN_THROTTLE_ENABLED = True  # Refuse logins over these limits with a 429
+    LOGIN_THROTTLE_IP_ATTEMPTS = 20  # Failed logins from one address in a burst
+    LOGIN_THROTTLE_IP_PERIOD = 60  # Seconds for an address to get them all back
+    LOGIN_THROTTLE_USER_ATTEMPTS = 5  # Failed logins for a username from one address
+    LOGIN_THROTTLE_USER_PERIOD = 300  # Seconds for a username to get them all back
+    LOGIN_THROTTLE_PATH = None  # SQLite file the workers share; None for per-worker limits
     ASSETS_DEBUG = False
+    # Where "manage.py assets build" writes hashed, precompressed bundles
+    ASSETS_DIST_DIR = os.path.join(APP_DIR, 'static', 'public', 'dist')
+    ASSETS_USE_MANIFEST = False  # Serve those instead of building on demand
     DEBUG_TB_ENABLED = False  # Disable Debug toolbar
     DEBUG_TB_INTERCEPT_REDIRECTS = False
+    DB_POOL_SIZE = 5  # Connections each worker keeps open
+    DB_MAX_OVERFLOW = 10  # Extra connections opened under load, then closed
+    DB_POOL_TIMEOUT = 10  # Seconds to wait for a free connection
+    DB_POOL_RECYCLE = 1800  # Seconds before a connection is replaced
+    DB_POOL_PRE_PING = True  # Check connections still work before use
+    DB_STATEMENT_TIMEOUT = 30  # Seconds a request's statement may run; None for no limit
+    DB_REPLICA_BINDS = []  # SQLALCHEMY_BINDS keys of read replicas
+    DB_REPLICA_HEALTH_INTERVAL = 10  # Seconds between checks of a replica
+    DB_READ_YOUR_WRITES = 5  # Seconds a session reads from the primary after writing
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
+    PAGE_CACHE_ENABLED = True  # Cache rendered public pages and fragments
+    PAGE_CACHE_TIMEOUT = 300
+    RELEASE = os_env.get('TSETSECHECKOUT_RELEASE')  # Part of every page cache key
+    ETAGS_ENABLED = True  # Weak ETags and 304s for GET responses
+    COMPRESS_ENABLED = True  # Gzip textual responses for clients that accept it
+    COMPRESS_MIN_SIZE = 500  # Bytes; smaller responses aren't worth it
+    COMPRESS_LEVEL = 6
+    USER_CACHE_SIZE = 1000  # Logged-in users kept in memory per worker
+    USER_CACHE_TTL = 60  # Seconds before another worker's writes are seen
+    USERNAME_FILTER_CAPACITY = 100000  # Usernames the availability filter sizes for
+    USERNAME_FILTER_TTL = 300  # Seconds between rebuilds of that filter
+    SCAN_MAX_BARCODES = 5000  # Barcodes accepted per checkout/return request
+    EXPORT_BATCH_SIZE = 1000  # Rows fetched and sent per chunk of an export
+    METRICS_ENABLED = True  # Record timings and serve them on /metrics
+    METRICS_DIR = None  # Where workers share their metrics; None for this process only
+    METRICS_FLUSH_INTERVAL = 10  # Seconds between writes to METRICS_DIR
+    METRICS_SLOW_REQUEST = 1.0  # Log requests slower than this, with their SQL
+    METRICS_ALLOWED_ADDRESSES = ['127.0.0.1', '::1']  # Who may scrape /metrics
+    # Scrapers elsewhere send "Authorization: Bearer <token>"
+    METRICS_TOKEN = os_env.get('TSETSECHECKOUT_METRICS_TOKEN')
+    PROFILE_DIR = None  # Where request profiles go; None turns profiling off
+    PROFILE_ENDPOINTS = []  # Endpoints profiled on every request
+    PROFILE_SAMPLE_RATE = 0  # Profile one in this many requests; 0 for none
+    PROFILE_MODE = 'sample'  # Or "cprofile": exact, but much slower
+    PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+    PROFILE_MAX_SECONDS = 30  # Sampling stops after this long
+    PROFILE_MAX_CONCURRENT = 1  # Profiles running at once in a worker
+    PROFILE_TOKEN_MAX_AGE = 3600  # Seconds an X-Profile header stays valid
+    MEMBERS_PER_PAGE = 50
+    AUDIT_ENABLED = True  # Record logins and checkouts in audit_events
+    AUDIT_FLUSH_INTERVAL = 5  # Seconds between batch writes; None writes only when full
+    AUDIT_BATCH_SIZE = 500  # Buffered events that trigger a write right away
+    AUDIT_MAX_BUFFER = 10000  # Events kept in memory while writes fail; the rest stay in the spool
+    AUDIT_SPOOL_DIR = None  # Where unwritten events are kept in case a worker dies
+    JOBS_CONCURRENCY = 2  # Processes "manage.py worker" runs jobs in
+    JOBS_POLL_INTERVAL = 1  # Seconds an idle worker waits before looking again
+    JOBS_MAX_ATTEMPTS = 3  # Runs before a failing job is given up on
+    JOBS_RETRY_DELAY = 10  # Seconds before the first retry; doubles each time
+    JOBS_RETRY_MAX_DELAY = 600  # Seconds between retries at most
+    JOBS_LOCK_TIMEOUT = 300  # Seconds without a heartbeat before a running job is requeued
+    JOBS_STATUS_POLL_INTERVAL = 2  # Seconds between a job page's status requests
+    JOBS_OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'job-output')  # Files jobs write, e.g. exports
+    JOBS_OUTPUT_TTL = 24 * 60 * 60  # Seconds before a job's file is deleted
+    MEMBER_COUNT_TTL = 60  # Seconds the directory's total counts are cached
+    BLUEPRINTS = [  # Import names of the blueprints to register
+        'TsetseCheckout.public.views:blueprint',
+        'TsetseCheckout.user.views:blueprint',
+        'TsetseCheckout.samples.views:blueprint',
+        'TsetseCheckout.jobs.views:blueprint',
+        'TsetseCheckout.assets:blueprint',
+    ]
+    STARTUP_BUDGET = 2.0  # Seconds "manage.py startup-profile" allows
 
 
 class ProdConfig(Config):
@@ -20,6 +97,23 @@ class ProdConfig(Config):
     DEBUG = False
     SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/example'  # TODO: Change me
     DEBUG_TB_ENABLED = False  # Disable Debug toolbar
+    ASSETS_USE_MANIFEST = True  # Requires "manage.py assets build" on deploy
+    # One cache file shared by every worker on the host. The directory must
+    # belong to the app's user and be writable by nobody else.
+    CACHE_TYPE = 'TsetseCheckout.cache_backends.sqlite'
+    CACHE_DIR = os_env.get('TSETSECHECKOUT_CACHE_DIR',
+                           '/var/cache/tsetsecheckout')
+    CACHE_THRESHOLD = 10000  # Entries kept before least recently used go
+    LOGIN_THROTTLE_PATH = os.path.join(CACHE_DIR, 'login-throttle.sqlite')
+    METRICS_DIR = os_env.get('TSETSECHECKOUT_METRICS_DIR',
+                             '/var/lib/tsetsecheckout/metrics')
+    PROFILE_DIR = os_env.get('TSETSECHECKOUT_PROFILE_DIR')  # Off unless set
+    # Private to the app's user, like CACHE_DIR
+    AUDIT_SPOOL_DIR = os_env.get('TSETSECHECKOUT_AUDIT_DIR',
+                                 '/var/lib/tsetsecheckout/audit')
+    # Must be shared by the web and job workers, and private to their user
+    JOBS_OUTPUT_DIR = os_env.get('TSETSECHECKOUT_JOBS_DIR',
+                                 '/var/lib/tsetsecheckout/jobs')
 
 
 class DevConfig(Config):
@@ -32,6 +126,7 @@ class DevConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///{0}'.format(DB_PATH)
     DEBUG_TB_ENABLED = True
     ASSETS_DEBUG = True  # Don't bundle/minify static assets
+    PAGE_CACHE_ENABLED = False  # See template edits immediately
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
 
 
@@ -40,4 +135,6 @@ class TestConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     BCRYPT_LOG_ROUNDS = 1  # For faster tests
+    DB_POOL_PRE_PING = False  # Keeps query counts exact
+    AUDIT_FLUSH_INTERVAL = None  # No thread; tests flush the audit log themselves
     WTF_CSRF_ENABLED = False  # Allows form testing
\ No newline at end of file
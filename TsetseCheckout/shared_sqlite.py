@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''SQLite files shared by every worker on a host.
+
+The ``sqlite`` cache backend and the login throttle keep their state in a
+SQLite file in WAL mode, so readers don't wait for writers and a change made
+by one worker is seen by the others at once. :class:`SharedSQLite` gives
+each thread of each process its own connection to such a file, and
+:func:`private_directory` makes sure no other user can write to the
+directory it lives in.
+'''
+import os
+import sqlite3
+import stat
+import threading
+from contextlib import contextmanager
+
+
+class SharedSQLite(object):
+    '''Per-thread connections to a SQLite file in WAL mode.
+
+    :param path: The database file. Created if it doesn't exist.
+    :param busy_timeout: Seconds to wait for another process's write.
+    '''
+
+    def __init__(self, path, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def connection(self):
+        '''This thread's connection, in autocommit mode.'''
+        # Connections must not cross threads or survive a fork.
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, pid
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        '''Run the block in a transaction that holds the write lock from the
+        start, so read-modify-write is atomic across processes.
+        '''
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def private_directory(path):
+    '''Create ``path`` readable by this user only, or check that it is
+    owned by this user and that nobody else can write to it.
+
+    Cached values are unpickled, so anyone who can write the cache file can
+    run code in every worker. Other files the app reads back as its own,
+    like the audit spool, need the same protection.
+
+    :raises RuntimeError: If someone else could write to the directory.
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    info = os.stat(path)
+    if info.st_uid != os.getuid():
+        raise RuntimeError('{0} is owned by uid {1}, not {2}'.format(
+            path, info.st_uid, os.getuid()))
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError('{0} is writable by other users'.format(path))
+    return path
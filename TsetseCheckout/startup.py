@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''Measure how long a cold worker takes to start.
+
+Run ``python -m TsetseCheckout.startup CONFIG`` in a fresh interpreter: it
+times the import of each package in :data:`IMPORTS`, in order, then creates
+the app with ``TsetseCheckout.settings.CONFIG`` and prints the times as JSON.
+``manage.py startup-profile`` runs it and checks the total against a budget.
+'''
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+#: Timed in this order, so each is charged only for what the earlier ones
+#: didn't already import.
+IMPORTS = (
+    'werkzeug',
+    'jinja2',
+    'flask',
+    'sqlalchemy',
+    'flask_sqlalchemy',
+    'flask_login',
+    'flask_bcrypt',
+    'flask_wtf',
+    'flask_cache',
+    'TsetseCheckout.app',
+)
+
+
+def measure(config_name):
+    '''Import :data:`IMPORTS` and create the app, timing each step.
+
+    :returns: An ordered dict of ``{'imports': {...}, 'init': {...},
+        'total': seconds}``, times in seconds.
+    '''
+    start = time.time()
+    imports = OrderedDict()
+    for name in IMPORTS:
+        step_start = time.time()
+        importlib.import_module(name)
+        imports[name] = time.time() - step_start
+    from TsetseCheckout import settings
+    from TsetseCheckout.app import create_app
+    app = create_app(getattr(settings, config_name))
+    return OrderedDict([
+        ('imports', imports),
+        ('init', app.extensions['startup_timings']),
+        ('total', time.time() - start),
+    ])
+
+
+def profile(config_name, python=sys.executable):
+    '''Run :func:`measure` in a new interpreter, so nothing is imported
+    already, and return its result.
+    '''
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output(
+        [python, '-m', 'TsetseCheckout.startup', config_name],
+        cwd=project_root)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1],
+                      object_pairs_hook=OrderedDict)
+
+
+if __name__ == '__main__':
+    print(json.dumps(measure(sys.argv[1])))
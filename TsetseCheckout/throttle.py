@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''Throttling login attempts.
+
+Every login attempt takes a token from two buckets: one for the client's
+address and one for the username it tries from that address. Keying the
+second on the address as well means nobody can lock an account's owner out
+by failing to log in as them from elsewhere. A bucket holds
+``LOGIN_THROTTLE_IP_ATTEMPTS`` (or ``LOGIN_THROTTLE_USER_ATTEMPTS``) tokens
+and refills completely over ``LOGIN_THROTTLE_IP_PERIOD`` (or
+``LOGIN_THROTTLE_USER_PERIOD``) seconds. A successful login gives its tokens
+back, so only failures count against the limits.
+
+An attempt that finds either bucket empty is refused with a 429 before the
+database or bcrypt are touched, so a credential-stuffing burst can't keep
+every worker busy hashing.
+
+If ``LOGIN_THROTTLE_PATH`` is set the buckets are kept in that SQLite file,
+which every worker on the host opens (in WAL mode, like the ``sqlite`` cache
+backend), so the limits apply to the host rather than to each worker.
+Otherwise each worker keeps its own.
+'''
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+from TsetseCheckout.shared_sqlite import SharedSQLite, private_directory
+
+#: Attempts between removals of buckets that have refilled, which are the
+#: same as no bucket at all.
+PRUNE_EVERY = 256
+
+#: Characters of a username used in its bucket's key.
+MAX_USERNAME_LENGTH = 64
+
+LIMITS = ('ip', 'username')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS buckets ('
+    '  key TEXT PRIMARY KEY, tokens REAL NOT NULL,'
+    '  updated REAL NOT NULL, full_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_buckets_full_at ON buckets (full_at)',
+)
+
+
+class TooManyAttempts(TooManyRequests):
+    '''Raised for a login attempt over the limits.'''
+    description = ('Too many login attempts. Please wait a little before '
+                   'trying again.')
+
+    def __init__(self, retry_after, description=None):
+        TooManyRequests.__init__(self, description)
+        #: Seconds until the attempt would be allowed.
+        self.retry_after = int(math.ceil(retry_after))
+
+
+class TokenBuckets(object):
+    '''Token buckets that refill continuously. Subclasses decide where they
+    are kept.
+    '''
+
+    def __init__(self):
+        self._attempts = 0
+        self._attempts_lock = threading.Lock()
+
+    def take(self, limits, now=None):
+        '''Take one token from each bucket, or from none of them if any is
+        empty.
+
+        :param limits: ``(key, capacity, period)`` for each bucket.
+        :returns: ``(empty, wait)``: the keys of the empty buckets, and the
+            seconds until all of them have a token again. ``empty`` is an
+            empty list if the tokens were taken.
+        '''
+        now = time.time() if now is None else now
+        with self._transaction() as store:
+            stored = store.load([key for key, _, _ in limits])
+            levels = dict(
+                (key, _refill(stored.get(key), capacity, period, now))
+                for key, capacity, period in limits)
+            empty = [key for key, _, _ in limits if levels[key] < 1]
+            if empty:
+                wait = max((1 - levels[key]) * period / capacity
+                           for key, capacity, period in limits
+                           if key in empty)
+                return empty, wait
+            store.save([_row(key, levels[key] - 1, capacity, period, now)
+                        for key, capacity, period in limits])
+            if self._due_for_pruning():
+                store.prune(now)
+        return [], 0.0
+
+    def give_back(self, limits, now=None):
+        '''Return a token taken by :meth:`take` to each bucket.'''
+        now = time.time() if now is None else now
+        with self._transaction() as store:
+            stored = store.load([key for key, _, _ in limits])
+            store.save([
+                _row(key, min(capacity, _refill(stored.get(key), capacity,
+                                                period, now) + 1),
+                     capacity, period, now)
+                for key, capacity, period in limits])
+
+    def _due_for_pruning(self):
+        with self._attempts_lock:
+            self._attempts += 1
+            return self._attempts % PRUNE_EVERY == 0
+
+    def _transaction(self):
+        raise NotImplementedError()
+
+
+class MemoryBuckets(TokenBuckets):
+    '''Buckets in this process's memory.'''
+
+    def __init__(self):
+        TokenBuckets.__init__(self)
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, updated, full_at)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield self
+
+    def load(self, keys):
+        return dict((key, self._buckets[key]) for key in keys
+                    if key in self._buckets)
+
+    def save(self, rows):
+        for key, tokens, updated, full_at in rows:
+            self._buckets[key] = (tokens, updated, full_at)
+
+    def prune(self, now):
+        for key, (_, _, full_at) in list(self._buckets.items()):
+            if full_at <= now:
+                del self._buckets[key]
+
+
+class SQLiteBuckets(TokenBuckets):
+    '''Buckets in a SQLite file that every process on the host can share.
+
+    :param busy_timeout: Seconds to wait for another process's write.
+    '''
+
+    def __init__(self, path, busy_timeout=5):
+        TokenBuckets.__init__(self)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            private_directory(directory)
+        self._file = SharedSQLite(path, busy_timeout)
+        with self._transaction() as store:
+            for statement in _SCHEMA:
+                store.conn.execute(statement)
+
+    @contextmanager
+    def _transaction(self):
+        with self._file.transaction() as conn:
+            yield _SQLiteStore(conn)
+
+
+class _SQLiteStore(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def load(self, keys):
+        rows = self.conn.execute(
+            'SELECT key, tokens, updated, full_at FROM buckets '
+            'WHERE key IN ({0})'.format(', '.join('?' * len(keys))), keys)
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def save(self, rows):
+        self.conn.executemany('INSERT OR REPLACE INTO buckets '
+                              '(key, tokens, updated, full_at) '
+                              'VALUES (?, ?, ?, ?)', rows)
+
+    def prune(self, now):
+        self.conn.execute('DELETE FROM buckets WHERE full_at <= ?', (now,))
+
+
+def _refill(stored, capacity, period, now):
+    if stored is None:
+        return float(capacity)
+    tokens, updated = stored[0], stored[1]
+    return min(float(capacity),
+               tokens + max(now - updated, 0) * capacity / float(period))
+
+
+def _row(key, tokens, capacity, period, now):
+    full_at = now + (capacity - tokens) * period / float(capacity)
+    return (key, tokens, now, full_at)
+
+
+class LoginThrottle(object):
+    '''Applies the limits described in this module to login attempts.'''
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.ip_limit = (20, 60)
+        self.username_limit = (5, 300)
+        self.buckets = None
+        self._lock = threading.Lock()
+        self._reset_counts()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('LOGIN_THROTTLE_ENABLED', True)
+        self.ip_limit = (app.config.get('LOGIN_THROTTLE_IP_ATTEMPTS', 20),
+                         app.config.get('LOGIN_THROTTLE_IP_PERIOD', 60))
+        self.username_limit = (
+            app.config.get('LOGIN_THROTTLE_USER_ATTEMPTS', 5),
+            app.config.get('LOGIN_THROTTLE_USER_PERIOD', 300))
+        path = app.config.get('LOGIN_THROTTLE_PATH')
+        self.buckets = SQLiteBuckets(path) if path else MemoryBuckets()
+        self._reset_counts()
+        app.extensions['login_throttle'] = self
+
+    def _reset_counts(self):
+        with self._lock:
+            self._counts = dict(('rejected_' + limit, 0) for limit in LIMITS)
+            self._counts['allowed'] = 0
+
+    def attempt(self, username):
+        '''Count a login attempt for ``username`` from the current client.
+
+        :raises TooManyAttempts: if the client or the username is over its
+            limit. Nothing is counted then.
+        '''
+        if not self.enabled:
+            return
+        limits = self._limits(username)
+        empty, wait = self.buckets.take(limits)
+        with self._lock:
+            if not empty:
+                self._counts['allowed'] += 1
+            for key in empty:
+                self._counts['rejected_' + key.split(':', 1)[0]] += 1
+        if empty:
+            raise TooManyAttempts(wait)
+
+    def succeeded(self, username):
+        '''Give back the attempt counted for a login that succeeded.'''
+        if self.enabled:
+            self.buckets.give_back(self._limits(username))
+
+    def stats(self):
+        '''Attempts allowed and rejected (by the limit that was reached) in
+        this process.
+        '''
+        with self._lock:
+            return dict(self._counts)
+
+    def _limits(self, username):
+        username = (username or '').strip().lower()[:MAX_USERNAME_LENGTH]
+        address = request.remote_addr
+        return [('ip:{0}'.format(address),) + self.ip_limit,
+                ('username:{0}:{1}'.format(address, username),) +
+                self.username_limit]
+
+
+login_throttle = LoginThrottle()
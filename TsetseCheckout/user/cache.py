@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""In-process caches for user data."""
+import threading
+import time
+from collections import OrderedDict
+
+from flask.ext.login import UserMixin
+
+from TsetseCheckout.utils import BloomFilter
+
+
+class UserSnapshot(UserMixin):
+    """A detached, read-only copy of a :class:`User`, suitable for
+    ``current_user``. Load the ``User`` itself to change anything.
+    """
+    FIELDS = ('id', 'username', 'email', 'first_name', 'last_name',
+              'active', 'is_admin', 'created_at')
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, getattr(user, field))
+        object.__setattr__(self, 'role_names',
+                           tuple(role.name for role in user.roles))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UserSnapshot is read-only')
+
+    @property
+    def full_name(self):
+        return "{0} {1}".format(self.first_name, self.last_name)
+
+    def __repr__(self):
+        return '<UserSnapshot({username!r})>'.format(username=self.username)
+
+
+class UserCache(object):
+    """LRU cache of :class:`UserSnapshot` objects with a time-to-live.
+
+    The cache lives in one process, so writes made by another worker are only
+    seen once the entry expires. ``USER_CACHE_TTL`` bounds that staleness and
+    ``USER_CACHE_SIZE`` bounds memory; a size of ``0`` disables the cache.
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 0
+        self.ttl = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('USER_CACHE_SIZE', 1000)
+        self.ttl = app.config.get('USER_CACHE_TTL', 60)
+        self.invalidate()
+        self.hits = self.misses = 0
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id, loader):
+        """Return the snapshot for ``user_id``, calling ``loader(user_id)``
+        to fetch the user on a miss. Returns ``None`` for unknown users.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None and entry[0] > now:
+                self._entries[user_id] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        user = loader(user_id)
+        if user is None or self.maxsize <= 0:
+            return user
+        snapshot = UserSnapshot(user)
+        with self._lock:
+            # Don't store what we loaded if it was invalidated meanwhile.
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, snapshot)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id=None):
+        """Drop one user's snapshot, or every snapshot if ``user_id`` is
+        ``None``.
+        """
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+class UsernameFilter(object):
+    """Bloom filter of taken usernames, so "is this name free?" checks can
+    usually be answered without a query.
+
+    Names are lowercased. The filter is rebuilt from the database every
+    ``USERNAME_FILTER_TTL`` seconds to pick up other workers' registrations;
+    between rebuilds a name registered elsewhere may be reported free, which
+    ``RegisterForm`` still catches on submit.
+    """
+
+    def __init__(self, app=None):
+        self.capacity = 0
+        self.ttl = 0
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._expires_at = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.capacity = app.config.get('USERNAME_FILTER_CAPACITY', 100000)
+        self.ttl = app.config.get('USERNAME_FILTER_TTL', 300)
+        self.reset()
+        app.extensions['username_filter'] = self
+
+    def might_contain(self, username, load_usernames):
+        """Return False if ``username`` is certainly not taken.
+
+        :param load_usernames: Callable returning an iterable of every taken
+            username, used to (re)build the filter.
+        """
+        with self._lock:
+            if self._bloom is None or time.time() >= self._expires_at:
+                bloom = BloomFilter(self.capacity)
+                for taken in load_usernames():
+                    bloom.add(taken.lower())
+                self._bloom = bloom
+                self._expires_at = time.time() + self.ttl
+            return username.lower() in self._bloom
+
+    def add(self, username):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(username.lower())
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+
+
+user_cache = UserCache()
+username_filter = UsernameFilter()
@@ -2,6 +2,7 @@ from flask_wtf import Form
 from wtforms import TextField, PasswordField
 from wtforms.validators import DataRequired, Email, EqualTo, Length
 
+from TsetseCheckout.database import db
 from .models import User
 
 class RegisterForm(Form):
@@ -22,12 +23,22 @@ class RegisterForm(Form):
         initial_validation = super(RegisterForm, self).validate()
         if not initial_validation:
             return False
-        user = User.query.filter_by(username=self.username.data).first()
-        if user:
+        return self.check_unique()
+
+    def check_unique(self):
+        """Look up the username and email in a single query and add an error
+        to whichever field is taken, ignoring case.
+        """
+        username = self.username.data.lower()
+        email = self.email.data.lower()
+        lower_username = db.func.lower(User.username)
+        lower_email = db.func.lower(User.email)
+        taken = (db.session.query(lower_username, lower_email)
+                 .filter(db.or_(lower_username == username,
+                                lower_email == email))
+                 .all())
+        if any(row[0] == username for row in taken):
             self.username.errors.append("Username already registered")
-            return False
-        user = User.query.filter_by(email=self.email.data).first()
-        if user:
+        if any(row[1] == email for row in taken):
             self.email.errors.append("Email already registered")
-            return False
-        return True
\ No newline at end of file
+        return not taken
\ No newline at end of file
@@ -2,8 +2,11 @@
 import datetime as dt
 
 from flask.ext.login import UserMixin
+from sqlalchemy import event, inspect
 
-from TsetseCheckout.extensions import bcrypt
+from TsetseCheckout.caching import page_cache
+from TsetseCheckout.hashing import hashing_pool
+from TsetseCheckout.user.cache import user_cache, username_filter
 from TsetseCheckout.database import (
     Column,
     db,
@@ -23,6 +26,16 @@ class Role(SurrogatePK, Model):
     def __init__(self, name, **kwargs):
         db.Model.__init__(self, name=name, **kwargs)
 
+    def on_write(self):
+        # A role may have moved between users, so drop every snapshot.
+        user_cache.invalidate()
+        page_cache.invalidate()
+
+    @classmethod
+    def on_bulk_write(cls):
+        user_cache.invalidate()
+        page_cache.invalidate()
+
     def __repr__(self):
         return '<Role({name})>'.format(name=self.name)
 
@@ -39,6 +52,10 @@ class User(UserMixin, SurrogatePK, Model):
     active = Column(db.Boolean(), default=False)
     is_admin = Column(db.Boolean(), default=False)
 
+    #: Columns shown on cached pages (the nav and the member directory).
+    #: Changing anything else, like the password, leaves the page cache be.
+    PAGE_COLUMNS = ('username', 'first_name', 'last_name')
+
     def __init__(self, username, email, password=None, **kwargs):
         db.Model.__init__(self, username=username, email=email, **kwargs)
         if password:
@@ -47,14 +64,73 @@ class User(UserMixin, SurrogatePK, Model):
             self.password = None
 
     def set_password(self, password):
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = hashing_pool.generate_password_hash(password)
 
     def check_password(self, value):
-        return bcrypt.check_password_hash(self.password, value)
+        return hashing_pool.check_password_hash(self.password, value)
+
+    def password_needs_rehash(self):
+        """True if the stored hash uses another cost factor than the one
+        currently configured (see :meth:`HashingPool.needs_rehash`).
+        """
+        return bool(self.password) and hashing_pool.needs_rehash(self.password)
+
+    def on_write(self):
+        user_cache.invalidate(self.id)
+        state = inspect(self)
+        if state.deleted or state.was_deleted:
+            page_cache.invalidate()
+            return
+        username_filter.add(self.username)
+        # Set by _page_column_set for new users too.
+        if self.__dict__.pop('_page_stale', False):
+            page_cache.invalidate()
+
+    @classmethod
+    def on_bulk_write(cls):
+        user_cache.invalidate()
+        username_filter.reset()
+        page_cache.invalidate()
+
+    @classmethod
+    def username_available(cls, username):
+        """True if no user has ``username``, ignoring case. Usually answered
+        from :data:`username_filter` without touching the database.
+        """
+        if not username_filter.might_contain(username, cls._all_usernames):
+            return True
+        taken = db.session.query(cls.id).filter(
+            db.func.lower(cls.username) == username.lower()).first()
+        return taken is None
+
+    @classmethod
+    def _all_usernames(cls):
+        return (row.username for row in
+                db.session.query(cls.username).yield_per(1000))
 
     @property
     def full_name(self):
         return "{0} {1}".format(self.first_name, self.last_name)
 
     def __repr__(self):
-        return '<User({username!r})>'.format(username=self.username)
\ No newline at end of file
+        return '<User({username!r})>'.format(username=self.username)
+
+
+# Usernames and emails are unique regardless of case.
+db.Index('uq_users_username_lower', db.func.lower(User.username), unique=True)
+db.Index('uq_users_email_lower', db.func.lower(User.email), unique=True)
+# Keyset pagination of the member directory seeks on (created_at, id).
+db.Index('ix_users_created_at_id', User.created_at, User.id)
+# The member search's lower(...) text_pattern_ops indexes only exist on
+# PostgreSQL, so they are created by migration 8a4d0f2e6c17 alone.
+
+
+def _page_column_set(user, value, oldvalue, initiator):
+    if value != oldvalue:
+        user._page_stale = True
+
+
+for column in User.PAGE_COLUMNS:
+    # active_history loads the old value of an expired attribute to compare.
+    event.listen(getattr(User, column), 'set', _page_column_set,
+                 active_history=True)
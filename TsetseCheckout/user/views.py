@@ -1,12 +1,86 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, render_template
+from flask import Blueprint, abort, current_app, render_template, request
 from flask.ext.login import login_required
 
+from TsetseCheckout.database import (
+    InvalidCursor,
+    approximate_count,
+    db,
+    keyset_paginate,
+    use_replica,
+)
+from TsetseCheckout.caching import page_cache
+from TsetseCheckout.exports import export_response
+from TsetseCheckout.middleware import fresh_when
+from TsetseCheckout.user.models import User
+from TsetseCheckout.utils import admin_required
+
 blueprint = Blueprint("user", __name__, url_prefix='/users',
                         static_folder="../static")
 
+EXPORT_COLUMNS = ('id', 'username', 'email', 'first_name', 'last_name',
+                  'active', 'is_admin', 'created_at')
+
+# Every member sees the directory, so it leaves out email addresses.
+DIRECTORY_COLUMNS = ('id', 'username', 'first_name', 'last_name', 'created_at')
+
+#: Columns the directory search matches by prefix, case-insensitively.
+SEARCH_COLUMNS = ('username', 'first_name', 'last_name')
+
+#: Sort name -> (columns to seek on, descending)
+SORTS = {
+    'newest': (('created_at', 'id'), True),
+    'oldest': (('created_at', 'id'), False),
+    'username': (('username', 'id'), False),
+}
+
 
 @blueprint.route("/")
+@use_replica
 @login_required
+@fresh_when(page_cache.generation)  # Bumped when a listed user changes
 def members():
-    return render_template("users/members.html")
\ No newline at end of file
+    users = User.__table__
+    search = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'newest')
+    if sort not in SORTS:
+        sort = 'newest'
+    order_by, descending = SORTS[sort]
+
+    select = db.select([users.c[column] for column in DIRECTORY_COLUMNS])
+    whereclause = _search_clause(users, search) if search else None
+    if whereclause is not None:
+        select = select.where(whereclause)
+    try:
+        page = keyset_paginate(
+            select, [users.c[column] for column in order_by],
+            per_page=current_app.config['MEMBERS_PER_PAGE'],
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            descending=descending)
+    except InvalidCursor:
+        abort(400)
+    total = approximate_count(
+        users, whereclause, cache_key='members:count:{0}'.format(search.lower()),
+        timeout=current_app.config['MEMBER_COUNT_TTL'])
+    return render_template("users/members.html", page=page, total=total,
+                           search=search, sort=sort, sorts=sorted(SORTS))
+
+
+def _search_clause(users, search):
+    # Prefix matches only; on PostgreSQL they can use the lower(...)
+    # text_pattern_ops indexes (SQLite scans the table either way).
+    pattern = (search.lower().replace('\\', '\\\\')
+               .replace('%', '\\%').replace('_', '\\_')) + '%'
+    return db.or_(*[db.func.lower(users.c[column]).like(pattern, escape='\\')
+                    for column in SEARCH_COLUMNS])
+
+
+@blueprint.route("/export.<any(csv, jsonl):fmt>")
+@use_replica
+@admin_required
+def export(fmt):
+    users = User.__table__
+    select = (db.select([users.c[column] for column in EXPORT_COLUMNS])
+              .order_by(users.c.id))
+    return export_response(select, EXPORT_COLUMNS, fmt, 'users')
@@ -1,10 +1,74 @@
 # -*- coding: utf-8 -*-
 '''Helper utilities and decorators.'''
-from flask import flash
+import errno
+import hashlib
+import math
+import os
+import struct
+from functools import wraps
+
+from flask import abort, flash
+from flask.ext.login import current_user
+
+from .compat import text_type
 
 def flash_errors(form, category="warning"):
     '''Flash all errors for a form.'''
     for field, errors in form.errors.items():
         for error in errors:
             flash("{0} - {1}"
-                    .format(getattr(form, field).label.text, error), category)
\ No newline at end of file
+                    .format(getattr(form, field).label.text, error), category)
+
+
+def admin_required(func):
+    '''Like ``login_required``, but the user must also be an admin.
+    Anyone else gets a 403.
+    '''
+    @wraps(func)
+    def decorated_view(*args, **kwargs):
+        if not (current_user.is_authenticated() and
+                getattr(current_user, 'is_admin', False)):
+            abort(403)
+        return func(*args, **kwargs)
+    return decorated_view
+
+
+def process_is_running(pid):
+    '''Whether a process with this id exists on the host.'''
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+class BloomFilter(object):
+    '''A fixed-size set of strings that can answer "definitely not here"
+    without storing the strings. Membership tests may give false positives at
+    roughly ``error_rate`` once ``capacity`` items are added, never false
+    negatives.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hash_count = max(1, int(round(self.size / float(capacity) *
+                                           math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        if isinstance(value, text_type):
+            value = value.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(value).digest())
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(value))
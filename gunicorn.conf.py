@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings for production workers.
+
+The app is imported and created once in the master and then forked, so
+workers start in milliseconds and share its memory. ``post_fork`` gives each
+worker its own database connections, and ``worker_exit`` writes its buffered
+audit events.
+"""
+import os
+
+bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', '5000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+preload_app = True
+
+
+def on_starting(server):
+    # Counters from the last deployment's workers would be added to ours.
+    from TsetseCheckout.metrics import clear_directory
+    metrics_dir = server.app.wsgi().config.get('METRICS_DIR')
+    if metrics_dir:
+        clear_directory(metrics_dir)
+
+
+def post_fork(server, worker):
+    from TsetseCheckout.app import after_fork
+    after_fork(server.app.wsgi())
+
+
+def worker_exit(server, worker):
+    # Write the audit events still buffered; atexit may not get the chance.
+    from TsetseCheckout.audit.log import audit_log
+    audit_log.shutdown()
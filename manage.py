@@ -1,29 +1,52 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import os
 import sys
 import subprocess
-from flask.ext.script import Manager, Shell, Server
-from flask.ext.migrate import MigrateCommand
+from flask import current_app
+from flask.ext.script import Command, Manager, Option, Shell, Server
+from flask.ext.migrate import Migrate, MigrateCommand
 
 from TsetseCheckout.app import create_app
+from TsetseCheckout.assets import build_assets
+from TsetseCheckout.audit.models import AuditEvent
+from TsetseCheckout.jobs.models import Job
+from TsetseCheckout.jobs.worker import Worker
+from TsetseCheckout.samples.manifest import import_manifest
+from TsetseCheckout.samples.models import Checkout, Sample, StorageBox
 from TsetseCheckout.user.models import User
 from TsetseCheckout.settings import DevConfig, ProdConfig
 from TsetseCheckout.database import db
+from TsetseCheckout.hashing import calibrate_log_rounds
+from TsetseCheckout import loadtest
+from TsetseCheckout.profiling import HEADER as PROFILE_HEADER, profiler
+from TsetseCheckout.startup import profile as profile_startup
 
-if os.environ.get("TSETSECHECKOUT_ENV") == 'prod':
-    app = create_app(ProdConfig)
-else:
-    app = create_app(DevConfig)
-
-manager = Manager(app)
 TEST_CMD = "py.test tests"
 
+def _create_app(env=None):
+    """Create the app for a command. Web workers don't need the migration
+    commands, so only this script sets up Flask-Migrate.
+    """
+    if (env or os.environ.get("TSETSECHECKOUT_ENV")) == 'prod':
+        app = create_app(ProdConfig)
+    else:
+        app = create_app(DevConfig)
+    Migrate(app, db)
+    return app
+
+manager = Manager(_create_app)
+manager.add_option('-e', '--env', dest='env', required=False,
+                   help='"prod" or "dev" (default: $TSETSECHECKOUT_ENV)')
+
 def _make_context():
     """Return context dict for a shell session so you can access
-    app, db, and the User model by default.
+    app, db, and the models by default.
     """
-    return {'app': app, 'db': db, 'User': User}
+    return {'app': current_app._get_current_object(), 'db': db, 'User': User,
+            'Sample': Sample, 'StorageBox': StorageBox, 'Checkout': Checkout,
+            'AuditEvent': AuditEvent, 'Job': Job}
 
 @manager.command
 def test():
@@ -32,9 +55,188 @@ def test():
     exit_code = pytest.main(['tests', '--verbose'])
     return exit_code
 
+@manager.option('-b', '--budget', dest='budget', type=float, default=None,
+                help='Seconds one hash may take (default: BCRYPT_LATENCY_BUDGET)')
+def calibrate(budget=None):
+    """Benchmark bcrypt and print the highest cost within the latency budget.
+    Run once per deploy and set the result in the environment; workers don't
+    calibrate themselves.
+    """
+    if budget is None:
+        budget = current_app.config['BCRYPT_LATENCY_BUDGET']
+    rounds = calibrate_log_rounds(
+        budget,
+        min_rounds=current_app.config['BCRYPT_MIN_LOG_ROUNDS'],
+        max_rounds=current_app.config['BCRYPT_MAX_LOG_ROUNDS'],
+    )
+    print("export TSETSECHECKOUT_BCRYPT_LOG_ROUNDS={0}  # for a budget of "
+          "{1}s".format(rounds, budget))
+
+class LoadTest(Command):
+    """Simulate concurrent users and write a JSON latency report.
+
+    In-process runs register users and create LOADTEST samples in the
+    configured database, so they need --allow-writes; the rows are deleted
+    afterwards unless --keep is given.
+    """
+
+    option_list = (
+        Option('-u', '--users', dest='users', type=int, default=10),
+        Option('-d', '--duration', dest='duration', type=float, default=30,
+               help='Seconds to run for'),
+        Option('--url', dest='url', default=None,
+               help='Server to load, e.g. http://127.0.0.1:8000 '
+                    '(default: this app, in-process)'),
+        Option('-o', '--output', dest='output', default='loadtest.json'),
+        Option('--samples', dest='samples', type=int, default=100,
+               help='Samples to create for the checkout flow (in-process)'),
+        Option('--barcode', dest='barcodes', action='append', default=[],
+               help='A barcode the checkout flow may use (with --url)'),
+        Option('--seed', dest='seed', type=int, default=None),
+        Option('--allow-writes', dest='allow_writes', action='store_true',
+               help='Let an in-process run write users and samples to the '
+                    'configured database'),
+        Option('--keep', dest='keep', action='store_true',
+               help="Don't delete them afterwards"),
+    )
+
+    def run(self, users, duration, url, output, samples, barcodes, seed,
+            allow_writes, keep):
+        if url:
+            make_session = lambda: loadtest.HTTPSession(url)
+        elif not allow_writes:
+            print("An in-process run writes users and samples to {0}; pass "
+                  "--allow-writes to go ahead, or --url to load a "
+                  "server".format(
+                      current_app.config['SQLALCHEMY_DATABASE_URI']))
+            sys.exit(1)
+        else:
+            app = current_app._get_current_object()
+            make_session = lambda: loadtest.WSGISession(app)
+            barcodes = loadtest.seed_samples(samples) if samples else []
+        print("Running {0} users for {1:.0f}s against {2}".format(
+            users, duration, url or 'the app in-process'))
+        try:
+            report = loadtest.run(make_session, users=users,
+                                  duration=duration, barcodes=barcodes,
+                                  seed=seed)
+        finally:
+            if not url and not keep:
+                print("Deleted {0} users and {1} samples".format(
+                    *loadtest.cleanup()))
+        report['target'] = url or 'in-process'
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        for name, summary in sorted(report['requests_by_name'].items()):
+            print("{0:<18} {1:6d} requests {2:6.1%} errors  p50 {3:7.1f} ms"
+                  "  p95 {4:7.1f} ms  p99 {5:7.1f} ms".format(
+                      name, summary['requests'], summary['error_rate'],
+                      summary['latency']['p50'] * 1000,
+                      summary['latency']['p95'] * 1000,
+                      summary['latency']['p99'] * 1000))
+        print("{0} requests at {1:.1f}/s, {2:.1%} errors; report written "
+              "to {3}".format(report['requests'], report['throughput'],
+                              report['error_rate'], output))
+
+class ProfileToken(Command):
+    """Print a header that makes the request sent with it be profiled."""
+
+    option_list = (
+        Option('-m', '--mode', dest='mode', choices=('sample', 'cprofile'),
+               default=None, help='Defaults to PROFILE_MODE'),
+    )
+
+    def run(self, mode):
+        print("{0}: {1}".format(PROFILE_HEADER, profiler.make_token(mode)))
+
+class StartupProfile(Command):
+    """Time a cold start, each import and extension, in a new process."""
+
+    option_list = (
+        Option('-c', '--config', dest='config', default='ProdConfig',
+               help='Settings class to start with (default: ProdConfig)'),
+        Option('-b', '--budget', dest='budget', type=float, default=None,
+               help='Seconds allowed (default: STARTUP_BUDGET)'),
+    )
+
+    def run(self, config, budget):
+        if budget is None:
+            budget = current_app.config['STARTUP_BUDGET']
+        timings = profile_startup(config)
+        for section in ('imports', 'init'):
+            print("{0}:".format(section))
+            for name, seconds in timings[section].items():
+                print("  {0:<24} {1:8.1f} ms".format(name, seconds * 1000))
+        total = timings['total']
+        print("total: {0:.1f} ms (budget {1:.1f} ms)".format(total * 1000,
+                                                            budget * 1000))
+        if total > budget:
+            print("Over budget by {0:.1f} ms".format((total - budget) * 1000))
+            sys.exit(1)
+
+class ImportManifest(Command):
+    """Stream a CSV or JSON-lines sample manifest into the database."""
+
+    option_list = (
+        Option('path', help='Manifest file'),
+        Option('-f', '--format', dest='fmt', choices=('csv', 'jsonl'),
+               default=None, help='Defaults to guessing from the extension'),
+        Option('-c', '--chunk-size', dest='chunk_size', type=int, default=1000,
+               help='Records per transaction'),
+        Option('--restart', dest='restart', action='store_true', default=False,
+               help='Ignore the checkpoint and start from the first record'),
+    )
+
+    def run(self, path, fmt, chunk_size, restart):
+        def progress(stats):
+            print("{0} records read, {1} imported, {2} invalid "
+                  "({3:.0f} records/s)".format(stats.position, stats.imported,
+                                               stats.invalid, stats.rate))
+        if not restart and os.path.exists(path + '.checkpoint'):
+            print("Resuming from {0}.checkpoint".format(path))
+        stats = import_manifest(path, fmt=fmt, chunk_size=chunk_size,
+                                restart=restart, progress=progress)
+        for number, message in stats.errors:
+            print("Record {0}: {1}".format(number + 1, message))
+        print("Done: {0} imported, {1} invalid in {2:.1f}s "
+              "({3:.0f} records/s)".format(stats.imported, stats.invalid,
+                                           stats.elapsed, stats.rate))
+
+class RunWorker(Command):
+    """Run queued background jobs in a pool of processes."""
+
+    option_list = (
+        Option('-c', '--concurrency', dest='concurrency', type=int,
+               default=None, help='Processes (default: JOBS_CONCURRENCY)'),
+        Option('--burst', dest='burst', action='store_true', default=False,
+               help='Exit once no jobs are due'),
+    )
+
+    def run(self, concurrency, burst):
+        worker = Worker(current_app._get_current_object(),
+                        concurrency=concurrency, burst=burst)
+        print("Running jobs in {0} processes; Ctrl-C to stop after the "
+              "current jobs, twice to stop now".format(worker.concurrency))
+        worker.run()
+
+AssetsCommand = Manager(usage="Build static assets")
+
+@AssetsCommand.option('-d', '--dist-dir', dest='dist_dir', default=None)
+def build(dist_dir=None):
+    """Compile the bundles into hashed, precompressed files."""
+    manifest = build_assets(current_app, dist_dir)
+    for name, filename in sorted(manifest.items()):
+        print("{0}: {1}".format(name, filename))
+
 manager.add_command('server', Server())
 manager.add_command('shell', Shell(make_context=_make_context))
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', ImportManifest())
+manager.add_command('assets', AssetsCommand)
+manager.add_command('startup-profile', StartupProfile())
+manager.add_command('profile-token', ProfileToken())
+manager.add_command('loadtest', LoadTest())
+manager.add_command('worker', RunWorker())
 
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""Case-insensitive unique indexes on users
+
+Revision ID: 3f6c2a9d81b4
+Revises: 1dd5927cfb51
+Create Date: 2026-10-18 09:12:40.118302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6c2a9d81b4'
+down_revision = '1dd5927cfb51'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE UNIQUE INDEX uq_users_username_lower '
+               'ON users (lower(username))')
+    op.execute('CREATE UNIQUE INDEX uq_users_email_lower '
+               'ON users (lower(email))')
+
+
+def downgrade():
+    op.drop_index('uq_users_email_lower', 'users')
+    op.drop_index('uq_users_username_lower', 'users')
@@ -0,0 +1,62 @@
+"""Storage boxes, samples and checkouts
+
+Revision ID: 52e1b7c0d3a9
+Revises: 3f6c2a9d81b4
+Create Date: 2026-10-18 10:41:07.562184
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52e1b7c0d3a9'
+down_revision = '3f6c2a9d81b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('storage_boxes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('location', sa.String(length=120), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('samples',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('barcode', sa.String(length=64), nullable=False),
+    sa.Column('box_id', sa.Integer(), nullable=True),
+    sa.Column('position', sa.String(length=10), nullable=True),
+    sa.Column('species', sa.String(length=80), nullable=True),
+    sa.Column('collection_site', sa.String(length=120), nullable=True),
+    sa.Column('collected_on', sa.Date(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['box_id'], ['storage_boxes.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('barcode')
+    )
+    op.create_table('checkouts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sample_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('checked_out_at', sa.DateTime(), nullable=False),
+    sa.Column('returned_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['sample_id'], ['samples.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_checkouts_sample_id_returned_at', 'checkouts',
+                    ['sample_id', 'returned_at'])
+    op.create_index('ix_checkouts_user_id_checked_out_at', 'checkouts',
+                    ['user_id', 'checked_out_at'])
+
+
+def downgrade():
+    op.drop_index('ix_checkouts_user_id_checked_out_at', 'checkouts')
+    op.drop_index('ix_checkouts_sample_id_returned_at', 'checkouts')
+    op.drop_table('checkouts')
+    op.drop_table('samples')
+    op.drop_table('storage_boxes')
@@ -0,0 +1,37 @@
+"""Indexes for keyset pagination on (created_at, id) and member search
+
+Revision ID: 8a4d0f2e6c17
+Revises: 52e1b7c0d3a9
+Create Date: 2026-10-18 14:05:22.904716
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a4d0f2e6c17'
+down_revision = '52e1b7c0d3a9'
+
+from alembic import op
+import sqlalchemy as sa
+
+# The member directory searches these by prefix.
+SEARCH_COLUMNS = ('username', 'first_name', 'last_name')
+
+
+def upgrade():
+    op.create_index('ix_users_created_at_id', 'users', ['created_at', 'id'])
+    op.create_index('ix_samples_created_at_id', 'samples',
+                    ['created_at', 'id'])
+    if op.get_bind().dialect.name == 'postgresql':
+        # LIKE 'prefix%' can't use the default operator class unless the
+        # database collation is C.
+        for column in SEARCH_COLUMNS:
+            op.execute('CREATE INDEX ix_users_{0}_lower_pattern ON users '
+                       '(lower({0}) text_pattern_ops)'.format(column))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for column in SEARCH_COLUMNS:
+            op.drop_index('ix_users_{0}_lower_pattern'.format(column), 'users')
+    op.drop_index('ix_samples_created_at_id', 'samples')
+    op.drop_index('ix_users_created_at_id', 'users')
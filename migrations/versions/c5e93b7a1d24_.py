@@ -0,0 +1,46 @@
+"""Audit log of logins and checkouts
+
+Revision ID: c5e93b7a1d24
+Revises: 8a4d0f2e6c17
+Create Date: 2026-10-18 16:42:09.318205
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e93b7a1d24'
+down_revision = '8a4d0f2e6c17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('audit_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('event_id', sa.String(length=32), nullable=False),
+    sa.Column('action', sa.String(length=20), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('sample_id', sa.Integer(), nullable=True),
+    sa.Column('username', sa.String(length=80), nullable=True),
+    sa.Column('remote_addr', sa.String(length=45), nullable=True),
+    sa.Column('detail', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('event_id')
+    )
+    op.create_index('ix_audit_events_created_at', 'audit_events',
+                    ['created_at'])
+    op.create_index('ix_audit_events_user_id_created_at', 'audit_events',
+                    ['user_id', 'created_at'])
+    op.create_index('ix_audit_events_sample_id_created_at', 'audit_events',
+                    ['sample_id', 'created_at'])
+    op.create_index('ix_audit_events_username_created_at', 'audit_events',
+                    ['username', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_audit_events_username_created_at', 'audit_events')
+    op.drop_index('ix_audit_events_sample_id_created_at', 'audit_events')
+    op.drop_index('ix_audit_events_user_id_created_at', 'audit_events')
+    op.drop_index('ix_audit_events_created_at', 'audit_events')
+    op.drop_table('audit_events')
@@ -0,0 +1,46 @@
+"""Queue of background jobs
+
+Revision ID: e41b8c3f9a02
+Revises: c5e93b7a1d24
+Create Date: 2026-10-18 18:20:41.572093
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e41b8c3f9a02'
+down_revision = 'c5e93b7a1d24'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=200), nullable=False),
+    sa.Column('arguments', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('locked_by', sa.String(length=80), nullable=True),
+    sa.Column('locked_at', sa.DateTime(), nullable=True),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_status_priority_run_at', 'jobs',
+                    ['status', 'priority', 'run_at'])
+    op.create_index('ix_jobs_user_id_created_at', 'jobs',
+                    ['user_id', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_user_id_created_at', 'jobs')
+    op.drop_index('ix_jobs_status_priority_run_at', 'jobs')
+    op.drop_table('jobs')
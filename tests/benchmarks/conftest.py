@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""The ``benchmark`` fixture and the baseline it is checked against.
+
+Every benchmark records how many SQL statements one call makes and, with
+``--benchmarks``, how long it takes: the best of several rounds, each the
+mean of a few calls, as :mod:`timeit` does it. A test fails if a call makes
+more statements than the baseline says, or (with ``--benchmarks``) if it is
+more than ``--benchmark-tolerance`` slower.
+
+Timings depend on the machine, so regenerate the baseline on the machine
+that checks it::
+
+    py.test tests/benchmarks --benchmark-save
+"""
+import gc
+import json
+import os
+import timeit
+import warnings
+
+import pytest
+from sqlalchemy import event
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class Benchmark(object):
+
+    def __init__(self, name, engine, timed, baseline, tolerance, results):
+        self.name = name
+        self.engine = engine
+        self.timed = timed
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.results = results
+
+    def __call__(self, func, setup=None, rounds=10, number=10):
+        """Benchmark ``func``, calling ``setup`` (untimed) before each call.
+        One call is made first to warm up, so first-use work like loading
+        expired attributes isn't counted.
+
+        :returns: What the last call to ``func`` returned.
+        """
+        if not self.timed:
+            rounds = number = 1
+        if setup is not None:
+            setup()
+        func()
+        # Like timeit, keep collections from landing in random rounds.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            seconds, queries, result = self._run(func, setup, rounds, number)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        self.check(dict(seconds=round(seconds, 7), queries=queries))
+        return result
+
+    def _run(self, func, setup, rounds, number):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        best = None
+        result = None
+        for _ in range(rounds):
+            elapsed = 0.0
+            for _ in range(number):
+                if setup is not None:
+                    setup()
+                del statements[:]
+                event.listen(self.engine, 'before_cursor_execute', count)
+                start = timeit.default_timer()
+                try:
+                    result = func()
+                finally:
+                    elapsed += timeit.default_timer() - start
+                    event.remove(self.engine, 'before_cursor_execute', count)
+            mean = elapsed / number
+            best = mean if best is None else min(best, mean)
+        return best, len(statements), result
+
+    def check(self, measured):
+        self.results[self.name] = measured
+        expected = self.baseline.get(self.name)
+        if expected is None:
+            warnings.warn('No baseline for benchmark {0}'.format(self.name))
+            return
+        assert measured['queries'] <= expected['queries'], (
+            '{0} made {1} queries, the baseline is {2}'.format(
+                self.name, measured['queries'], expected['queries']))
+        if self.timed:
+            limit = expected['seconds'] * (1 + self.tolerance)
+            assert measured['seconds'] <= limit, (
+                '{0} took {1:.6f}s, the baseline is {2:.6f}s (limit '
+                '{3:.6f}s)'.format(self.name, measured['seconds'],
+                                   expected['seconds'], limit))
+
+
+def _load_baseline():
+    if not os.path.exists(BASELINE):
+        return {}
+    with open(BASELINE) as f:
+        return json.load(f)
+
+
+@pytest.yield_fixture(scope='session')
+def benchmark_results(request):
+    """Results of this run, written to the baseline with
+    ``--benchmark-save``.
+    """
+    results = {}
+    yield results
+    if request.config.getoption('benchmark_save') and results:
+        baseline = _load_baseline()
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture
+def benchmark(request, db, benchmark_results):
+    """Benchmarks a callable under the current test's name."""
+    config = request.config
+    timed = (config.getoption('benchmarks') or
+             config.getoption('benchmark_save'))
+    baseline = {} if config.getoption('benchmark_save') else _load_baseline()
+    name = request.node.name
+    if name.startswith('test_'):
+        name = name[len('test_'):]
+    return Benchmark(name, db.engine, timed, baseline,
+                     config.getoption('benchmark_tolerance'),
+                     benchmark_results)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the code every request or login goes through."""
+import itertools
+
+import pytest
+from flask import render_template
+
+from TsetseCheckout.assets import build_assets
+from TsetseCheckout.caching import page_cache
+from TsetseCheckout.public.forms import LoginForm
+from TsetseCheckout.public.views import load_user
+from TsetseCheckout.user.cache import user_cache
+from TsetseCheckout.user.forms import RegisterForm
+from TsetseCheckout.user.models import Role, User
+
+
+class TestPasswords:
+
+    def test_check_password(self, user, benchmark):
+        assert benchmark(lambda: user.check_password('myprecious'))
+
+    def test_set_password(self, user, benchmark):
+        benchmark(lambda: user.set_password('newsecret'))
+
+
+class TestForms:
+
+    def test_login_form_validate(self, user, benchmark):
+        def validate():
+            return LoginForm(username=user.username,
+                             password='myprecious').validate()
+        assert benchmark(validate)
+
+    def test_register_form_validate(self, user, benchmark):
+        def validate():
+            return RegisterForm(username='unique', email='foo@bar.com',
+                                password='example',
+                                confirm='example').validate()
+        assert benchmark(validate)
+
+
+class TestUserLoading:
+
+    def test_load_user_cached(self, user, benchmark):
+        load_user(str(user.id))
+        assert benchmark(lambda: load_user(str(user.id))).id == user.id
+
+    def test_load_user_uncached(self, db, user, benchmark):
+        user.roles.append(Role('admin'))
+        db.session.commit()
+        user_id = str(user.id)
+
+        def forget():
+            user_cache.invalidate()
+            db.session.expunge_all()
+        assert benchmark(lambda: load_user(user_id),
+                         setup=forget).role_names == ('admin',)
+
+
+class TestCRUD:
+
+    def test_create(self, db, benchmark):
+        names = ('bench{0}'.format(i) for i in itertools.count())
+
+        def create():
+            username = next(names)
+            return User.create(username=username,
+                               email=username + '@example.com')
+        assert benchmark(create).id
+
+    def test_save(self, user, benchmark):
+        names = ('name{0}'.format(i) for i in itertools.count())
+
+        def save():
+            user.first_name = next(names)
+            return user.save()
+        benchmark(save)
+
+    def test_get_by_id(self, db, user, benchmark):
+        user_id = user.id
+        assert benchmark(lambda: User.get_by_id(user_id),
+                         setup=db.session.expunge_all).id == user_id
+
+
+class TestRendering:
+
+    def test_render_layout(self, db, benchmark):
+        render_template('layout.html')  # Builds the bundles and fragments
+        assert '</html>' in benchmark(lambda: render_template('layout.html'))
+
+    def test_render_layout_uncached(self, db, benchmark, monkeypatch):
+        render_template('layout.html')
+        monkeypatch.setattr(page_cache, 'enabled', False)
+        assert '</html>' in benchmark(lambda: render_template('layout.html'))
+
+
+class TestAssets:
+
+    def test_build_assets(self, app, tmpdir, benchmark):
+        pytest.importorskip('cssmin')
+        pytest.importorskip('jsmin')
+        manifest = benchmark(lambda: build_assets(app, str(tmpdir)),
+                             rounds=3, number=1)
+        assert sorted(manifest) == ['css_all', 'js_all']
@@ -3,6 +3,7 @@
 import os
 
 import pytest
+from sqlalchemy import event
 from webtest import TestApp
 
 from TsetseCheckout.settings import TestConfig
@@ -11,6 +12,18 @@ from TsetseCheckout.database import db as _db
 
 from .factories import UserFactory
 
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--benchmarks', action='store_true',
+                    help='Time the benchmarks in tests/benchmarks and fail '
+                         'on regressions against the baseline.')
+    group.addoption('--benchmark-save', action='store_true',
+                    help='Write the benchmark results to the baseline.')
+    group.addoption('--benchmark-tolerance', type=float, default=0.5,
+                    help='How much slower than the baseline a benchmark '
+                         'may be (default 0.5, i.e. 50%%).')
+
 @pytest.yield_fixture(scope='function')
 def app():
     _app = create_app(TestConfig)
@@ -41,4 +54,17 @@ def db(app):
 def user(db):
     user = UserFactory(password='myprecious')
     db.session.commit()
-    return user
\ No newline at end of file
+    return user
+
+
+@pytest.yield_fixture
+def queries(db):
+    """A list that collects every SQL statement run while the test executes."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
-from factory import Sequence, PostGenerationMethodCall
+from factory import Sequence, SubFactory, PostGenerationMethodCall
 from factory.alchemy import SQLAlchemyModelFactory
 
+from TsetseCheckout.samples.models import Sample, StorageBox
 from TsetseCheckout.user.models import User
 from TsetseCheckout.database import db
 
@@ -20,3 +21,20 @@ class UserFactory(BaseFactory):
 
     class Meta:
         model = User
+
+
+class StorageBoxFactory(BaseFactory):
+    name = Sequence(lambda n: "box{0}".format(n))
+    location = "Freezer 1, Rack A"
+
+    class Meta:
+        model = StorageBox
+
+
+class SampleFactory(BaseFactory):
+    barcode = Sequence(lambda n: "TS{0:06d}".format(n))
+    box = SubFactory(StorageBoxFactory)
+    species = "Glossina fuscipes fuscipes"
+
+    class Meta:
+        model = Sample
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Tests for build-time asset compilation."""
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from TsetseCheckout.assets import asset_manifest, build_assets
+
+pytest.importorskip('cssmin')
+pytest.importorskip('jsmin')
+
+
+@pytest.fixture
+def dist_dir(app, tmpdir):
+    dist_dir = str(tmpdir.join('dist'))
+    build_assets(app, dist_dir)
+    app.config.update(ASSETS_DIST_DIR=dist_dir, ASSETS_USE_MANIFEST=True)
+    asset_manifest.init_app(app)
+    return dist_dir
+
+
+class TestBuild:
+
+    def test_writes_hashed_and_compressed_files(self, app, tmpdir):
+        dist_dir = str(tmpdir)
+        manifest = build_assets(app, dist_dir)
+        assert sorted(manifest) == ['css_all', 'js_all']
+        with open(os.path.join(dist_dir, 'manifest.json')) as f:
+            assert json.load(f) == manifest
+        css = manifest['css_all']
+        assert css.startswith('common.') and css.endswith('.css')
+        with open(os.path.join(dist_dir, css), 'rb') as f:
+            data = f.read()
+        with gzip.open(os.path.join(dist_dir, css + '.gz')) as f:
+            assert f.read() == data
+
+    def test_same_content_same_files(self, app, tmpdir):
+        first = build_assets(app, str(tmpdir.join('a')))
+        second = build_assets(app, str(tmpdir.join('b')))
+        assert first == second
+        name = first['js_all'] + '.gz'
+        assert (tmpdir.join('a', name).read_binary() ==
+                tmpdir.join('b', name).read_binary())
+
+    def test_falls_back_without_manifest(self, app, tmpdir):
+        app.config.update(ASSETS_DIST_DIR=str(tmpdir),
+                          ASSETS_USE_MANIFEST=True)
+        asset_manifest.init_app(app)
+        assert asset_manifest.manifest is None
+        url, = asset_manifest.urls('css_all')
+        assert url.startswith('/static/')
+
+
+class TestServing:
+
+    def test_pages_link_hashed_files(self, dist_dir, testapp):
+        manifest = asset_manifest.manifest
+        res = testapp.get('/about/')
+        assert '/assets/{0}'.format(manifest['css_all']) in res
+        assert '/assets/{0}'.format(manifest['js_all']) in res
+
+    def test_serves_precompressed_with_far_future_headers(self, app,
+                                                          dist_dir):
+        filename = asset_manifest.manifest['css_all']
+        res = app.test_client().get('/assets/' + filename,
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.mimetype == 'text/css'
+        assert 'immutable' in res.headers['Cache-Control']
+        assert 'max-age=31536000' in res.headers['Cache-Control']
+        with open(os.path.join(dist_dir, filename), 'rb') as f:
+            assert gzip.GzipFile(fileobj=io.BytesIO(res.data)).read() == f.read()
+
+    def test_serves_identity_without_accept_encoding(self, app, dist_dir):
+        filename = asset_manifest.manifest['js_all']
+        res = app.test_client().get('/assets/' + filename)
+        assert 'Content-Encoding' not in res.headers
+        assert res.headers['Vary'] == 'Accept-Encoding'
+
+    def test_only_serves_built_files(self, dist_dir, testapp):
+        res = testapp.get('/assets/manifest.json', expect_errors=True)
+        assert res.status_code == 404
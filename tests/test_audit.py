@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Tests for the write-behind audit log."""
+import datetime as dt
+import json
+import os
+
+import pytest
+from flask import url_for
+
+from TsetseCheckout.audit.log import audit_log
+from TsetseCheckout.audit.models import AuditEvent
+from TsetseCheckout.throttle import login_throttle
+from TsetseCheckout.utils import process_is_running
+from .factories import SampleFactory
+from .test_functional import log_in
+
+
+@pytest.fixture
+def spool_dir(app, tmpdir):
+    app.config['AUDIT_SPOOL_DIR'] = str(tmpdir.join('spool'))
+    audit_log.init_app(app)
+    return app.config['AUDIT_SPOOL_DIR']
+
+
+def dead_pid():
+    pid = 99999
+    while process_is_running(pid):
+        pid += 1
+    return pid
+
+
+def actions():
+    return [event.action for event in
+            AuditEvent.query.order_by(AuditEvent.id)]
+
+
+class TestAuditLog:
+
+    def test_buffers_until_flushed(self, db, queries):
+        audit_log.record(AuditEvent.LOGIN, user_id=1, username='foo')
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[1, 2])
+        assert queries == []
+        assert audit_log.flush() == 3
+        inserts = [q for q in queries if q.startswith('INSERT')]
+        assert len(inserts) == 1
+        assert actions() == ['login', 'checkout', 'checkout']
+        assert audit_log.flush() == 0
+
+    def test_flushes_when_the_batch_is_full(self, db):
+        audit_log.batch_size = 3
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[1, 2])
+        assert AuditEvent.query.count() == 0
+        audit_log.record(AuditEvent.RETURN, user_id=1, sample_ids=[1])
+        assert AuditEvent.query.count() == 3
+
+    def test_splits_statements_for_sqlite(self, db, queries):
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1,
+                         sample_ids=range(250))
+        audit_log.flush()
+        inserts = [q for q in queries if q.startswith('INSERT')]
+        assert len(inserts) == 3  # 999 variables / 9 columns = 111 rows
+        assert AuditEvent.query.count() == 250
+
+    def test_failed_flush_is_retried(self, db, monkeypatch):
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+
+        def fail(events):
+            raise RuntimeError('database is down')
+        monkeypatch.setattr(audit_log, '_insert', fail)
+        assert audit_log.flush() == 0
+        monkeypatch.undo()
+        audit_log.record(AuditEvent.LOGIN, user_id=2)
+        assert audit_log.flush() == 2
+        assert [e.user_id for e in AuditEvent.query] == [1, 2]
+
+    def test_failed_flush_caps_the_buffer(self, db, monkeypatch):
+        audit_log.max_buffer = 3
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[1, 2])
+
+        def fail(events):
+            raise RuntimeError('database is down')
+        monkeypatch.setattr(audit_log, '_insert', fail)
+        audit_log.flush()
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[3, 4])
+        audit_log.flush()
+        monkeypatch.undo()
+        assert audit_log.flush() == 3
+        assert [e.sample_id for e in AuditEvent.query] == [2, 3, 4]
+
+    def test_shutdown_flushes(self, db):
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+        audit_log.shutdown()
+        assert AuditEvent.query.count() == 1
+
+    def test_disabled(self, app, db):
+        app.config['AUDIT_ENABLED'] = False
+        audit_log.init_app(app)
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+        assert audit_log.flush() == 0
+
+
+class TestSpool:
+
+    def test_spools_until_flushed(self, db, spool_dir):
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[7])
+        path, = [os.path.join(spool_dir, name)
+                 for name in os.listdir(spool_dir)]
+        with open(path) as f:
+            event = json.loads(f.read())
+        assert event['sample_id'] == 7
+        audit_log.flush()
+        assert os.listdir(spool_dir) == []
+
+    def test_failed_flush_keeps_the_spool(self, db, spool_dir, monkeypatch):
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+
+        def fail(events):
+            raise RuntimeError('database is down')
+        monkeypatch.setattr(audit_log, '_insert', fail)
+        audit_log.flush()
+        audit_log.record(AuditEvent.LOGIN, user_id=2)
+        assert len(os.listdir(spool_dir)) == 2
+        monkeypatch.undo()
+        assert audit_log.flush() == 2
+        assert os.listdir(spool_dir) == []
+
+    def test_events_over_the_cap_stay_in_the_spool(self, db, spool_dir,
+                                                   monkeypatch):
+        audit_log.max_buffer = 3
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[1, 2])
+
+        def fail(events):
+            raise RuntimeError('database is down')
+        monkeypatch.setattr(audit_log, '_insert', fail)
+        audit_log.flush()
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[3, 4])
+        audit_log.flush()
+        assert audit_log._buffer == []
+        assert len(os.listdir(spool_dir)) == 2
+        monkeypatch.undo()
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+        assert audit_log.flush() == 5
+        assert sorted(e.sample_id for e in AuditEvent.query
+                      if e.sample_id) == [1, 2, 3, 4]
+        assert os.listdir(spool_dir) == []
+
+    def test_refuses_a_spool_others_can_write(self, app, tmpdir):
+        spool = tmpdir.mkdir('spool')
+        spool.chmod(0o777)
+        app.config['AUDIT_SPOOL_DIR'] = str(spool)
+        with pytest.raises(RuntimeError):
+            audit_log.init_app(app)
+
+    def test_recovers_events_of_dead_workers(self, db, spool_dir):
+        audit_log.record(AuditEvent.CHECKOUT, user_id=1, sample_ids=[1, 2])
+        path, = [os.path.join(spool_dir, name)
+                 for name in os.listdir(spool_dir)]
+        with open(path) as f:
+            lines = f.readlines()
+        # The first event made it to the database before the worker died
+        # in the middle of writing a third.
+        audit_log.flush()
+        AuditEvent.query.filter_by(sample_id=2).delete()
+        db.session.commit()
+        dead = os.path.join(spool_dir, '{0}.1.jsonl'.format(dead_pid()))
+        with open(dead, 'w') as f:
+            f.writelines(lines)
+            f.write('{"action": "check')
+
+        assert audit_log.recover() == 1
+        assert sorted(e.sample_id for e in AuditEvent.query) == [1, 2]
+        assert os.listdir(spool_dir) == []
+
+    def test_leaves_live_workers_alone(self, db, spool_dir):
+        audit_log.record(AuditEvent.LOGIN, user_id=1)
+        assert audit_log.recover() == 0
+        assert len(os.listdir(spool_dir)) == 1
+
+
+class TestSearch:
+
+    def test_filters(self, db):
+        start = dt.datetime(2026, 1, 1)
+        for i, (action, user_id, sample_id) in enumerate([
+                (AuditEvent.CHECKOUT, 1, 10),
+                (AuditEvent.RETURN, 1, 10),
+                (AuditEvent.CHECKOUT, 2, 11),
+                (AuditEvent.LOGIN, 2, None)]):
+            AuditEvent.create(event_id=str(i), action=action,
+                              user_id=user_id, sample_id=sample_id,
+                              created_at=start + dt.timedelta(days=i))
+        assert [e.action for e in AuditEvent.search(sample_id=10)] == [
+            'return', 'checkout']
+        assert [e.event_id for e in AuditEvent.search(user_id=2)] == [
+            '3', '2']
+        assert [e.event_id for e in AuditEvent.search(
+            start=start + dt.timedelta(days=1),
+            end=start + dt.timedelta(days=3))] == ['2', '1']
+        assert AuditEvent.search(user_id=1,
+                                 action=AuditEvent.CHECKOUT).count() == 1
+
+
+class TestHooks:
+
+    def test_logins(self, user, testapp):
+        testapp.extra_environ['REMOTE_ADDR'] = '10.0.0.1'
+        log_in(testapp, user)
+        testapp.get(url_for('public.logout'))
+        res = testapp.get('/')
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'wrong'
+        form.submit()
+        audit_log.flush()
+        login, failed = AuditEvent.query.order_by(AuditEvent.id)
+        assert (login.action, login.user_id) == ('login', user.id)
+        assert login.remote_addr == '10.0.0.1'
+        assert (failed.action, failed.user_id) == ('login_failed', user.id)
+        assert failed.detail == 'Invalid password'
+
+    def test_throttled_logins(self, app, user, testapp):
+        app.config['LOGIN_THROTTLE_USER_ATTEMPTS'] = 1
+        login_throttle.init_app(app)
+        for _ in range(2):
+            res = testapp.get('/')
+            form = res.forms['loginForm']
+            form['username'] = 'nobody'
+            form['password'] = 'guess'
+            form.submit(expect_errors=True)
+        audit_log.flush()
+        assert actions() == ['login_failed', 'login_throttled']
+        assert AuditEvent.search(username='nobody').count() == 2
+
+    def test_checkouts(self, db, user, testapp):
+        samples = [SampleFactory() for _ in range(2)]
+        db.session.commit()
+        barcodes = [sample.barcode for sample in samples]
+        log_in(testapp, user)
+        testapp.post_json(url_for('samples.checkout'),
+                          {'barcodes': barcodes + ['nope']})
+        testapp.post_json(url_for('samples.checkin'),
+                          {'barcodes': barcodes[:1]})
+        audit_log.flush()
+        events = AuditEvent.query.filter(
+            AuditEvent.sample_id.isnot(None)).order_by(AuditEvent.id).all()
+        assert [(e.action, e.sample_id, e.user_id) for e in events] == [
+            ('checkout', samples[0].id, user.id),
+            ('checkout', samples[1].id, user.id),
+            ('return', samples[0].id, user.id),
+        ]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Tests for the shared SQLite cache backend."""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from TsetseCheckout import cache_backends
+from TsetseCheckout.cache_backends import SQLiteCache
+from TsetseCheckout.extensions import cache
+from TsetseCheckout.shared_sqlite import private_directory
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('cache.sqlite'))
+
+
+def _set_in_child(path, key, value):
+    SQLiteCache(path).set(key, value)
+
+
+class TestSQLiteCache:
+
+    def test_round_trips_values(self, path):
+        c = SQLiteCache(path)
+        assert c.get('missing') is None
+        assert c.set('key', {'a': [1, 2]}) is True
+        assert c.get('key') == {'a': [1, 2]}
+        assert c.has('key')
+        assert c.delete('key') is True
+        assert c.get('key') is None
+
+    def test_expires_after_timeout(self, path):
+        c = SQLiteCache(path)
+        c.set('short', 1, timeout=0.01)
+        c.set('forever', 2, timeout=0)
+        time.sleep(0.02)
+        assert c.get('short') is None
+        assert c.get('forever') == 2
+        assert c.add('short', 3) is True
+        assert c.add('short', 4) is False
+        assert c.get('short') == 3
+
+    def test_shared_between_instances(self, path):
+        first, second = SQLiteCache(path), SQLiteCache(path)
+        first.set('key', 'value')
+        assert second.get('key') == 'value'
+        second.delete('key')
+        assert first.get('key') is None
+        first.set_many({'a': 1, 'b': 2})
+        second.clear()
+        assert first.get_many('a', 'b') == [None, None]
+
+    def test_shared_between_processes(self, path):
+        c = SQLiteCache(path)
+        child = multiprocessing.Process(target=_set_in_child,
+                                        args=(path, 'from-child', 42))
+        child.start()
+        child.join(10)
+        assert child.exitcode == 0
+        assert c.get('from-child') == 42
+
+    def test_inc_and_dec(self, path):
+        c = SQLiteCache(path)
+        assert c.inc('counter') == 1
+        assert c.inc('counter', 5) == 6
+        assert c.dec('counter', 2) == 4
+        assert SQLiteCache(path).get('counter') == 4
+
+    def test_evicts_least_recently_used(self, path, monkeypatch):
+        monkeypatch.setattr(cache_backends, 'PRUNE_EVERY', 1)
+        monkeypatch.setattr(cache_backends, 'TOUCH_INTERVAL', 0)
+        c = SQLiteCache(path, threshold=3)
+        for key in 'abc':
+            c.set(key, key)
+            time.sleep(0.01)
+        c.get('a')
+        c.set('d', 'd')
+        assert c.get('b') is None
+        assert c.get('a') == 'a'
+        stats = c.stats()
+        assert stats['evictions'] >= 1
+        assert stats['entries'] <= 3
+
+    def test_stats_are_summed_across_instances(self, path):
+        first, second = SQLiteCache(path), SQLiteCache(path)
+        first.set('key', 1)
+        first.get('key')
+        second.get('key')
+        second.get('missing')
+        first.stats()
+        stats = second.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+        assert stats['sets'] == 1
+        assert stats['hit_ratio'] == pytest.approx(2 / 3.0)
+
+    def test_key_prefix(self, path):
+        SQLiteCache(path, key_prefix='one_').set('key', 1)
+        assert SQLiteCache(path, key_prefix='two_').get('key') is None
+
+    def test_clear_keeps_other_prefixes(self, path):
+        one, two = SQLiteCache(path, key_prefix='a_'), SQLiteCache(path)
+        one.set('key', 1)
+        two.set('A_key', 2)
+        two.set('abkey', 3)
+        assert one.clear() is True
+        assert one.get('key') is None
+        assert (two.get('A_key'), two.get('abkey')) == (2, 3)
+
+    def test_reconnects_after_fork(self, path):
+        c = SQLiteCache(path)
+        c.set('key', 1)
+        conn = c._connection()
+        c._file._local.pid = -1  # as if inherited from a parent process
+        assert c._connection() is not conn
+        assert c.get('key') == 1
+
+
+class TestFlaskCacheIntegration:
+
+    def test_selected_by_cache_type(self, app, tmpdir):
+        app.config.update(CACHE_TYPE='TsetseCheckout.cache_backends.sqlite',
+                          CACHE_DIR=str(tmpdir.join('cache')))
+        cache.init_app(app)
+        assert isinstance(cache.cache, SQLiteCache)
+        cache.set('key', 'value')
+        assert cache.get('key') == 'value'
+        assert os.path.exists(str(tmpdir.join('cache', 'cache.sqlite')))
+        assert os.stat(str(tmpdir.join('cache'))).st_mode & 0o777 == 0o700
+
+    def test_refuses_a_directory_others_can_write(self, app, tmpdir):
+        shared = tmpdir.mkdir('shared')
+        shared.chmod(0o777)
+        app.config.update(CACHE_TYPE='TsetseCheckout.cache_backends.sqlite',
+                          CACHE_DIR=str(shared))
+        with pytest.raises(RuntimeError):
+            cache.init_app(app)
+        assert not shared.join('cache.sqlite').exists()
+
+    def test_refuses_a_directory_of_another_user(self, tmpdir, monkeypatch):
+        owner = os.stat(str(tmpdir)).st_uid
+        monkeypatch.setattr(os, 'getuid', lambda: owner + 1)
+        with pytest.raises(RuntimeError):
+            private_directory(str(tmpdir))
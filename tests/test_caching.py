@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Tests for page and fragment caching."""
+import re
+
+import pytest
+from flask import _request_ctx_stack, render_template_string, url_for
+from webtest import TestApp
+
+from TsetseCheckout.caching import CSRF_PLACEHOLDER, page_cache
+from TsetseCheckout.user.models import Role
+from .factories import UserFactory
+from .test_functional import log_in
+
+
+def cache_status(res):
+    return res.headers.get('X-Page-Cache')
+
+
+@pytest.mark.usefixtures('db')
+class TestPageCache:
+
+    def test_anonymous_pages_are_shared(self, app):
+        assert cache_status(TestApp(app).get('/about/')) == 'miss'
+        assert cache_status(TestApp(app).get('/about/')) == 'hit'
+
+    def test_varies_on_user(self, app, user):
+        other = UserFactory(password='myprecious')
+        other.save()
+        first, second = TestApp(app), TestApp(app)
+        log_in(first, user)
+        log_in(second, other)
+        assert cache_status(first.get('/about/')) == 'miss'
+        res = second.get('/about/')
+        assert cache_status(res) == 'miss'
+        assert other.username in res
+        res = first.get('/about/')
+        assert cache_status(res) == 'hit'
+        assert user.username in res
+        assert other.username not in res
+
+    def test_bypassed_while_messages_are_flashed(self, testapp, user):
+        testapp.get('/')
+        res = log_in(testapp, user)
+        testapp.get(url_for('public.logout'))
+        res = testapp.get('/')
+        assert 'You are logged out.' in res
+        assert cache_status(res) is None
+        assert 'You are logged out.' not in testapp.get('/')
+
+    def test_post_is_not_cached(self, testapp, user):
+        res = testapp.get('/')
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'wrong'
+        res = form.submit()
+        assert cache_status(res) is None
+
+    def test_model_write_invalidates(self, testapp, user):
+        log_in(testapp, user)
+        testapp.get('/about/')
+        assert cache_status(testapp.get('/about/')) == 'hit'
+        Role.create(name='curator', user=user)
+        assert cache_status(testapp.get('/about/')) == 'miss'
+
+    def test_only_shown_user_fields_invalidate(self, testapp, user):
+        user.save()  # The fixture commits the new user without saving it
+        log_in(testapp, user)
+        testapp.get('/about/')
+        user.set_password('rehashed')
+        user.active = not user.active
+        user.save()
+        assert cache_status(testapp.get('/about/')) == 'hit'
+        user.first_name = user.first_name
+        user.save()
+        assert cache_status(testapp.get('/about/')) == 'hit'
+        user.first_name = 'Renamed'
+        user.save()
+        assert cache_status(testapp.get('/about/')) == 'miss'
+
+    def test_new_and_deleted_users_invalidate(self, testapp, user):
+        testapp.get('/about/')
+        other = UserFactory()
+        other.save()
+        assert cache_status(testapp.get('/about/')) == 'miss'
+        other.delete()
+        assert cache_status(testapp.get('/about/')) == 'miss'
+
+    def test_deploy_changes_keys(self, app, testapp):
+        testapp.get('/about/')
+        app.config['RELEASE'] = 'next-release'
+        page_cache.init_app(app)
+        assert cache_status(testapp.get('/about/')) == 'miss'
+
+    def test_can_be_disabled(self, app, testapp):
+        app.config['PAGE_CACHE_ENABLED'] = False
+        page_cache.init_app(app)
+        testapp.get('/about/')
+        assert cache_status(testapp.get('/about/')) is None
+
+    def test_each_visitor_gets_their_own_csrf_token(self, app, user):
+        app.config['WTF_CSRF_ENABLED'] = True
+        # Flask-WTF keeps the token on ``g``; give each request its own.
+        username, ctx = user.username, _request_ctx_stack.top
+        ctx.pop()
+        try:
+            self.check_csrf_tokens(app, username)
+        finally:
+            ctx.push()
+
+    def check_csrf_tokens(self, app, username):
+        first, second = TestApp(app), TestApp(app)
+        first_res, second_res = first.get('/'), second.get('/')
+        assert cache_status(second_res) == 'hit'
+        tokens = [res.forms['loginForm']['csrf_token'].value
+                  for res in (first_res, second_res)]
+        assert tokens[0] != tokens[1]
+        assert CSRF_PLACEHOLDER not in tokens
+        form = second_res.forms['loginForm']
+        form['username'] = username
+        form['password'] = 'myprecious'
+        assert 'You are logged in.' in form.submit().follow()
+
+
+@pytest.mark.usefixtures('db')
+class TestFragmentCache:
+
+    TEMPLATE = ('{% cachefragment "counter", key %}'
+                '{{ counter.append(1) or counter|length }}'
+                '{% endcachefragment %}')
+
+    def test_renders_once_per_key(self):
+        counter = []
+        render = lambda key: render_template_string(
+            self.TEMPLATE, counter=counter, key=key)
+        assert render('a') == '1'
+        assert render('a') == '1'
+        assert render('b') == '2'
+        page_cache.invalidate()
+        assert render('a') == '3'
+
+    def test_strips_csrf_token(self, app):
+        app.config['WTF_CSRF_ENABLED'] = True
+        template = ('{% cachefragment "form" %}'
+                    '<input id="csrf_token" name="csrf_token" type="hidden" '
+                    'value="{{ token }}">{% endcachefragment %}')
+        render_template_string(template, token='secret')
+        html = render_template_string(template, token='secret')
+        assert 'secret' not in html
+        assert re.search(r'value="[^"]+"', html)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Tests for checking samples out and back in."""
+import pytest
+from sqlalchemy.orm.exc import StaleDataError
+
+from TsetseCheckout.samples.checkout import checkout_samples, return_samples
+from TsetseCheckout.samples.models import Checkout, Sample
+from .factories import SampleFactory
+
+
+def make_samples(db, count):
+    samples = [SampleFactory() for _ in range(count)]
+    db.session.commit()
+    return [sample.id for sample in samples]
+
+
+class TestCheckout:
+
+    def test_checks_out_available_samples(self, db, user):
+        ids = make_samples(db, 3)
+        results = checkout_samples(ids, user.id)
+        assert [r.ok for r in results] == [True, True, True]
+        assert all(s.status == Sample.CHECKED_OUT for s in Sample.query)
+        checkouts = Checkout.query.all()
+        assert sorted(c.sample_id for c in checkouts) == ids
+        assert all(c.user_id == user.id for c in checkouts)
+        assert all(c.returned_at is None for c in checkouts)
+
+    def test_does_not_double_book(self, db, user):
+        ids = make_samples(db, 2)
+        checkout_samples(ids[:1], user.id)
+        results = checkout_samples(ids, user.id)
+        assert results[0].ok is False
+        assert results[0].reason == 'unavailable'
+        assert results[1].ok is True
+        assert Checkout.query.filter_by(sample_id=ids[0]).count() == 1
+
+    def test_reports_unknown_samples(self, db, user):
+        ids = make_samples(db, 1)
+        results = checkout_samples([ids[0], 12345], user.id)
+        assert results[1] == (12345, False, 'unknown')
+
+    def test_duplicate_ids_are_claimed_once(self, db, user):
+        ids = make_samples(db, 1)
+        results = checkout_samples(ids + ids, user.id)
+        assert len(results) == 1
+        assert Checkout.query.count() == 1
+
+    def test_bumps_version(self, db, user):
+        ids = make_samples(db, 1)
+        version = Sample.get_by_id(ids[0]).version
+        checkout_samples(ids, user.id)
+        assert Sample.get_by_id(ids[0]).version == version + 1
+
+    def test_stale_orm_write_is_rejected(self, db, user):
+        ids = make_samples(db, 1)
+        sample = Sample.get_by_id(ids[0])
+        sample.species
+        checkout_samples(ids, user.id, commit=False)
+        sample.position = 'B2'
+        with pytest.raises(StaleDataError):
+            db.session.flush()
+        db.session.rollback()
+
+
+class TestReturn:
+
+    def test_returns_checked_out_samples(self, db, user):
+        ids = make_samples(db, 2)
+        checkout_samples(ids, user.id)
+        results = return_samples(ids)
+        assert [r.ok for r in results] == [True, True]
+        assert all(s.status == Sample.AVAILABLE for s in Sample.query)
+        assert all(c.returned_at is not None for c in Checkout.query)
+
+    def test_reports_samples_not_checked_out(self, db, user):
+        ids = make_samples(db, 2)
+        checkout_samples(ids[:1], user.id)
+        results = return_samples(ids + [999])
+        assert results[0].ok is True
+        assert results[1] == (ids[1], False, 'not_checked_out')
+        assert results[2] == (999, False, 'unknown')
+
+    def test_can_check_out_again_after_return(self, db, user):
+        ids = make_samples(db, 1)
+        checkout_samples(ids, user.id)
+        return_samples(ids)
+        assert checkout_samples(ids, user.id)[0].ok is True
+        assert Checkout.query.count() == 2
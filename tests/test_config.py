@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-from TsetseCheckout.app import create_app
-from TsetseCheckout.settings import ProdConfig, DevConfig
+from TsetseCheckout.app import after_fork, create_app
+from TsetseCheckout.database import db
+from TsetseCheckout.settings import ProdConfig, DevConfig, TestConfig
+from TsetseCheckout.startup import IMPORTS, measure
 
 def test_production_config():
     app = create_app(ProdConfig)
@@ -14,4 +16,40 @@ def test_dev_config():
     app = create_app(DevConfig)
     assert app.config['ENV'] == 'dev'
     assert app.config['DEBUG'] is True
-    assert app.config['ASSETS_DEBUG'] is True
\ No newline at end of file
+    assert app.config['ASSETS_DEBUG'] is True
+
+def test_production_skips_development_extensions():
+    app = create_app(ProdConfig)
+    timings = app.extensions['startup_timings']
+    assert 'debug_toolbar' not in timings
+    assert 'migrate' not in app.extensions
+    assert list(timings)[:2] == ['config', 'asset_manifest']
+    assert 'blueprints' in timings
+
+
+def test_dev_loads_debug_toolbar():
+    app = create_app(DevConfig)
+    assert 'debug_toolbar' in app.extensions['startup_timings']
+
+
+def test_blueprints_come_from_config():
+    class OnlyPublic(TestConfig):
+        BLUEPRINTS = ['TsetseCheckout.public.views:blueprint']
+    app = create_app(OnlyPublic)
+    assert set(app.blueprints) == set(['public'])
+
+
+def test_after_fork_replaces_database_connections():
+    app = create_app(TestConfig)
+    with app.app_context():
+        pool = db.engine.pool
+    after_fork(app)
+    with app.app_context():
+        assert db.engine.pool is not pool
+
+
+def test_measure_startup():
+    timings = measure('TestConfig')
+    assert list(timings['imports']) == list(IMPORTS)
+    assert 'db' in timings['init']
+    assert timings['total'] >= sum(timings['imports'].values())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Tests for the connection pool configuration."""
+import os
+
+import pytest
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+
+from TsetseCheckout.app import create_app
+from TsetseCheckout.database import db
+from TsetseCheckout.engine import (
+    InstrumentedQueuePool,
+    _set_statement_timeout,
+)
+from TsetseCheckout.settings import TestConfig
+
+
+@pytest.fixture
+def pooled_app(tmpdir):
+    class PooledConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{0}'.format(
+            tmpdir.join('pool.db'))
+        DB_POOL_SIZE = 1
+        DB_MAX_OVERFLOW = 0
+        DB_POOL_TIMEOUT = 0.1
+        DB_STATEMENT_TIMEOUT = 0.2
+    return create_app(PooledConfig)
+
+
+class TestPool:
+
+    def test_file_database_is_pooled(self, pooled_app):
+        engine = db.get_engine(pooled_app)
+        assert isinstance(engine.pool, InstrumentedQueuePool)
+        assert engine.pool.size() == 1
+
+    def test_memory_database_is_not_pooled(self, app):
+        assert db.pool_stats(app) == {}
+
+    def test_stats(self, pooled_app):
+        engine = db.get_engine(pooled_app)
+        with engine.connect() as conn:
+            assert db.pool_stats(pooled_app)['in_use'] == 1
+            conn.execute('SELECT 1')
+        stats = db.pool_stats(pooled_app)
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+        assert stats['checkouts'] == 1
+        assert stats['timeouts'] == 0
+
+    def test_exhaustion_is_counted(self, pooled_app):
+        engine = db.get_engine(pooled_app)
+        with engine.connect():
+            with pytest.raises(exc.TimeoutError):
+                engine.connect()
+        stats = db.pool_stats(pooled_app)
+        assert stats['timeouts'] == 1
+        assert stats['max_wait_time'] >= 0.1
+
+    def test_connections_are_not_shared_after_fork(self, pooled_app,
+                                                    monkeypatch):
+        engine = db.get_engine(pooled_app)
+        with engine.connect() as conn:
+            parent_connection = conn.connection.connection
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        with engine.connect() as conn:
+            assert conn.connection.connection is not parent_connection
+
+    def test_dead_connection_is_replaced(self, pooled_app):
+        pooled_app.config['DB_POOL_PRE_PING'] = True
+        engine = db.get_engine(pooled_app)
+        with engine.connect() as conn:
+            idle_connection = conn.connection.connection
+        idle_connection.close()  # As if the server went away
+        assert engine.execute('SELECT 1').scalar() == 1
+
+
+class TestStatementTimeout:
+
+    def test_sqlite_statement_is_interrupted(self, pooled_app):
+        engine = db.get_engine(pooled_app)
+        endless = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                   'SELECT i + 1 FROM n) SELECT count(*) FROM n')
+        with pooled_app.test_request_context():
+            with pytest.raises(exc.OperationalError) as error:
+                engine.execute(endless)
+            assert 'interrupted' in str(error.value)
+            # The connection is still usable for the next statement.
+            assert engine.execute('SELECT 1').scalar() == 1
+
+    def test_sqlite_statements_outside_requests_are_not_limited(
+            self, pooled_app):
+        engine = db.get_engine(pooled_app)
+        deadlines = []
+
+        def record(conn, *args):
+            deadlines.append(conn.connection.info.get('statement_deadline'))
+        event.listen(engine, 'before_cursor_execute', record)
+        engine.execute('SELECT 1')
+        assert deadlines == [None]
+
+    def test_postgresql_pool_options(self, app):
+        options = {}
+        db.apply_driver_hacks(app, make_url('postgresql://localhost/test'),
+                              options)
+        assert 'connect_args' not in options
+        assert options['poolclass'] is InstrumentedQueuePool
+        assert options['pool_size'] == app.config['DB_POOL_SIZE']
+
+    def test_postgresql_timeout_is_set_for_requests_only(self, pooled_app):
+        connection, record = FakeConnection(), FakeRecord()
+        _set_statement_timeout(30, connection, record, None)
+        assert connection.executed == []
+        with pooled_app.test_request_context():
+            _set_statement_timeout(30, connection, record, None)
+            _set_statement_timeout(30, connection, record, None)
+        _set_statement_timeout(30, connection, record, None)
+        assert connection.executed == ['SET statement_timeout = 30000',
+                                       'SET statement_timeout = 0']
+        assert connection.commits == 2
+
+
+class FakeRecord(object):
+
+    def __init__(self):
+        self.info = {}
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.executed.append(statement)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
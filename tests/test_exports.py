@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Tests for streaming exports."""
+import csv
+import datetime as dt
+import gzip
+import io
+import json
+import zlib
+
+from flask import url_for
+from sqlalchemy import event
+
+from TsetseCheckout.compat import PY2
+from TsetseCheckout.exports import (
+    encode_csv,
+    encode_jsonl,
+    gzip_chunks,
+    iter_rows,
+)
+from TsetseCheckout.user.models import User
+from .factories import SampleFactory, StorageBoxFactory, UserFactory
+from .test_functional import log_in
+
+
+def read_csv(body):
+    # The py2 csv module reads bytes, so decode the values row by row.
+    lines = body.splitlines() if PY2 else body.decode('utf-8').splitlines()
+    return [dict((key, value.decode('utf-8') if PY2 else value)
+                 for key, value in row.items())
+            for row in csv.DictReader(lines)]
+
+
+class TestEncoding:
+
+    def test_csv_chunk_per_batch(self):
+        batches = [[(1, u'Glossina', None)], [(2, u'Ōkubo', dt.date(2014, 6, 1))]]
+        chunks = list(encode_csv(iter(batches), ('id', 'name', 'on')))
+        assert len(chunks) == 3
+        rows = read_csv(b''.join(chunks))
+        assert rows[0] == {'id': '1', 'name': 'Glossina', 'on': ''}
+        assert rows[1] == {'id': '2', 'name': u'Ōkubo', 'on': '2014-06-01'}
+
+    def test_jsonl(self):
+        batches = [[(1, dt.datetime(2014, 6, 1, 12, 30))]]
+        body = b''.join(encode_jsonl(iter(batches), ('id', 'at')))
+        assert json.loads(body.decode('utf-8')) == {
+            'id': 1, 'at': '2014-06-01T12:30:00'}
+
+    def test_gzip_flushes_every_chunk(self):
+        chunks = [b'a' * 100, b'b' * 100]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        compressed = gzip_chunks(iter(chunks))
+        # Each chunk can be decompressed as soon as it arrives.
+        assert decompressor.decompress(next(compressed)) == chunks[0]
+        assert decompressor.decompress(next(compressed)) == chunks[1]
+        body = b''.join(gzip_chunks(iter(chunks)))
+        assert gzip.GzipFile(fileobj=io.BytesIO(body)).read() == b''.join(chunks)
+
+
+def test_streams_on_a_connection_already_in_use(db):
+    UserFactory().save()
+    User.query.count()  # The session's connection is open now.
+    streamed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        streamed.append(context.execution_options.get('stream_results'))
+    engine = db.session.connection().engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        batches = list(iter_rows(db.select([User.__table__.c.id])))
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert len(batches[0]) == 1
+    assert streamed == [True]
+
+
+class TestExportViews:
+
+    def test_user_export_requires_admin(self, user, testapp):
+        log_in(testapp, user)
+        res = testapp.get(url_for('user.export', fmt='csv'), expect_errors=True)
+        assert res.status_code == 403
+
+    def test_admin_exports_users_as_csv(self, db, testapp):
+        admin = UserFactory(password='myprecious', is_admin=True)
+        db.session.commit()
+        log_in(testapp, admin)
+        res = testapp.get(url_for('user.export', fmt='csv'))
+        assert res.content_type == 'text/csv'
+        assert 'filename=users.csv' in res.headers['Content-Disposition']
+        rows = read_csv(res.body)
+        assert [row['username'] for row in rows] == [admin.username]
+        assert 'password' not in rows[0]
+
+    def test_exports_samples_as_gzipped_json_lines(self, app, db):
+        box = StorageBoxFactory(name='Freezer 1')
+        SampleFactory(box=box)
+        SampleFactory(box=None)
+        db.session.commit()
+        # WebTest transparently decodes gzip, so look at the raw response.
+        res = app.test_client().get(url_for('samples.export', fmt='jsonl'),
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.is_streamed
+        body = gzip.GzipFile(fileobj=io.BytesIO(res.data)).read()
+        records = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        assert [record['box'] for record in records] == ['Freezer 1', None]
+        assert records[0]['status'] == 'available'
+
+    def test_streams_in_batches(self, app, db, user, testapp):
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        for _ in range(5):
+            SampleFactory(box=None)
+        db.session.commit()
+        log_in(testapp, user)
+        res = testapp.get(url_for('samples.export', fmt='csv'))
+        assert len(read_csv(res.body)) == 5
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import pytest
 
+from TsetseCheckout.hashing import hashing_pool, log_rounds_of
 from TsetseCheckout.public.forms import LoginForm
 from TsetseCheckout.user.forms import RegisterForm
 from .factories import UserFactory
@@ -23,6 +24,20 @@ class TestRegisterForm:
         assert form.validate() is False
         assert 'Email already registered' in form.email.errors
 
+    def test_validate_ignores_case(self, user):
+        form = RegisterForm(username=user.username.upper(),
+            email=user.email.upper(), password='example', confirm='example')
+
+        assert form.validate() is False
+        assert 'Username already registered' in form.username.errors
+        assert 'Email already registered' in form.email.errors
+
+    def test_validate_uses_one_query(self, user, queries):
+        form = RegisterForm(username='unique', email='foo@bar.com',
+            password='example', confirm='example')
+        assert form.validate() is True
+        assert len(queries) == 1
+
     def test_validate_success(self, db):
         form = RegisterForm(username='newusername', email='new@test.test',
             password='example', confirm='example')
@@ -38,6 +53,38 @@ class TestLoginForm:
         assert form.validate() is True
         assert form.user == user
 
+    def test_validate_rehashes_to_current_cost(self, user, monkeypatch):
+        user.set_password('example')
+        user.save()
+        monkeypatch.setattr(hashing_pool, 'log_rounds', 5)
+        form = LoginForm(username=user.username, password='example')
+        assert form.validate() is True
+        assert log_rounds_of(user.password) == 5
+        assert user.check_password('example') is True
+
+    def test_validate_rehashes_down_to_current_cost(self, user,
+                                                    monkeypatch):
+        monkeypatch.setattr(hashing_pool, 'min_log_rounds', 4)
+        monkeypatch.setattr(hashing_pool, 'log_rounds', 5)
+        user.set_password('example')
+        user.save()
+        monkeypatch.setattr(hashing_pool, 'log_rounds', 4)
+        form = LoginForm(username=user.username, password='example')
+        assert form.validate() is True
+        assert log_rounds_of(user.password) == 4
+
+    def test_validate_keeps_a_stronger_hash_above_the_floor(self, user,
+                                                            monkeypatch):
+        monkeypatch.setattr(hashing_pool, 'min_log_rounds', 5)
+        monkeypatch.setattr(hashing_pool, 'log_rounds', 5)
+        user.set_password('example')
+        user.save()
+        stored = user.password
+        monkeypatch.setattr(hashing_pool, 'log_rounds', 4)
+        form = LoginForm(username=user.username, password='example')
+        assert form.validate() is True
+        assert user.password == stored
+
     def test_validate_unknown_username(self, db):
         form = LoginForm(username='unknown', password='example')
         assert form.validate() is False
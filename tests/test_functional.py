@@ -7,8 +7,19 @@ import pytest
 from flask import url_for
 
 
+from TsetseCheckout.hashing import HashingOverloaded, hashing_pool
+from TsetseCheckout.samples.models import Checkout, Sample
+from TsetseCheckout.user.forms import RegisterForm
 from TsetseCheckout.user.models import User
-from .factories import UserFactory
+from .factories import SampleFactory, UserFactory
+
+
+def log_in(testapp, user, password='myprecious'):
+    res = testapp.get("/")
+    form = res.forms['loginForm']
+    form['username'] = user.username
+    form['password'] = password
+    return form.submit().follow()
 
 
 class TestLoggingIn:
@@ -60,6 +71,18 @@ class TestLoggingIn:
         # sees error
         assert "Unknown user" in res
 
+    def test_sees_503_if_hashing_pool_is_overloaded(self, user, testapp,
+                                                    monkeypatch):
+        def overloaded(*args):
+            raise HashingOverloaded()
+        monkeypatch.setattr(hashing_pool, 'submit', overloaded)
+        res = testapp.get("/")
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'myprecious'
+        res = form.submit(expect_errors=True)
+        assert res.status_code == 503
+
 
 class TestRegistering:
 
@@ -109,4 +132,135 @@ class TestRegistering:
         # Submits
         res = form.submit()
         # sees error
-        assert "Username already registered" in res
\ No newline at end of file
+        assert "Username already registered" in res
+
+    def test_sees_error_message_if_username_taken_during_submit(self, user,
+                                                               testapp,
+                                                               monkeypatch):
+        # Another signup wins the race between validation and insert
+        check_unique = RegisterForm.check_unique
+        calls = []
+
+        def racy_check_unique(form):
+            calls.append(form)
+            return len(calls) == 1 or check_unique(form)
+        monkeypatch.setattr(RegisterForm, 'check_unique', racy_check_unique)
+        res = testapp.get(url_for("public.register"))
+        form = res.forms["registerForm"]
+        form['username'] = user.username
+        form['email'] = 'foo@bar.com'
+        form['password'] = 'secret'
+        form['confirm'] = 'secret'
+        res = form.submit()
+        assert res.status_code == 200
+        assert "Username already registered" in res
+
+
+class TestUsernameAvailability:
+
+    def test_taken_username(self, user, testapp):
+        url = url_for('public.username_available', username=user.username)
+        assert testapp.get(url).json == {'username': user.username,
+                                         'available': False}
+
+    def test_taken_username_ignores_case(self, user, testapp):
+        url = url_for('public.username_available',
+                      username=user.username.upper())
+        assert testapp.get(url).json['available'] is False
+
+    def test_free_username_answered_without_query(self, user, testapp,
+                                                  queries):
+        testapp.get(url_for('public.username_available', username='warmup'))
+        del queries[:]
+        url = url_for('public.username_available', username='nobody')
+        assert testapp.get(url).json['available'] is True
+        assert queries == []
+
+    def test_new_registration_is_seen(self, db, testapp):
+        testapp.get(url_for('public.username_available', username='warmup'))
+        UserFactory(username='fresh').save()
+        url = url_for('public.username_available', username='fresh')
+        assert testapp.get(url).json['available'] is False
+
+
+class TestScanning:
+
+    def make_barcodes(self, db, count):
+        samples = [SampleFactory(box=None) for _ in range(count)]
+        db.session.commit()
+        return [sample.barcode for sample in samples]
+
+    def test_rejects_malformed_body(self, user, testapp):
+        log_in(testapp, user)
+        res = testapp.post_json(url_for('samples.checkout'),
+                                {'barcodes': 'TS000001'}, expect_errors=True)
+        assert res.status_code == 400
+
+    def test_checks_out_and_returns(self, db, user, testapp):
+        barcodes = self.make_barcodes(db, 2)
+        log_in(testapp, user)
+        res = testapp.post_json(url_for('samples.checkout'),
+                                {'barcodes': barcodes + ['nope']})
+        assert res.json['succeeded'] == 2
+        assert res.json['failed'] == 1
+        assert res.json['results'][2] == {'barcode': 'nope', 'ok': False,
+                                          'reason': 'unknown'}
+        res = testapp.post_json(url_for('samples.checkout'),
+                                {'barcodes': barcodes[:1]})
+        assert res.json['results'][0]['reason'] == 'unavailable'
+        res = testapp.post_json(url_for('samples.checkin'),
+                                {'barcodes': barcodes})
+        assert res.json['succeeded'] == 2
+        assert Sample.query.filter_by(status=Sample.AVAILABLE).count() == 2
+
+    def test_checks_out_a_thousand_barcodes(self, db, user, testapp, queries):
+        barcodes = self.make_barcodes(db, 1000)
+        log_in(testapp, user)
+        del queries[:]
+        res = testapp.post_json(url_for('samples.checkout'),
+                                {'barcodes': barcodes})
+        assert res.json['succeeded'] == 1000
+        assert Checkout.query.count() == 1000
+        # Resolving barcodes and finding claimable rows is done in batches,
+        # not per tube (SQLite still needs one guarded UPDATE per row).
+        selects = [q for q in queries if q.startswith('SELECT')]
+        assert len(selects) <= 6
+
+
+class TestMemberDirectory:
+
+    def test_pages_through_members(self, app, db, user, testapp):
+        app.config['MEMBERS_PER_PAGE'] = 2
+        for _ in range(4):
+            UserFactory().save()
+        log_in(testapp, user)
+        res = testapp.get(url_for('user.members', sort='username'))
+        seen = [cell.text for cell in res.html.select('#members tbody td:nth-of-type(1)')]
+        while 'Next' in res:
+            res = res.click('Next')
+            seen += [cell.text for cell in res.html.select('#members tbody td:nth-of-type(1)')]
+        assert seen == sorted(u.username for u in User.query)
+        assert 'about 5' in res
+
+    def test_searches_by_prefix(self, db, user, testapp):
+        UserFactory(username='glossina').save()
+        UserFactory(username='palpalis').save()
+        log_in(testapp, user)
+        res = testapp.get(url_for('user.members', q='GLOSS'))
+        assert 'glossina' in res
+        assert 'palpalis' not in res
+        assert 'about 1 matching' in res
+
+    def test_hides_and_doesnt_search_emails(self, db, user, testapp):
+        UserFactory(username='glossina', email='palpalis@example.com').save()
+        log_in(testapp, user)
+        res = testapp.get(url_for('user.members'))
+        assert 'palpalis@example.com' not in res
+        res = testapp.get(url_for('user.members', q='palpalis'))
+        assert 'glossina' not in res
+
+    def test_bad_cursor_is_rejected(self, user, testapp):
+        log_in(testapp, user)
+        res = testapp.get(url_for('user.members', after='garbage'),
+                          expect_errors=True)
+        assert res.status_code == 400
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Tests for the password hashing pool."""
+import threading
+import time
+
+import pytest
+
+from TsetseCheckout.hashing import (
+    HashingOverloaded,
+    HashingPool,
+    calibrate_log_rounds,
+    log_rounds_of,
+)
+
+
+class TestHashingPool:
+
+    def make_pool(self, app, **config):
+        app.config.update(config)
+        return HashingPool(app)
+
+    def test_hashes_on_pool(self, app):
+        pool = self.make_pool(app, HASHING_POOL_SIZE=2)
+        pw_hash = pool.generate_password_hash('myprecious')
+        assert pool.check_password_hash(pw_hash, 'myprecious') is True
+        assert pool.check_password_hash(pw_hash, 'wrong') is False
+        stats = pool.stats()
+        assert stats['submitted'] == 3
+        assert stats['completed'] == 3
+        assert stats['hash_seconds'] > 0
+        pool.shutdown()
+
+    def test_inline_when_size_is_zero(self, app):
+        pool = self.make_pool(app, HASHING_POOL_SIZE=0)
+        pw_hash = pool.generate_password_hash('myprecious')
+        assert pool.check_password_hash(pw_hash, 'myprecious') is True
+        assert pool.stats()['submitted'] == 0
+        assert pool.stats()['completed'] == 2
+
+    def test_sheds_load_when_queue_is_full(self, app):
+        pool = self.make_pool(app, HASHING_POOL_SIZE=1, HASHING_QUEUE_DEPTH=1)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        busy = threading.Thread(target=pool.submit, args=(block,))
+        busy.start()
+        started.wait(5)
+        waiting = threading.Thread(target=pool.submit, args=(block,))
+        waiting.start()
+        deadline = time.time() + 5
+        while pool.stats()['queued'] < 1:
+            assert time.time() < deadline, 'the second job was never queued'
+            time.sleep(0.001)
+        with pytest.raises(HashingOverloaded):
+            pool.submit(block)
+        release.set()
+        busy.join()
+        waiting.join()
+        assert pool.stats()['rejected'] == 1
+        pool.shutdown()
+
+    def test_times_out_waiting_for_a_thread(self, app):
+        pool = self.make_pool(app, HASHING_POOL_SIZE=1, HASHING_TIMEOUT=0.01)
+        release = threading.Event()
+        with pytest.raises(HashingOverloaded):
+            pool.submit(release.wait, 5)
+        release.set()
+        assert pool.stats()['timed_out'] == 1
+        pool.shutdown()
+
+    def test_reraises_errors(self, app):
+        pool = self.make_pool(app, HASHING_POOL_SIZE=1)
+        with pytest.raises(ValueError):
+            pool.generate_password_hash('')
+        pool.shutdown()
+
+
+class TestCalibration:
+
+    def test_log_rounds_of(self):
+        assert log_rounds_of('$2a$12$abcdefghijklmnopqrstuv') == 12
+        assert log_rounds_of(b'$2b$04$abcdefghijklmnopqrstuv') == 4
+        assert log_rounds_of('plaintext') is None
+        assert log_rounds_of(None) is None
+
+    def test_calibrate_never_goes_below_minimum(self):
+        assert calibrate_log_rounds(0, min_rounds=5, max_rounds=8) == 5
+
+    def test_calibrate_stops_at_maximum(self):
+        assert calibrate_log_rounds(60, min_rounds=4, max_rounds=5) == 5
+
+    def test_needs_rehash(self, app):
+        app.config.update(HASHING_POOL_SIZE=0, BCRYPT_LOG_ROUNDS=5)
+        pool = HashingPool(app)
+        assert pool.needs_rehash(pool.generate_password_hash('example')) is False
+        pool.log_rounds = 4
+        assert pool.needs_rehash(pool.generate_password_hash('example')) is False
+        pool.log_rounds = 6
+        assert pool.needs_rehash('$2a$05$abcdefghijklmnopqrstuv') is True
+        assert pool.needs_rehash('plaintext') is True
+
+    def test_downgrades_to_the_floor_at_most(self, app):
+        app.config.update(HASHING_POOL_SIZE=0, BCRYPT_LOG_ROUNDS=11,
+                          BCRYPT_MIN_LOG_ROUNDS=10)
+        pool = HashingPool(app)
+        assert pool.needs_rehash('$2a$13$abcdefghijklmnopqrstuv') is True
+        pool.log_rounds = 9
+        assert pool.needs_rehash('$2a$13$abcdefghijklmnopqrstuv') is False
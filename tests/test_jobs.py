@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Tests for the background job queue."""
+import datetime as dt
+import json
+import os
+import sys
+import time
+
+import pytest
+from flask import url_for
+
+from TsetseCheckout.app import create_app
+from TsetseCheckout.database import db as _db
+from TsetseCheckout.jobs import queue, worker
+from TsetseCheckout.jobs.models import Job
+from TsetseCheckout.jobs.queue import task
+from TsetseCheckout.jobs.tasks import export_samples
+from TsetseCheckout.settings import TestConfig
+from .factories import SampleFactory
+from .test_functional import log_in
+
+WORKER = 'testhost:1'
+
+
+@task()
+def add(a, b):
+    return a + b
+
+
+@task(max_attempts=2, priority=5)
+def fail():
+    raise RuntimeError('out of tubes')
+
+
+def not_a_task():
+    pass
+
+
+def crash(*args):
+    sys.exit(3)
+
+
+@pytest.fixture
+def output_dir(app, tmpdir):
+    app.config['JOBS_OUTPUT_DIR'] = str(tmpdir.join('jobs'))
+    return app.config['JOBS_OUTPUT_DIR']
+
+
+def run_next(now=None):
+    job = queue.claim(WORKER, now=now)
+    queue.run(job, WORKER)
+    return Job.get_by_id(job.id)
+
+
+class TestEnqueue:
+
+    def test_stores_the_call(self, db):
+        job = queue.enqueue(add, args=(1, 2))
+        assert job.name == 'tests.test_jobs:add'
+        assert json.loads(job.arguments) == {'args': [1, 2], 'kwargs': {}}
+        assert (job.status, job.attempts, job.max_attempts) == ('queued', 0, 3)
+
+    def test_task_defaults(self, db):
+        job = queue.enqueue('tests.test_jobs:fail')
+        assert (job.priority, job.max_attempts) == (5, 2)
+        assert queue.enqueue(fail, priority=1).priority == 1
+
+    def test_only_tasks(self, db):
+        with pytest.raises(ValueError):
+            queue.enqueue(not_a_task)
+
+
+class TestClaim:
+
+    def test_by_priority_then_age(self, db):
+        now = dt.datetime.utcnow()
+        first = queue.enqueue(add, args=(1, 1))
+        urgent = queue.enqueue(add, args=(2, 2), priority=10)
+        later = queue.enqueue(add, args=(3, 3), delay=60)
+        second = queue.enqueue(add, args=(4, 4))
+        claimed = [queue.claim(WORKER, now=now + dt.timedelta(seconds=1))
+                   for _ in range(4)]
+        assert claimed[:3] == [urgent, first, second]
+        assert claimed[3] is None
+        assert queue.claim(WORKER, now=now + dt.timedelta(seconds=61)) == later
+
+    def test_marks_the_job_running(self, db):
+        job = queue.enqueue(add, args=(1, 1))
+        assert queue.claim(WORKER) == job
+        assert (job.status, job.attempts, job.version) == ('running', 1, 2)
+        assert job.locked_by == WORKER
+        assert queue.claim('otherhost:2') is None
+
+    def test_skips_jobs_claimed_since_they_were_read(self, db, monkeypatch):
+        taken = queue.enqueue(add, args=(1, 1), priority=1)
+        free = queue.enqueue(add, args=(2, 2))
+        execute = _db.session.execute
+        raced = []
+
+        def racing(statement, *args, **kwargs):
+            # Another worker claims the first candidate after our read.
+            if not raced and str(statement).startswith('UPDATE'):
+                raced.append(execute(
+                    Job.__table__.update()
+                    .where(Job.__table__.c.id == taken.id)
+                    .values(version=Job.__table__.c.version + 1)))
+            return execute(statement, *args, **kwargs)
+        monkeypatch.setattr(_db.session, 'execute', racing)
+        assert queue.claim(WORKER) == free
+        assert Job.get_by_id(taken.id).status == 'queued'
+
+
+class TestRun:
+
+    def test_success(self, db):
+        queue.enqueue(add, args=(1, 2))
+        job = run_next()
+        assert job.status == 'succeeded'
+        assert job.to_dict()['result'] == 3
+        assert job.locked_by is None
+        assert job.finished_at is not None
+
+    def test_retries_with_backoff(self, app, db):
+        app.config['JOBS_RETRY_DELAY'] = 10
+        job_id = queue.enqueue(fail, max_attempts=3).id
+        start = dt.datetime.utcnow()
+        job = run_next()
+        assert (job.status, job.attempts) == ('queued', 1)
+        assert job.to_dict()['error'] == 'RuntimeError: out of tubes'
+        assert 10 <= (job.run_at - start).total_seconds() < 12
+        assert queue.claim(WORKER) is None  # Not due yet
+
+        job = run_next(now=job.run_at)
+        assert (job.status, job.attempts) == ('queued', 2)
+        assert 20 <= (job.run_at - start).total_seconds() < 22
+
+        job = run_next(now=job.run_at)
+        assert (job.id, job.status, job.attempts) == (job_id, 'failed', 3)
+        assert job.finished_at is not None
+
+    def test_gives_up_a_lost_lock(self, db, monkeypatch):
+        job = queue.enqueue(add, args=(1, 2))
+        queue.claim(WORKER)
+
+        def slow_add(a, b):
+            # Meanwhile the job was taken for lost and claimed again.
+            _db.session.execute(
+                Job.__table__.update().values(locked_by='otherhost:2'))
+            return a + b
+        slow_add.is_task = True
+        monkeypatch.setattr(queue, '_resolve', lambda name: slow_add)
+        queue.run(job, WORKER)
+        job = Job.get_by_id(job.id)
+        assert (job.status, job.locked_by) == ('running', 'otherhost:2')
+
+    def test_requeue_stale(self, app, db):
+        lost = queue.enqueue(add, args=(1, 1))
+        out_of_attempts = queue.enqueue(add, args=(2, 2), max_attempts=1)
+        fresh = queue.enqueue(add, args=(3, 3))
+        now = dt.datetime.utcnow()
+        for _ in range(3):
+            queue.claim(WORKER, now=now)
+        timeout = app.config['JOBS_LOCK_TIMEOUT']
+        jobs = Job.__table__
+        _db.session.execute(
+            jobs.update()
+            .where(jobs.c.id.in_([lost.id, out_of_attempts.id]))
+            .values(locked_at=now - dt.timedelta(seconds=timeout + 1)))
+        assert queue.requeue_stale(now=now) == 2
+        assert (lost.status, lost.locked_by) == ('queued', None)
+        assert out_of_attempts.status == 'failed'
+        assert fresh.status == 'running'
+
+    def test_remove_expired_output(self, app, output_dir):
+        os.makedirs(output_dir, 0o700)
+        for name in ('old.csv', 'old.csv.part', 'new.csv'):
+            open(os.path.join(output_dir, name), 'w').close()
+        stamp = time.time() - app.config['JOBS_OUTPUT_TTL'] - 1
+        for name in ('old.csv', 'old.csv.part'):
+            os.utime(os.path.join(output_dir, name), (stamp, stamp))
+        assert queue.remove_expired_output() == 2
+        assert os.listdir(output_dir) == ['new.csv']
+
+
+class TestTasks:
+
+    def test_export_samples(self, db, output_dir):
+        samples = [SampleFactory() for _ in range(3)]
+        db.session.commit()
+        result = export_samples('jsonl')
+        assert result['rows'] == 3
+        with open(os.path.join(output_dir, result['filename'])) as f:
+            rows = [json.loads(line) for line in f]
+        assert [row['barcode'] for row in rows] == [s.barcode for s in samples]
+        assert os.listdir(output_dir) == [result['filename']]
+        assert os.stat(output_dir).st_mode & 0o777 == 0o700
+
+    def test_export_refuses_a_directory_others_can_write(self, db,
+                                                         output_dir):
+        os.makedirs(output_dir)
+        os.chmod(output_dir, 0o777)
+        with pytest.raises(RuntimeError):
+            export_samples('csv')
+
+
+class TestViews:
+
+    def test_export_job(self, db, user, testapp, output_dir):
+        SampleFactory()
+        db.session.commit()
+        log_in(testapp, user)
+        res = testapp.post_json(url_for('samples.export_job', fmt='csv'), {})
+        assert res.status_code == 202
+        assert res.json['status'] == 'queued'
+        assert res.headers['Location'].endswith(
+            url_for('jobs.show', job_id=res.json['id']))
+        page = testapp.get(res.headers['Location'])
+        assert res.json['status_url'] in page
+        assert testapp.get(res.json['status_url']).json['download_url'] is None
+
+        run_next()
+        status = testapp.get(res.json['status_url']).json
+        assert status['status'] == 'succeeded'
+        assert status['result']['rows'] == 1
+        download = testapp.get(status['download_url'])
+        assert download.body.decode('utf-8').startswith('id,barcode,box')
+
+    def test_export_job_needs_json(self, db, user, testapp):
+        log_in(testapp, user)
+        res = testapp.post(url_for('samples.export_job', fmt='csv'),
+                           expect_errors=True)
+        assert res.status_code == 400
+        assert Job.query.count() == 0
+
+    def test_only_the_owner_sees_a_job(self, db, user, testapp):
+        job = queue.enqueue(add, args=(1, 1), user_id=user.id + 1)
+        log_in(testapp, user)
+        for endpoint in ('jobs.show', 'jobs.status', 'jobs.download'):
+            res = testapp.get(url_for(endpoint, job_id=job.id),
+                              expect_errors=True)
+            assert res.status_code == 404
+        user.is_admin = True
+        user.save()
+        assert testapp.get(url_for('jobs.status', job_id=job.id)).json[
+            'status'] == 'queued'
+
+
+class TestWorker:
+
+    @pytest.yield_fixture
+    def file_app(self, tmpdir):
+        config = type('FileConfig', (TestConfig,), dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///{0}'.format(
+                tmpdir.join('jobs.db')),
+            JOBS_POLL_INTERVAL=0.05))
+        app = create_app(config)
+        _db.app = app  # As the db fixture does
+        with app.app_context():
+            _db.create_all()
+            yield app
+
+    def test_burst(self, file_app, monkeypatch):
+        monkeypatch.setattr(worker, 'SUPERVISE_INTERVAL', 0.05)
+        ids = [queue.enqueue(add, args=(i, i)).id for i in range(10)]
+        queue.enqueue(fail)
+        worker.Worker(file_app, concurrency=2, burst=True).run()
+        _db.session.remove()
+        jobs = Job.query.order_by(Job.id).all()
+        assert [job.to_dict()['result'] for job in jobs[:-1]] == [
+            2 * i for i in range(len(ids))]
+        assert all(job.locked_by is None for job in jobs)
+        assert (jobs[-1].status, jobs[-1].attempts) == ('queued', 1)
+
+    def test_backs_off_restarting_a_crashing_process(self, file_app,
+                                                     monkeypatch):
+        monkeypatch.setattr(worker, '_work', crash)
+        pool = worker.Worker(file_app, concurrency=1)
+        pool.processes = [pool._start()]
+        crashed = pool.processes[0]
+        crashed.join()
+        pool._reap()
+        assert pool.processes == [crashed]
+        assert crashed.restart_at - crashed.started_at >= 2
+        crashed.restart_at = 0
+        pool._reap()
+        restarted, = pool.processes
+        assert restarted is not crashed
+        restarted.join()
+        pool._reap()
+        assert restarted.failures == 2
+        assert restarted.restart_at - restarted.started_at >= 4
+        pool.stopping.set()
+        pool._reap()
+        assert pool.processes == []
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Tests for the load testing harness."""
+import pytest
+
+from TsetseCheckout import loadtest
+from TsetseCheckout.app import create_app
+from TsetseCheckout.database import db
+from TsetseCheckout.samples.models import Checkout, Sample
+from TsetseCheckout.settings import TestConfig
+from TsetseCheckout.user.models import User
+from .factories import SampleFactory, UserFactory
+
+
+@pytest.yield_fixture
+def loaded_app(tmpdir):
+    class LoadConfig(TestConfig):
+        TESTING = False  # Keep login_required on
+        WTF_CSRF_ENABLED = True
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{0}'.format(
+            tmpdir.join('load.db'))
+    app = create_app(LoadConfig)
+    db.app = app
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+def test_in_process_run(loaded_app):
+    barcodes = loadtest.seed_samples(30)
+    loaded_app.test_client().get('/')  # Build the asset bundles first
+    report = loadtest.run(lambda: loadtest.WSGISession(loaded_app),
+                          users=3, duration=1, barcodes=barcodes, seed=1)
+    assert report['abandoned_users'] == []
+    assert report['errors'] == 0
+    assert report['requests'] > 0
+    assert report['throughput'] > 0
+    by_name = report['requests_by_name']
+    for name in ('register:submit', 'login:submit', 'logout'):
+        assert by_name[name]['requests'] >= 3
+    for name in ('browse:members', 'checkout:out', 'checkout:return'):
+        assert by_name[name]['requests'] > 0
+    latency = report['latency']
+    assert 0 < latency['p50'] <= latency['p95'] <= latency['p99'] \
+        <= latency['max']
+    assert report['histogram'][-1] == {'le': '+Inf',
+                                       'count': report['requests']}
+
+
+def test_cleanup(loaded_app):
+    keep_user, keep_sample = UserFactory(), SampleFactory()
+    db.session.commit()
+    barcodes = loadtest.seed_samples(5)
+    loaded_app.test_client().get('/')  # Build the asset bundles first
+    report = loadtest.run(lambda: loadtest.WSGISession(loaded_app),
+                          users=2, duration=0.5, barcodes=barcodes, seed=1)
+    assert report['errors'] == 0
+    registered = report['requests_by_name']['register:submit']['requests']
+    assert loadtest.cleanup() == (registered, 5)
+    assert User.query.all() == [keep_user]
+    assert Sample.query.all() == [keep_sample]
+    assert Checkout.query.count() == 0
+
+
+def test_errors_are_counted(loaded_app):
+    recorder = loadtest.Recorder()
+    user = loadtest.SimulatedUser(loadtest.WSGISession(loaded_app), recorder)
+    user.username = 'nobody'
+    with pytest.raises(loadtest.LoadTestError):
+        user.login()
+    report = recorder.report(1.0)
+    assert report['requests_by_name']['login:submit']['errors'] == 1
+    assert report['requests_by_name']['login:submit']['statuses'] == \
+        {'200': 1}
+
+
+def test_percentiles():
+    ordered = [i / 100.0 for i in range(1, 101)]
+    assert loadtest._percentile(ordered, 50) == 0.5
+    assert loadtest._percentile(ordered, 99) == 0.99
+    assert loadtest._percentile([0.1], 95) == 0.1
+    assert loadtest._percentile([], 50) == 0.0
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Tests for streaming manifest imports."""
+import datetime as dt
+import json
+import os
+
+import pytest
+
+from TsetseCheckout.samples import manifest
+from TsetseCheckout.samples.manifest import import_manifest
+from TsetseCheckout.samples.models import Sample, StorageBox
+
+HEADER = 'barcode,box,position,species,collection_site,collected_on\n'
+
+
+def write_csv(tmpdir, count, extra=''):
+    path = tmpdir.join('manifest.csv')
+    lines = [HEADER]
+    for n in range(count):
+        lines.append('TS{0:04d},box{1},A{2},Glossina pallidipes,Kisumu,'
+                     '2014-06-{3:02d}\n'.format(n, n % 2, n, n % 28 + 1))
+    path.write(''.join(lines) + extra)
+    return str(path)
+
+
+@pytest.mark.usefixtures('db')
+class TestImportManifest:
+
+    def test_imports_csv(self, tmpdir):
+        stats = import_manifest(write_csv(tmpdir, 5), chunk_size=2)
+        assert stats.imported == 5
+        assert stats.invalid == 0
+        assert Sample.query.count() == 5
+        sample = Sample.query.filter_by(barcode='TS0003').one()
+        assert sample.box.name == 'box1'
+        assert sample.collected_on == dt.date(2014, 6, 4)
+        assert sample.status == Sample.AVAILABLE
+        assert StorageBox.query.count() == 2
+
+    def test_imports_json_lines(self, tmpdir):
+        path = tmpdir.join('manifest.jsonl')
+        path.write('\n'.join(json.dumps({'barcode': 'TS{0}'.format(n),
+                                         'species': 'G. morsitans'})
+                             for n in range(3)))
+        stats = import_manifest(str(path))
+        assert stats.imported == 3
+        assert Sample.query.filter_by(species='G. morsitans').count() == 3
+
+    def test_counts_invalid_records(self, tmpdir):
+        path = write_csv(tmpdir, 2, extra=',box0,A9,,,\nTS9999,,,,,June\n')
+        stats = import_manifest(path)
+        assert stats.imported == 2
+        assert stats.invalid == 2
+        assert [number for number, _ in stats.errors] == [2, 3]
+
+    def test_counts_malformed_json_lines(self, tmpdir):
+        path = tmpdir.join('manifest.jsonl')
+        path.write('{"barcode": "TS1"}\n{"barcode": \n[1, 2]\n'
+                   '{"barcode": "TS2"}\n')
+        stats = import_manifest(str(path))
+        assert stats.imported == 2
+        assert [number for number, _ in stats.errors] == [1, 2]
+
+    def test_resume_skips_json_lines_unparsed(self, tmpdir, monkeypatch):
+        path = tmpdir.join('manifest.jsonl')
+        path.write('not json\n{"barcode": "TS1"}\n')
+        tmpdir.join('manifest.jsonl.checkpoint').write('1')
+        loads = json.loads
+        parsed = []
+
+        def tracking_loads(line):
+            parsed.append(line)
+            return loads(line)
+        monkeypatch.setattr(manifest.json, 'loads', tracking_loads)
+        stats = import_manifest(str(path))
+        assert (stats.imported, stats.invalid) == (1, 0)
+        assert parsed == ['{"barcode": "TS1"}\n']
+
+    def test_reimport_updates_existing_samples(self, tmpdir):
+        path = write_csv(tmpdir, 3)
+        import_manifest(path)
+        import_manifest(path)
+        assert Sample.query.count() == 3
+
+    def test_resumes_from_checkpoint(self, tmpdir, monkeypatch):
+        path = write_csv(tmpdir, 5)
+        upsert = Sample.bulk_upsert.__func__
+        calls = []
+
+        def failing_upsert(cls, rows, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError('connection lost')
+            return upsert(cls, rows, **kwargs)
+        monkeypatch.setattr(Sample, 'bulk_upsert',
+                            classmethod(failing_upsert))
+        with pytest.raises(RuntimeError):
+            import_manifest(path, chunk_size=2)
+        assert open(path + '.checkpoint').read() == '2'
+        assert Sample.query.count() == 2
+
+        monkeypatch.undo()
+        stats = import_manifest(path, chunk_size=2)
+        assert stats.start == 2
+        assert stats.imported == 3
+        assert Sample.query.count() == 5
+        assert not os.path.exists(path + '.checkpoint')
+
+    def test_reads_lazily(self, tmpdir, monkeypatch):
+        path = write_csv(tmpdir, 10)
+        seen = []
+        read_records = manifest.read_records
+
+        def tracking_read(*args):
+            for number, record in read_records(*args):
+                seen.append(number)
+                yield number, record
+        monkeypatch.setattr(manifest, 'read_records', tracking_read)
+
+        def progress(stats):
+            assert len(seen) == stats.imported
+        import_manifest(path, chunk_size=3, progress=progress)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Tests for request metrics and the /metrics endpoint."""
+import json
+import logging
+import re
+import time
+
+import pytest
+from flask import Flask, _request_ctx_stack
+
+from TsetseCheckout import metrics as metrics_module
+from TsetseCheckout.metrics import (
+    Metrics,
+    RequestMetrics,
+    aggregate,
+    clear_directory,
+    metrics,
+    render_prometheus,
+)
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+@pytest.yield_fixture
+def metrics_dir(app, tmpdir):
+    metrics.directory = str(tmpdir)
+    yield tmpdir
+    metrics.directory = None
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.info = {}
+
+
+def scrape(testapp, **kwargs):
+    return testapp.get('/metrics', extra_environ={'REMOTE_ADDR': '127.0.0.1'},
+                       **kwargs)
+
+
+def sample(body, name, **labels):
+    """The value of the sample ``name`` with exactly ``labels``."""
+    for line in body.splitlines():
+        match = SAMPLE.match(line)
+        if (match and match.group(1) == name and
+                dict(LABEL.findall(match.group(2) or '')) == labels):
+            return float(match.group(3))
+    return 0.0
+
+
+class TestMetrics:
+
+    def test_request_latency_and_templates(self, testapp):
+        before = sample(scrape(testapp).text,
+                        'http_requests_total', endpoint='public.about',
+                        method='GET', status='200')
+        testapp.get('/about/')
+        body = scrape(testapp).text
+        assert sample(body, 'http_requests_total', endpoint='public.about',
+                      method='GET', status='200') == before + 1
+        assert sample(body, 'http_request_duration_seconds_bucket',
+                      endpoint='public.about', method='GET', le='+Inf') >= 1
+        assert '# TYPE http_request_duration_seconds histogram' in body
+        assert sample(body, 'template_renders_total',
+                      template='public/about.html') >= 1
+
+    def test_sql_is_counted_per_endpoint(self, testapp, user):
+        before = sample(scrape(testapp).text, 'sql_queries_total',
+                        endpoint='user.members')
+        testapp.get('/users/')
+        body = scrape(testapp).text
+        assert sample(body, 'sql_queries_total',
+                      endpoint='user.members') > before
+        assert 'sql_query_duration_seconds_total{endpoint="user.members"}' \
+            in body
+
+    def test_hashing_pool_is_reported(self, testapp, user):
+        before = sample(scrape(testapp).text, 'bcrypt_hashes_total')
+        assert user.check_password('myprecious')
+        body = scrape(testapp).text
+        assert sample(body, 'bcrypt_hashes_total') == before + 1
+        assert '# TYPE bcrypt_hash_seconds_total counter' in body
+
+    def test_slow_requests_are_logged_with_sql(self, app, testapp, user):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        app.logger.addHandler(handler)
+        metrics.slow_request = 0
+        try:
+            testapp.get('/users/')
+        finally:
+            metrics.slow_request = app.config['METRICS_SLOW_REQUEST']
+            app.logger.removeHandler(handler)
+        assert messages[-1].startswith(
+            'Slow request: GET /users/ (user.members) 200')
+        assert 'FROM users' in messages[-1]
+
+    def test_slowest_statements_are_kept(self, app, monkeypatch):
+        monkeypatch.setattr(metrics_module, 'MAX_LOGGED_STATEMENTS', 3)
+        current = _request_ctx_stack.top.metrics = RequestMetrics()
+        for n, seconds in enumerate([0.5, 0.1, 0.9, 0.2, 0.7, 0.3]):
+            conn = Connection()
+            conn.info['metrics_started_at'] = [time.time() - seconds]
+            metrics_module._after_cursor_execute(
+                conn, None, 'SELECT {0}'.format(n), None, None, False)
+        assert current.sql_count == 6
+        assert sorted(statement for _, statement in current.statements) == [
+            'SELECT 0', 'SELECT 2', 'SELECT 4']
+
+    def test_only_local_or_token_holders_may_scrape(self, testapp):
+        res = testapp.get('/metrics', expect_errors=True,
+                          extra_environ={'REMOTE_ADDR': '10.0.0.8'})
+        assert res.status_code == 404
+        metrics.token = 'scraper-token'
+        try:
+            res = testapp.get('/metrics', expect_errors=True,
+                              extra_environ={'REMOTE_ADDR': '10.0.0.8'},
+                              headers={'Authorization': 'Bearer wrong'})
+            assert res.status_code == 404
+            res = testapp.get(
+                '/metrics', extra_environ={'REMOTE_ADDR': '10.0.0.8'},
+                headers={'Authorization': 'Bearer scraper-token'})
+            assert '# TYPE' in res.text
+        finally:
+            metrics.token = None
+
+    def test_workers_are_added_up(self, testapp, metrics_dir):
+        dead_worker = dict(
+            pid=2 ** 22 + 1,  # Above the largest pid Linux hands out
+            counters=[['http_requests_total',
+                       [['endpoint', 'public.home'], ['method', 'GET'],
+                        ['status', '200']], 5]],
+            histograms=[], gauges=[['db_pool_connections',
+                                    [['state', 'in_use']], 3]])
+        metrics_dir.join('{0}.json'.format(dead_worker['pid'])).write(
+            json.dumps(dead_worker))
+        testapp.get('/')
+        body = scrape(testapp).text
+        assert sample(body, 'http_requests_total', endpoint='public.home',
+                      method='GET', status='200') >= 6
+        # Gauges of a worker that has exited are dropped.
+        assert 'db_pool_connections' not in body
+        assert len(metrics_dir.listdir()) == 2
+        clear_directory(str(metrics_dir))
+        assert metrics_dir.listdir() == []
+
+    def test_refuses_a_directory_others_can_write(self, tmpdir):
+        tmpdir.chmod(0o777)
+        app = Flask(__name__)
+        app.config['METRICS_DIR'] = str(tmpdir)
+        with pytest.raises(RuntimeError):
+            Metrics(app)
+
+
+def test_render_histogram():
+    name = 'http_request_duration_seconds'
+    totals = aggregate([
+        dict(pid=1, counters=[], gauges=[], histograms=[
+            [name, [['endpoint', 'a']], [0] * 2 + [1] * 10 + [0.02]]]),
+        dict(pid=1, counters=[], gauges=[], histograms=[
+            [name, [['endpoint', 'a']], [0] * 11 + [1] + [20.0]]]),
+    ])
+    lines = render_prometheus(totals).splitlines()
+    assert '# TYPE {0} histogram'.format(name) in lines
+    assert name + '_bucket{endpoint="a",le="0.025"} 1' in lines
+    assert name + '_bucket{endpoint="a",le="+Inf"} 2' in lines
+    assert name + '_sum{endpoint="a"} 20.02' in lines
+    assert name + '_count{endpoint="a"} 2' in lines
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Tests for conditional GET and response compression."""
+import gzip
+import io
+
+import pytest
+from flask import Response, stream_with_context
+
+from TsetseCheckout.middleware import fresh_when, no_compression, no_etag
+from .factories import UserFactory
+from .test_functional import log_in
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+@pytest.fixture
+def views(app):
+    calls = []
+    body = 'x' * 2000
+
+    @app.route('/_test/fresh/')
+    @fresh_when(lambda: 'v1')
+    def fresh():
+        calls.append('fresh')
+        return body
+
+    @app.route('/_test/small/')
+    def small():
+        return 'tiny'
+
+    @app.route('/_test/plain/')
+    @no_compression
+    @no_etag
+    def plain():
+        return body
+
+    @app.route('/_test/form/')
+    def form():
+        return '<input name="csrf_token" value="secret">' + body
+
+    @app.route('/_test/stream/')
+    def stream():
+        def generate():
+            for _ in range(3):
+                yield body
+        return Response(stream_with_context(generate()), mimetype='text/csv')
+
+    return calls
+
+
+@pytest.mark.usefixtures('db')
+class TestConditionalGet:
+
+    def test_answers_if_none_match_with_304(self, testapp):
+        res = testapp.get('/about/')
+        etag = res.headers['ETag']
+        assert etag.startswith('W/')
+        res = testapp.get('/about/', headers={'If-None-Match': etag})
+        assert res.status_code == 304
+        assert res.body == b''
+
+    def test_fresh_when_skips_the_view(self, app, views):
+        client = app.test_client()
+        etag = client.get('/_test/fresh/').headers['ETag']
+        res = client.get('/_test/fresh/', headers={'If-None-Match': etag})
+        assert res.status_code == 304
+        assert views == ['fresh']
+
+    def test_user_writes_change_the_members_etag(self, testapp, user):
+        etag = testapp.get('/users/').headers['ETag']
+        UserFactory().save()
+        res = testapp.get('/users/', headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
+
+    def test_etag_depends_on_who_asks(self, testapp, user):
+        etag = testapp.get('/about/').headers['ETag']
+        log_in(testapp, user)
+        res = testapp.get('/about/', headers={'If-None-Match': etag})
+        assert res.status_code == 200
+
+    def test_opt_out(self, app, views):
+        res = app.test_client().get('/_test/plain/',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert 'ETag' not in res.headers
+        assert 'Content-Encoding' not in res.headers
+
+
+@pytest.mark.usefixtures('db')
+class TestCompression:
+
+    def test_compresses_large_responses(self, app, views):
+        res = app.test_client().get('/_test/fresh/',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in res.headers['Vary']
+        assert gunzip(res.data) == b'x' * 2000
+        assert int(res.headers['Content-Length']) == len(res.data)
+
+    def test_leaves_small_responses(self, app, views):
+        res = app.test_client().get('/_test/small/',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in res.headers
+
+    @pytest.mark.parametrize('accept', [None, 'gzip;q=0', 'br, gzip;q=0'])
+    def test_only_when_accepted(self, app, views, accept):
+        headers = {'Accept-Encoding': accept} if accept else {}
+        res = app.test_client().get('/_test/fresh/', headers=headers)
+        assert 'Content-Encoding' not in res.headers
+
+    @pytest.mark.parametrize('url', ['/_test/form/', '/_test/fresh/?q=x'])
+    def test_leaves_breach_prone_pages(self, app, views, url):
+        res = app.test_client().get(url, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in res.headers
+
+    def test_compresses_other_types_with_a_query(self, app, views):
+        res = app.test_client().get('/_test/stream/?q=x',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert gunzip(res.data) == b'x' * 6000
+
+    def test_compresses_streams_as_they_stream(self, app, views):
+        res = app.test_client().get('/_test/stream/',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert res.is_streamed
+        assert 'Content-Length' not in res.headers
+        assert gunzip(res.data) == b'x' * 6000
@@ -4,6 +4,13 @@ import datetime as dt
 
 import pytest
 
+from TsetseCheckout.database import (
+    InvalidCursor,
+    _copy_line,
+    approximate_count,
+    db,
+    keyset_paginate,
+)
 from TsetseCheckout.user.models import User, Role
 from .factories import UserFactory
 
@@ -54,4 +61,206 @@ class TestUser:
         u = UserFactory()
         u.roles.append(role)
         u.save()
-        assert role in u.roles
\ No newline at end of file
+        assert role in u.roles
+
+def user_rows(count, start=0):
+    for n in range(start, start + count):
+        yield {'username': 'bulk{0}'.format(n),
+               'email': 'bulk{0}@example.com'.format(n)}
+
+
+@pytest.mark.usefixtures('db')
+class TestBulkOperations:
+
+    def test_bulk_create_returns_ids_in_order(self):
+        ids = User.bulk_create(user_rows(5), batch_size=2)
+        assert len(ids) == 5
+        for n, user_id in enumerate(ids):
+            user = User.get_by_id(user_id)
+            assert user.username == 'bulk{0}'.format(n)
+            assert isinstance(user.created_at, dt.datetime)
+
+    def test_bulk_create_one_statement_per_batch(self, queries):
+        User.bulk_create(user_rows(50))
+        inserts = [q for q in queries if q.startswith('INSERT')]
+        assert len(inserts) == 1
+
+    def test_bulk_create_splits_statements_for_sqlite(self):
+        ids = User.bulk_create(user_rows(1000))
+        assert ids == list(range(ids[0], ids[0] + 1000))
+        assert User.query.count() == 1000
+        assert User.get_by_id(ids[-1]).username == 'bulk999'
+
+    def test_bulk_create_with_explicit_ids(self):
+        rows = list(user_rows(3))
+        rows[0]['id'] = 50
+        rows[2]['id'] = 10
+        ids = User.bulk_create(rows)
+        assert ids[0] == 50 and ids[2] == 10
+        assert ids[1] not in (10, 50)
+        for n, user_id in enumerate(ids):
+            assert User.get_by_id(user_id).username == 'bulk{0}'.format(n)
+
+    def test_bulk_create_without_ids_returns_count(self):
+        assert User.bulk_create(user_rows(3), return_ids=False) == 3
+        assert User.query.count() == 3
+
+    def test_bulk_update(self):
+        ids = User.bulk_create(user_rows(3))
+        rows = [{'id': ids[0], 'first_name': 'Ann'},
+                {'id': ids[1], 'first_name': 'Bob'},
+                {'id': ids[2], 'last_name': 'Cole'}]
+        assert User.bulk_update(iter(rows)) == 3
+        assert User.get_by_id(ids[0]).first_name == 'Ann'
+        assert User.get_by_id(ids[1]).first_name == 'Bob'
+        assert User.get_by_id(ids[2]).last_name == 'Cole'
+
+    def test_bulk_upsert_on_unique_column(self):
+        existing = UserFactory(username='bulk1', first_name='Old')
+        existing.save()
+        created_at = existing.created_at
+        rows = [dict(row, first_name='New') for row in user_rows(3)]
+        rows[1]['email'] = existing.email
+        ids = User.bulk_upsert(rows, index_elements=['username'])
+        assert len(ids) == 3
+        assert ids[1] == existing.id
+        assert User.query.count() == 3
+        updated = User.get_by_id(existing.id)
+        assert updated.first_name == 'New'
+        assert updated.created_at == created_at
+        assert User.get_by_id(ids[2]).username == 'bulk2'
+
+    def test_bulk_upsert_splits_lookups_for_sqlite(self, queries):
+        User.bulk_create(user_rows(1000))
+        del queries[:]
+        rows = [dict(row, first_name='New') for row in user_rows(1000)]
+        ids = User.bulk_upsert(rows, index_elements=['username'])
+        lookups = [q for q in queries if q.startswith('SELECT')]
+        assert len(lookups) == 2  # At most 999 usernames per IN
+        assert User.get_by_id(ids[-1]).first_name == 'New'
+
+    def test_bulk_upsert_last_row_wins(self):
+        rows = [{'username': 'dup', 'email': 'a@example.com'},
+                {'username': 'dup', 'email': 'b@example.com'}]
+        ids = User.bulk_upsert(rows, index_elements=['username'])
+        assert ids[0] == ids[1]
+        assert User.get_by_id(ids[0]).email == 'b@example.com'
+
+
+def test_copy_line_keeps_empty_strings_apart_from_null():
+    line = _copy_line([None, u'', u'\\N', u'say "hi"', 3, True])
+    assert line == u'\\N,"","\\N","say ""hi""","3","True"\n'
+
+
+@pytest.mark.usefixtures('db')
+class TestGetMany:
+
+    def make_users(self, count):
+        return User.bulk_create(user_rows(count))
+
+    def test_returns_records_in_request_order(self):
+        ids = self.make_users(3)
+        records, missing = User.get_many([ids[2], str(ids[0]), ids[1]])
+        assert [r.id for r in records] == [ids[2], ids[0], ids[1]]
+        assert missing == []
+
+    def test_reports_missing_and_invalid_ids(self):
+        ids = self.make_users(2)
+        records, missing = User.get_many([ids[0], 9999, 'abc', None, ids[1]])
+        assert [r.id for r in records] == ids
+        assert missing == [9999, 'abc', None]
+
+    def test_one_query_per_chunk(self, queries):
+        ids = self.make_users(10)
+        del queries[:]
+        records, missing = User.get_many(ids, chunk_size=4)
+        assert len(records) == 10
+        assert len(queries) == 3
+
+    def test_reuses_identity_map(self, queries):
+        ids = self.make_users(3)
+        loaded, _ = User.get_many(ids)
+        del queries[:]
+        records, missing = User.get_many(ids + ids)
+        assert len(records) == 6
+        assert queries == []
+
+    def test_refetches_expired_records_together(self, db, queries):
+        ids = self.make_users(3)
+        loaded, _ = User.get_many(ids)
+        db.session.expire_all()
+        del queries[:]
+        records, missing = User.get_many(ids)
+        assert [r.username for r in records] == ['bulk0', 'bulk1', 'bulk2']
+        assert len(queries) == 1
+
+
+@pytest.mark.usefixtures('db')
+class TestKeysetPagination:
+
+    def make_users(self, count):
+        # Several users per timestamp, so the id breaks ties.
+        base = dt.datetime(2014, 1, 1)
+        rows = list(user_rows(count))
+        for n, row in enumerate(rows):
+            row['created_at'] = base + dt.timedelta(seconds=n // 3)
+        User.bulk_create(rows)
+
+    def paginate(self, descending=False, **kwargs):
+        users = User.__table__
+        return keyset_paginate(db.select([users.c.id, users.c.username]),
+                               [users.c.created_at, users.c.id], per_page=4,
+                               descending=descending, **kwargs)
+
+    def walk(self, descending=False):
+        pages, page = [], self.paginate(descending)
+        pages.append(page)
+        while page.has_next:
+            page = self.paginate(descending, after=page.next_cursor)
+            pages.append(page)
+        return pages
+
+    @pytest.mark.parametrize('descending', [False, True])
+    def test_walks_every_row_once_in_order(self, descending):
+        self.make_users(10)
+        pages = self.walk(descending)
+        assert [len(page) for page in pages] == [4, 4, 2]
+        ids = [row.id for page in pages for row in page]
+        assert ids == sorted(ids, reverse=descending)
+        assert len(set(ids)) == 10
+        assert not pages[0].has_prev
+        assert pages[-1].has_prev
+
+    def test_before_returns_previous_page(self):
+        self.make_users(10)
+        first, second, third = self.walk()
+        back = self.paginate(before=third.prev_cursor)
+        assert [row.id for row in back] == [row.id for row in second]
+        assert back.has_next
+        back = self.paginate(before=back.prev_cursor)
+        assert [row.id for row in back] == [row.id for row in first]
+        assert not back.has_prev
+
+    def test_seeks_instead_of_skipping(self, queries):
+        self.make_users(10)
+        cursor = self.paginate().next_cursor
+        del queries[:]
+        self.paginate(after=cursor)
+        # SQLite always renders "OFFSET ?"; it is bound to 0 here.
+        assert 'WHERE users.created_at > ?' in queries[0]
+
+    @pytest.mark.parametrize('cursor', ['garbage', 'WzFd', 'WyJ4IiwxXQ'])
+    def test_rejects_bad_cursor(self, cursor):
+        with pytest.raises(InvalidCursor):
+            self.paginate(after=cursor)
+
+    def test_approximate_count_is_cached(self, queries):
+        self.make_users(3)
+        users = User.__table__
+        assert approximate_count(users, cache_key='users') == 3
+        UserFactory().save()
+        del queries[:]
+        assert approximate_count(users, cache_key='users') == 3
+        assert queries == []
+        assert approximate_count(users) == 4
+        assert approximate_count(users, users.c.username == 'bulk1') == 1
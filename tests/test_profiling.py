@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Tests for the request profiler."""
+import pstats
+import time
+
+import pytest
+
+from TsetseCheckout.app import create_app
+from TsetseCheckout.profiling import HEADER, profiler
+from TsetseCheckout.settings import TestConfig
+
+
+def make_client(tmpdir, **config):
+    class ProfileConfig(TestConfig):
+        PROFILE_DIR = str(tmpdir)
+        PROFILE_INTERVAL = 0.001
+        SECRET_KEY = 'a-long-and-unguessable-test-key'
+    for key, value in config.items():
+        setattr(ProfileConfig, key, value)
+    app = create_app(ProfileConfig)
+
+    @app.route('/_test/slow/')
+    def slow():
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            pass
+        return 'done'
+    return app.test_client()
+
+
+def profiles(tmpdir, suffix):
+    return [path for path in tmpdir.listdir() if path.ext == suffix]
+
+
+class TestProfiler:
+
+    def test_off_without_a_directory(self, app):
+        assert 'profiler' not in app.extensions
+
+    def test_unprofiled_requests_write_nothing(self, tmpdir):
+        make_client(tmpdir).get('/_test/slow/')
+        assert tmpdir.listdir() == []
+
+    def test_profiled_endpoint_writes_collapsed_stacks(self, tmpdir):
+        client = make_client(tmpdir, PROFILE_ENDPOINTS=['slow'])
+        client.get('/_test/slow/')
+        client.get('/about/')
+        [path] = profiles(tmpdir, '.collapsed')
+        assert path.basename.endswith('-slow.collapsed')
+        lines = path.read().splitlines()
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) > 5
+        assert any('tests.test_profiling:slow' in line for line in lines)
+
+    def test_sample_rate(self, tmpdir):
+        client = make_client(tmpdir, PROFILE_SAMPLE_RATE=1)
+        client.get('/_test/slow/')
+        client.get('/_test/slow/')
+        assert len(profiles(tmpdir, '.collapsed')) == 2
+
+    def test_signed_header(self, tmpdir):
+        client = make_client(tmpdir)
+        with client.application.app_context():
+            token = profiler.make_token('cprofile')
+        response = client.get('/_test/slow/', headers={HEADER: token})
+        [path] = profiles(tmpdir, '.prof')
+        assert response.headers[HEADER + '-File'] == path.basename
+        functions = pstats.Stats(str(path)).stats
+        assert any(name == 'slow' for _, _, name in functions)
+
+    @pytest.mark.parametrize('secret', ['secret-key', 'short'])
+    def test_header_refused_with_a_placeholder_secret(self, tmpdir, secret):
+        client = make_client(tmpdir)
+        with client.application.app_context():
+            token = profiler.make_token('cprofile')
+            client.application.secret_key = secret
+            with pytest.raises(RuntimeError):
+                profiler.make_token('cprofile')
+        response = client.get('/_test/slow/', headers={HEADER: token})
+        assert HEADER + '-File' not in response.headers
+        assert tmpdir.listdir() == []
+
+    def test_forged_header_is_ignored(self, tmpdir):
+        client = make_client(tmpdir)
+        response = client.get('/_test/slow/', headers={HEADER: 'forged'})
+        assert HEADER + '-File' not in response.headers
+        assert tmpdir.listdir() == []
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Tests for sending reads to replicas."""
+import json
+
+import pytest
+from flask import jsonify
+
+from TsetseCheckout.app import create_app
+from TsetseCheckout.database import db, use_replica
+from TsetseCheckout.routing import LAST_WRITE_KEY
+from TsetseCheckout.settings import TestConfig
+from TsetseCheckout.user.models import User
+
+
+def make_app(tmpdir, **config):
+    class ReplicaConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{0}'.format(
+            tmpdir.join('primary.db'))
+        SQLALCHEMY_BINDS = {
+            'replica': 'sqlite:///{0}'.format(tmpdir.join('replica.db')),
+            'replica2': 'sqlite:///{0}'.format(tmpdir.join('replica2.db')),
+        }
+        DB_REPLICA_BINDS = ['replica']
+    for key, value in config.items():
+        setattr(ReplicaConfig, key, value)
+    app = create_app(ReplicaConfig)
+
+    @app.route('/test/replica/')
+    @use_replica
+    def replica_count():
+        return jsonify(count=User.query.count())
+
+    @app.route('/test/primary/')
+    def primary_count():
+        return jsonify(count=User.query.count())
+
+    @app.route('/test/replica/', methods=['POST'])
+    @use_replica
+    def replica_post_count():
+        return jsonify(count=User.query.count())
+
+    @app.route('/test/write/', methods=['POST'])
+    @use_replica
+    def write():
+        User.create(username='writer', email='writer@example.com')
+        return jsonify(count=User.query.count())
+
+    db.app = app
+    with app.app_context():
+        db.create_all(bind=None)
+        for bind, users in (('replica', 2), ('replica2', 3)):
+            engine = db.get_engine(app, bind=bind)
+            db.metadata.create_all(engine)
+            engine.execute(User.__table__.insert(), [
+                dict(username='{0}-{1}'.format(bind, i),
+                     email='{0}-{1}@example.com'.format(bind, i))
+                for i in range(users)])
+    return app
+
+
+@pytest.yield_fixture
+def client(tmpdir):
+    app = make_app(tmpdir)
+    yield app.test_client()
+    db.session.remove()
+
+
+def count(client, path, method='get'):
+    response = getattr(client, method)(path)
+    return json.loads(response.data.decode('utf-8'))['count']
+
+
+class TestRouting:
+
+    def test_undecorated_views_read_from_primary(self, client):
+        assert count(client, '/test/primary/') == 0
+
+    def test_decorated_views_read_from_replica(self, client):
+        assert count(client, '/test/replica/') == 2
+
+    def test_decorated_views_read_from_primary_on_post(self, client):
+        assert count(client, '/test/replica/', method='post') == 0
+
+    def test_writes_and_later_reads_use_primary(self, client):
+        assert count(client, '/test/write/', method='post') == 1
+        assert count(client, '/test/primary/') == 1
+
+    def test_reads_follow_own_writes_for_a_while(self, client):
+        client.post('/test/write/')
+        assert count(client, '/test/replica/') == 1
+        with client.session_transaction() as session:
+            session[LAST_WRITE_KEY] -= TestConfig.DB_READ_YOUR_WRITES
+        assert count(client, '/test/replica/') == 2
+
+    def test_round_robin(self, tmpdir):
+        app = make_app(tmpdir, DB_REPLICA_BINDS=['replica', 'replica2'])
+        client = app.test_client()
+        counts = [count(client, '/test/replica/') for _ in range(4)]
+        db.session.remove()
+        assert sorted(counts) == [2, 2, 3, 3]
+
+    def test_unhealthy_replica_is_skipped(self, tmpdir):
+        missing = tmpdir.join('missing', 'replica.db')
+        app = make_app(tmpdir, DB_REPLICA_BINDS=['broken', 'replica'],
+                       SQLALCHEMY_BINDS={
+                           'broken': 'sqlite:///{0}'.format(missing),
+                           'replica': 'sqlite:///{0}'.format(
+                               tmpdir.join('replica.db')),
+                           'replica2': 'sqlite:///{0}'.format(
+                               tmpdir.join('replica2.db'))})
+        client = app.test_client()
+        assert [count(client, '/test/replica/') for _ in range(2)] == [2, 2]
+        db.session.remove()
+        replicas = app.extensions['db_replicas']
+        assert replicas.health() == {'broken': False, 'replica': True}
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Tests for the login throttle."""
+import pytest
+from webtest import TestApp
+
+from TsetseCheckout.hashing import hashing_pool
+from TsetseCheckout.metrics import aggregate, metrics
+from TsetseCheckout.throttle import (
+    MemoryBuckets,
+    SQLiteBuckets,
+    login_throttle,
+)
+
+LIMITS = [('ip:127.0.0.1', 3, 30), ('username:foo', 2, 60)]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buckets(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryBuckets()
+    return SQLiteBuckets(str(tmpdir.join('throttle.sqlite')))
+
+
+def attempt(testapp, username, password):
+    res = testapp.get('/')
+    form = res.forms['loginForm']
+    form['username'] = username
+    form['password'] = password
+    return form.submit(expect_errors=True)
+
+
+@pytest.fixture
+def hash_checks(monkeypatch):
+    checks = []
+    check = hashing_pool.check_password_hash
+
+    def counting(pw_hash, password):
+        checks.append(password)
+        return check(pw_hash, password)
+    monkeypatch.setattr(hashing_pool, 'check_password_hash', counting)
+    return checks
+
+
+class TestTokenBuckets:
+
+    def test_empties_after_capacity(self, buckets):
+        assert buckets.take(LIMITS, now=100) == ([], 0.0)
+        assert buckets.take(LIMITS, now=100) == ([], 0.0)
+        empty, wait = buckets.take(LIMITS, now=100)
+        assert empty == ['username:foo']
+        assert wait == pytest.approx(30)  # One token in 60s / 2
+
+    def test_takes_nothing_unless_every_bucket_has_a_token(self, buckets):
+        buckets.take(LIMITS, now=100)
+        buckets.take(LIMITS, now=100)
+        buckets.take(LIMITS, now=100)  # Refused
+        # The address still has its third token for another username.
+        assert buckets.take([LIMITS[0]], now=100) == ([], 0.0)
+        assert buckets.take([LIMITS[0]], now=100)[0] == ['ip:127.0.0.1']
+
+    def test_refills_over_the_period(self, buckets):
+        buckets.take(LIMITS, now=100)
+        buckets.take(LIMITS, now=100)
+        assert buckets.take(LIMITS, now=129)[0] == ['username:foo']
+        assert buckets.take(LIMITS, now=130)[0] == []
+
+    def test_give_back(self, buckets):
+        buckets.take(LIMITS, now=100)
+        buckets.take(LIMITS, now=100)
+        buckets.give_back(LIMITS, now=100)
+        assert buckets.take(LIMITS, now=100)[0] == []
+        # Never more than the capacity.
+        for _ in range(5):
+            buckets.give_back(LIMITS, now=100)
+        for _ in range(2):
+            assert buckets.take(LIMITS, now=100)[0] == []
+        assert buckets.take(LIMITS, now=100)[0] == ['username:foo']
+
+    def test_prune_forgets_full_buckets(self, buckets):
+        buckets.take(LIMITS, now=100)
+        with buckets._transaction() as store:
+            store.prune(now=129)
+            assert sorted(store.load([key for key, _, _ in LIMITS])) == [
+                'username:foo']
+
+    def test_sqlite_buckets_are_shared(self, tmpdir):
+        path = str(tmpdir.join('throttle.sqlite'))
+        first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+        first.take(LIMITS, now=100)
+        second.take(LIMITS, now=100)
+        assert first.take(LIMITS, now=100)[0] == ['username:foo']
+
+
+class TestLoginThrottle:
+
+    def test_rejects_before_querying_or_hashing(self, user, testapp,
+                                                hash_checks, queries):
+        for _ in range(5):
+            assert 'Invalid password' in attempt(testapp, user.username,
+                                                 'wrong')
+        assert len(hash_checks) == 5
+        del queries[:]
+        res = attempt(testapp, user.username, 'wrong')
+        assert res.status_code == 429
+        assert int(res.headers['Retry-After']) == 60
+        assert len(hash_checks) == 5
+        assert not any('users' in statement for statement in queries)
+        # The right password doesn't get through either.
+        assert attempt(testapp, user.username,
+                       'myprecious').status_code == 429
+
+    def test_username_limit_is_per_address(self, app, user, testapp):
+        for _ in range(6):
+            attempt(testapp, user.username, 'wrong')
+        # The owner, elsewhere, isn't locked out by someone else's guesses.
+        owner = TestApp(app, extra_environ={'REMOTE_ADDR': '10.0.0.2'})
+        assert attempt(owner, user.username, 'myprecious').status_code == 302
+        assert attempt(testapp, user.username,
+                       'myprecious').status_code == 429
+
+    def test_limits_by_address(self, app, db, testapp):
+        app.config['LOGIN_THROTTLE_IP_ATTEMPTS'] = 2
+        login_throttle.init_app(app)
+        assert attempt(testapp, 'first', 'wrong').status_code == 200
+        assert attempt(testapp, 'second', 'wrong').status_code == 200
+        assert attempt(testapp, 'third', 'wrong').status_code == 429
+        assert login_throttle.stats() == dict(
+            allowed=2, rejected_ip=1, rejected_username=0)
+
+    def test_successful_logins_are_not_counted(self, user, testapp):
+        for _ in range(10):
+            assert attempt(testapp, user.username,
+                           'myprecious').status_code == 302
+            testapp.get('/logout/')
+
+    def test_unknown_users_cost_a_hash(self, db, testapp, hash_checks):
+        assert 'Unknown username' in attempt(testapp, 'nobody', 'guess')
+        assert hash_checks == ['guess']
+
+    def test_disabled(self, app, user, testapp):
+        app.config['LOGIN_THROTTLE_ENABLED'] = False
+        login_throttle.init_app(app)
+        for _ in range(10):
+            assert attempt(testapp, user.username,
+                           'wrong').status_code == 200
+
+    def test_rejections_are_counted_in_metrics(self, user, testapp):
+        for _ in range(6):
+            attempt(testapp, user.username, 'wrong')
+        totals = aggregate(metrics.collect())
+        assert totals[('login_attempts_total', ())] == 5
+        assert totals[('login_attempts_rejected_total',
+                       (('limit', 'username'),))] == 1
+        assert totals[('login_attempts_rejected_total',
+                       (('limit', 'ip'),))] == 0
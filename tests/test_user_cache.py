@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Tests for the cached user loader."""
+import pytest
+
+from TsetseCheckout.public.views import load_user
+from TsetseCheckout.user.cache import UserCache, UserSnapshot, user_cache
+from TsetseCheckout.user.models import Role, User
+from .factories import UserFactory
+
+
+class CountingLoader(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, user_id):
+        self.calls += 1
+        return User.get_by_id(user_id)
+
+
+@pytest.mark.usefixtures('db')
+class TestUserCache:
+
+    def test_load_user_returns_snapshot(self, user):
+        loaded = load_user(str(user.id))
+        assert isinstance(loaded, UserSnapshot)
+        assert loaded == user
+        assert loaded.username == user.username
+        assert loaded.is_authenticated()
+
+    def test_snapshot_is_read_only(self, user):
+        with pytest.raises(AttributeError):
+            load_user(user.id).username = 'changed'
+
+    def test_hit_skips_loader(self, user):
+        loader = CountingLoader()
+        user_cache.get(user.id, loader)
+        user_cache.get(user.id, loader)
+        assert loader.calls == 1
+        stats = user_cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_ratio'] == 0.5
+
+    def test_unknown_user_is_not_cached(self):
+        loader = CountingLoader()
+        assert user_cache.get(42, loader) is None
+        assert user_cache.get(42, loader) is None
+        assert loader.calls == 2
+
+    def test_save_invalidates(self, user):
+        load_user(user.id)
+        user.first_name = 'Changed'
+        user.save()
+        assert load_user(user.id).first_name == 'Changed'
+
+    def test_delete_invalidates(self, user):
+        load_user(user.id)
+        user.delete()
+        assert load_user(user.id) is None
+
+    def test_role_write_invalidates(self, user):
+        assert load_user(user.id).role_names == ()
+        Role.create(name='admin', user=user)
+        assert load_user(user.id).role_names == ('admin',)
+
+    def test_expires_after_ttl(self, app, user):
+        app.config['USER_CACHE_TTL'] = -1
+        cache = UserCache(app)
+        loader = CountingLoader()
+        cache.get(user.id, loader)
+        cache.get(user.id, loader)
+        assert loader.calls == 2
+
+    def test_evicts_least_recently_used(self, app):
+        app.config['USER_CACHE_SIZE'] = 2
+        cache = UserCache(app)
+        users = [UserFactory() for _ in range(3)]
+        for user in users:
+            user.save()
+        loader = CountingLoader()
+        cache.get(users[0].id, loader)
+        cache.get(users[1].id, loader)
+        cache.get(users[0].id, loader)
+        cache.get(users[2].id, loader)
+        assert cache.stats()['size'] == 2
+        cache.get(users[0].id, loader)
+        assert loader.calls == 3
+        cache.get(users[1].id, loader)
+        assert loader.calls == 4